@@ -0,0 +1,65 @@
+"""Measure the throughput of ``generate_cmaps`` against a plain loop over ``ImageConverter``.
+
+Usage:
+    python benchmarks/batch_throughput.py --images 64 --megapixels 1 --workers 1 4 8
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from img2cmap import ImageConverter
+from img2cmap import generate_cmaps
+
+
+def make_images(count, megapixels, directory):
+    """Writes ``count`` reproducible JPEGs made of a few noisy color blobs."""
+    side = int((megapixels * 1e6) ** 0.5)
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        palette = rng.integers(0, 256, size=(6, 3))
+        labels = rng.integers(0, len(palette), size=(side // 16 + 1, side // 16 + 1)).repeat(16, 0).repeat(16, 1)[:side, :side]
+        array = np.clip(palette[labels] + rng.normal(0, 12, size=(side, side, 3)), 0, 255).astype(np.uint8)
+        path = Path(directory) / f"image_{i}.jpg"
+        Image.fromarray(array).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def serial(paths, n_colors):
+    for path in paths:
+        ImageConverter(path).generate_cmap(n_colors=n_colors, random_state=42)
+
+
+def batch(paths, n_colors, workers):
+    for result in generate_cmaps(paths, n_colors=n_colors, random_state=42, workers=workers):
+        if result.error is not None:
+            raise result.error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--megapixels", type=float, default=1)
+    parser.add_argument("--n-colors", type=int, default=5)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_images(args.images, args.megapixels, directory)
+        runs = [("loop", lambda: serial(paths, args.n_colors))]
+        runs += [(f"batch x{workers}", lambda workers=workers: batch(paths, args.n_colors, workers)) for workers in args.workers]
+        print(f"{'mode':>10} {'seconds':>9} {'images/s':>9}")
+        for name, run in runs:
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            print(f"{name:>10} {elapsed:>9.2f} {args.images / elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
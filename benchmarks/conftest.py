@@ -0,0 +1,88 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("pytest_benchmark")
+
+DEFAULT_MEGAPIXELS = "0.25,1"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--bench-megapixels",
+        default=DEFAULT_MEGAPIXELS,
+        help=f"Comma separated image sizes in megapixels to benchmark, e.g. 0.25,1,12,48. Defaults to {DEFAULT_MEGAPIXELS}.",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    if "megapixels" in metafunc.fixturenames:
+        sizes = [float(size) for size in metafunc.config.getoption("--bench-megapixels").split(",")]
+        metafunc.parametrize("megapixels", sizes, ids=[f"{size:g}MP" for size in sizes], scope="session")
+
+
+def synthetic_array(megapixels, alpha, seed=0):
+    """Builds a reproducible image of a few noisy color blobs, optionally with a transparent border."""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(megapixels * 1e6 / width)
+    palette = rng.integers(0, 256, size=(8, 3), dtype=np.int16)
+    block = 32
+    labels = rng.integers(0, len(palette), size=(height // block + 1, width // block + 1))
+    labels = labels.repeat(block, axis=0).repeat(block, axis=1)[:height, :width]
+    array = palette[labels]
+    array += rng.integers(-12, 13, size=array.shape, dtype=np.int16)
+    array = np.clip(array, 0, 255).astype(np.uint8)
+    if not alpha:
+        return array
+    opacity = np.full((height, width, 1), 255, dtype=np.uint8)
+    border = max(1, min(height, width) // 8)
+    opacity[:border] = 0
+    opacity[-border:] = 0
+    return np.concatenate([array, opacity], axis=2)
+
+
+@pytest.fixture(scope="session")
+def image_cache(tmp_path_factory):
+    return {"directory": tmp_path_factory.mktemp("images")}
+
+
+@pytest.fixture(scope="session", params=[False, True], ids=["rgb", "rgba"])
+def image_file(request, megapixels, image_cache):
+    """Writes the synthetic image to a PNG once per session and returns its path."""
+    alpha = request.param
+    key = (megapixels, alpha)
+    if key not in image_cache:
+        path = image_cache["directory"] / f"synthetic_{megapixels:g}mp_{'rgba' if alpha else 'rgb'}.png"
+        Image.fromarray(synthetic_array(megapixels, alpha)).save(path, compress_level=1)
+        image_cache[key] = path
+    return image_cache[key]
+
+
+def _peak_memory_mb(function, *args):
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024**2
+
+
+@pytest.fixture
+def measure(benchmark, megapixels):
+    """Benchmarks ``function(*setup())``, recording the peak traced memory of an untimed first run.
+
+    ``setup`` builds fresh arguments for every round so that mutating stages (resize, remove_transparent) are timed
+    on the same input each time. Larger images get fewer rounds.
+    """
+
+    def run(function, setup=lambda: ()):
+        benchmark.extra_info["megapixels"] = megapixels
+        benchmark.extra_info["peak_memory_mb"] = round(_peak_memory_mb(function, *setup()), 2)
+        rounds = max(1, min(5, int(5 / megapixels)))
+        return benchmark.pedantic(function, setup=lambda: (setup(), {}), rounds=rounds, iterations=1)
+
+    return run
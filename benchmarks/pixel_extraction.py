@@ -0,0 +1,87 @@
+"""Compare the legacy ``np.array(image.getdata())`` pixel path against ``ImageConverter``.
+
+Each measurement runs in a fresh subprocess so that peak RSS is not polluted by earlier runs.
+
+Usage:
+    python benchmarks/pixel_extraction.py --megapixels 1 12 24
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+LEGACY_SETUP = """
+import numpy as np
+from PIL import Image
+"""
+
+LEGACY = """
+image = Image.open(PATH).convert("RGBA")
+getdata = getattr(image, "get_flattened_data", image.getdata)
+pixels = np.array(getdata())
+transparent_pixels = pixels[:, 3] == 0
+pixels = pixels[:, :3]
+"""
+
+CURRENT_SETUP = """
+from img2cmap import ImageConverter
+"""
+
+CURRENT = """
+converter = ImageConverter(PATH)
+"""
+
+RUNNER = """
+import json
+import resource
+import time
+import warnings
+warnings.simplefilter("ignore")
+PATH = {path!r}
+exec({setup!r})
+start = time.perf_counter()
+exec({code!r})
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"seconds": elapsed, "peak_rss_mb": peak / 1024}}))
+"""
+
+
+def make_image(megapixels, directory):
+    """Writes a reproducible noisy RGBA PNG with roughly ``megapixels`` million pixels."""
+    side = int((megapixels * 1e6) ** 0.5)
+    rng = np.random.default_rng(0)
+    array = rng.integers(0, 256, size=(side, side, 4), dtype=np.uint8)
+    array[..., 3] = np.where(array[..., 3] < 32, 0, 255)
+    path = Path(directory) / f"noise_{megapixels}mp.png"
+    Image.fromarray(array, "RGBA").save(path, compress_level=1)
+    return path
+
+
+def measure(setup, code, path):
+    """Runs ``code`` after the untimed ``setup`` in a fresh interpreter and returns its timings."""
+    output = subprocess.check_output([sys.executable, "-c", RUNNER.format(path=str(path), setup=setup, code=code)])
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[1, 12, 24])
+    args = parser.parse_args()
+
+    print(f"{'MP':>6} {'path':>8} {'seconds':>9} {'peak RSS (MB)':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for megapixels in args.megapixels:
+            path = make_image(megapixels, directory)
+            for name, setup, code in (("legacy", LEGACY_SETUP, LEGACY), ("current", CURRENT_SETUP, CURRENT)):
+                result = measure(setup, code, path)
+                print(f"{megapixels:>6g} {name:>8} {result['seconds']:>9.2f} {result['peak_rss_mb']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+import pytest
+
+from img2cmap import ImageConverter
+
+
+def test_init(measure, image_file):
+    measure(ImageConverter, lambda: (image_file,))
+
+
+def test_resize(measure, image_file):
+    measure(lambda converter: converter.resize((512, 512)), lambda: (ImageConverter(image_file),))
+
+
+def test_remove_transparent(measure, image_file):
+    measure(lambda converter: converter.remove_transparent(), lambda: (ImageConverter(image_file),))
+
+
+@pytest.mark.parametrize("engine", ["kmeans", "histogram"])
+@pytest.mark.parametrize("n_colors", [2, 4, 8, 16])
+def test_generate_cmap(measure, image_file, n_colors, engine):
+    converter = ImageConverter(image_file)
+    measure(lambda: converter.generate_cmap(n_colors=n_colors, random_state=42, engine=engine))
+
+
+@pytest.mark.parametrize("sweep", ["independent", "incremental"])
+@pytest.mark.parametrize("engine", ["kmeans", "histogram"])
+def test_generate_optimal_cmap(measure, image_file, engine, sweep):
+    converter = ImageConverter(image_file)
+    measure(lambda: converter.generate_optimal_cmap(max_colors=10, random_state=42, engine=engine, sweep=sweep))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from img2cmap import ImageConverter
+
+ENGINES = ["kmeans", "histogram", "median_cut", "octree"]
+QUALITY_SAMPLE = 100_000
+
+
+def palette_mse(pixels, palette):
+    """The mean squared distance from a sample of pixels to their nearest palette color."""
+    sample = pixels[np.random.default_rng(0).choice(len(pixels), size=min(len(pixels), QUALITY_SAMPLE), replace=False)]
+    distances = ((sample[:, None, :].astype(np.float64) - palette.rgb[None, :, :]) ** 2).sum(axis=2)
+    return float(distances.min(axis=1).mean())
+
+
+@pytest.mark.parametrize("n_colors", [4, 8, 16])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_engine(benchmark, measure, image_file, engine, n_colors):
+    """Times ``generate_palette`` per engine and records its quality next to the speed."""
+    converter = ImageConverter(image_file)
+    palette = measure(lambda: converter.generate_palette(n_colors, random_state=42, engine=engine))
+    mse = palette_mse(converter.pixels, palette)
+    reference = palette_mse(converter.pixels, ImageConverter(image_file).generate_palette(n_colors, random_state=42))
+    benchmark.extra_info.update(mse=round(mse, 2), mse_vs_kmeans=round(mse / max(reference, 1e-9), 3), colors=len(palette.rgb))
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+
+import pytest
+
+# dependencies that must only be imported by the stages that need them
+HEAVY_MODULES = ("sklearn", "scipy", "kneed", "matplotlib", "joblib")
+
+
+def importtime(statement):
+    """Runs ``statement`` in a fresh interpreter with ``-X importtime``.
+
+    Returns:
+        dict: The cumulative import time of every imported module, in milliseconds.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True, check=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1000
+    return times
+
+
+@pytest.mark.parametrize("statement", ["import img2cmap", "import img2cmap.cli", "import img2cmap.server"])
+def test_import(benchmark, statement):
+    times = benchmark.pedantic(importtime, args=(statement,), rounds=5, iterations=1)
+    module = statement.split()[-1]
+    benchmark.extra_info["import_ms"] = times[module]
+    benchmark.extra_info["slowest"] = dict(sorted(times.items(), key=lambda item: -item[1])[:10])
+    assert not [name for name in times if name.split(".")[0] in HEAVY_MODULES]
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from img2cmap import PaletteIndex
+
+
+@pytest.fixture(scope="module", params=[100_000, 1_000_000], ids=["100k", "1M"])
+def palette_index(request):
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, size=(request.param, 10, 3))
+    index = PaletteIndex(max_colors=10)
+    index.add(list(colors))
+    return index
+
+
+@pytest.mark.parametrize("n_queries", [1, 16])
+def test_query(benchmark, palette_index, n_queries):
+    queries = list(np.random.default_rng(1).integers(0, 256, size=(n_queries, 6, 3)))
+    distances, _ = benchmark.pedantic(palette_index.query, args=(queries,), kwargs=dict(k=10), rounds=3, iterations=1)
+    assert distances.shape == (n_queries, 10)
+    benchmark.extra_info["palettes"] = len(palette_index)
@@ -0,0 +1,66 @@
+import io
+import json
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from conftest import synthetic_array
+from PIL import Image
+
+from img2cmap.server import PaletteService
+from img2cmap.server import make_server
+
+N_IMAGES = 8
+CONCURRENCY = 20
+
+
+@pytest.fixture(scope="module")
+def server():
+    service = PaletteService()
+    server = make_server(port=0, service=service, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+@pytest.fixture(scope="module")
+def images():
+    encoded = []
+    for seed in range(N_IMAGES):
+        buffer = io.BytesIO()
+        Image.fromarray(synthetic_array(0.25, alpha=False, seed=seed)).save(buffer, format="PNG", compress_level=1)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def _post(port, data, query):
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/palette?{query}", data=data, headers={"Content-Type": "image/png"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+@pytest.mark.parametrize("distinct", [True, False], ids=["distinct", "identical"])
+def test_server_load(benchmark, server, images, distinct):
+    """Fires CONCURRENCY requests per image at a local server, every request of a round uses a fresh random_state."""
+    port = server.server_address[1]
+    rounds = iter(range(1_000_000))
+
+    def load():
+        query = f"n_colors=5&random_state={next(rounds)}"
+        bodies = [images[i % N_IMAGES] if distinct else images[0] for i in range(CONCURRENCY * N_IMAGES)]
+        with ThreadPoolExecutor(CONCURRENCY) as pool:
+            return list(pool.map(lambda body: _post(port, body, query), bodies))
+
+    # warm up the worker processes
+    load()
+    statuses = benchmark.pedantic(load, rounds=3, iterations=1)
+    metrics = server.service.metrics()
+    benchmark.extra_info.update(requests=len(statuses), ok=statuses.count(200), rejected=statuses.count(503))
+    benchmark.extra_info["metrics"] = json.loads(json.dumps(metrics))
@@ -1,3 +1,16 @@
+from .batch import BatchResult  # noqa: F401, E999
+from .batch import generate_cmaps  # noqa: F401, E999
+from .cache import PaletteCache  # noqa: F401, E999
 from .convert import ImageConverter  # noqa: F401, E999
+from .convert import StageTiming  # noqa: F401, E999
+from .convert import color_histogram  # noqa: F401, E999
+from .frames import FramePalette  # noqa: F401, E999
+from .frames import generate_aggregate_palette  # noqa: F401, E999
+from .frames import generate_frame_palettes  # noqa: F401, E999
+from .index import PaletteIndex  # noqa: F401, E999
+from .model import PaletteModel  # noqa: F401, E999
+from .palette import Palette  # noqa: F401, E999
+from .palette import finalize_palette  # noqa: F401, E999
+from .palette import finalize_palettes  # noqa: F401, E999
 
 __version__ = "0.2.3"
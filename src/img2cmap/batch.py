@@ -0,0 +1,154 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from contextlib import contextmanager
+from itertools import islice
+
+from threadpoolctl import threadpool_limits
+
+from .convert import ImageConverter
+
+BatchResult = namedtuple("BatchResult", ["index", "source", "cmap", "hexcodes", "error"])
+BatchResult.__doc__ = """The outcome of one image in ``generate_cmaps``.
+
+Attributes:
+    index (int): The position of the image in the input.
+    source: The image as it was passed in.
+    cmap (matplotlib.colors.ListedColormap): The colormap, None if the image failed.
+    hexcodes (list): The hex codes of the colormap, None if the image failed.
+    error (Exception): The exception raised while processing the image, None if it succeeded.
+"""
+
+
+def _decode(source, max_pixels, remove_transparent, cache):
+    converter = ImageConverter(source, max_pixels=max_pixels, cache=cache)
+    if remove_transparent:
+        converter.remove_transparent()
+    return converter
+
+
+_limit_lock = threading.Lock()
+_limit_state = {"fits": 0, "limits": None}
+
+
+@contextmanager
+def _single_threaded():
+    """Limits native code to one thread while any worker is fitting.
+
+    The limit is process wide, so concurrent fits share it: the first one in sets it and the last one out restores
+    the previous thread counts. Nesting ``threadpool_limits`` per worker instead would let one worker restore the
+    counts another one saved while it is still fitting.
+    """
+    with _limit_lock:
+        if not _limit_state["fits"]:
+            _limit_state["limits"] = threadpool_limits(limits=1)
+        _limit_state["fits"] += 1
+    try:
+        yield
+    finally:
+        with _limit_lock:
+            _limit_state["fits"] -= 1
+            if not _limit_state["fits"]:
+                _limit_state["limits"].__exit__(None, None, None)
+                _limit_state["limits"] = None
+
+
+def _cluster(converter, n_colors, random_state, engine, histogram_bits, color_space):
+    with _single_threaded():
+        cmap = converter.generate_cmap(
+            n_colors=n_colors, random_state=random_state, engine=engine, histogram_bits=histogram_bits, color_space=color_space
+        )
+    return cmap, converter.hexcodes
+
+
+def generate_cmaps(
+    images,
+    n_colors=4,
+    random_state=None,
+    workers=None,
+    decode_workers=None,
+    max_pixels=None,
+    remove_transparent=False,
+    engine="kmeans",
+    histogram_bits=5,
+    color_space="rgb",
+    ordered=True,
+    queue_size=None,
+    cache=None,
+):
+    """Generates colormaps for many images, overlapping decoding with clustering.
+
+    Images are decoded (and downloaded) by a pool of I/O threads and clustered by a pool of worker threads, with at
+    most ``queue_size`` images in flight so memory stays bounded however long the input is. While the workers fit,
+    native code is limited to a single thread so they do not oversubscribe the cores; code the caller runs between
+    results is not limited unless a fit is running at the same time.
+
+    Useage:
+        >>> for result in generate_cmaps(["a.png", "b.jpg"], n_colors=5, random_state=42):
+        ...     print(result.source, result.error or result.hexcodes)
+
+    Args:
+        images (iterable): The images, anything ``ImageConverter`` accepts. Can be a lazy iterator.
+        n_colors (int, optional): The number of colors in each colormap. Defaults to 4.
+        random_state (int, optional): A random seed for reproducing ListedColormaps. Defaults to None.
+        workers (int, optional): The number of clustering threads. If None, the number of CPUs. Defaults to None.
+        decode_workers (int, optional): The number of decoding threads. If None, same as ``workers``. Defaults to None.
+        max_pixels (int, optional): The pixel budget of each ``ImageConverter``. Defaults to None.
+        remove_transparent (bool, optional): Whether to remove transparent pixels before clustering. Defaults to False.
+        engine (str, optional): The clustering engine, see ``ImageConverter.generate_cmap``. Defaults to "kmeans".
+        histogram_bits (int, optional): The number of bits per channel kept by the "histogram" engine. Defaults to 5.
+        color_space (str, optional): The color space the colors are clustered in, see ``ImageConverter.generate_cmap``.
+            Defaults to "rgb".
+        ordered (bool, optional): If True, results are yielded in input order, otherwise as soon as they complete.
+            Defaults to True.
+        queue_size (int, optional): The maximum number of images decoded or being processed at once.
+            If None, twice the number of workers. Defaults to None.
+        cache (img2cmap.PaletteCache, optional): A cache shared by every image of the batch. Defaults to None.
+
+    Yields:
+        BatchResult: One result per image. Errors are reported in ``BatchResult.error`` and do not stop the batch.
+    """
+    workers = workers or os.cpu_count() or 1
+    decode_workers = decode_workers or workers
+    queue_size = queue_size or 2 * workers
+    images = enumerate(images)
+
+    with ThreadPoolExecutor(decode_workers) as decoders, ThreadPoolExecutor(workers) as clusterers:
+        # future -> (stage, index, source)
+        in_flight = dict()
+        # index -> BatchResult not yielded yet
+        finished = dict()
+        next_index = 0
+
+        def submit_decodes():
+            # results waiting for an earlier image count against the budget too, so ordered output stays bounded
+            for index, source in islice(images, max(0, queue_size - len(in_flight) - len(finished))):
+                future = decoders.submit(_decode, source, max_pixels, remove_transparent, cache)
+                in_flight[future] = ("decode", index, source)
+
+        submit_decodes()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, index, source = in_flight.pop(future)
+                error = future.exception()
+                if stage == "decode" and error is None:
+                    cluster_future = clusterers.submit(
+                        _cluster, future.result(), n_colors, random_state, engine, histogram_bits, color_space
+                    )
+                    in_flight[cluster_future] = ("cluster", index, source)
+                    continue
+                cmap, hexcodes = (None, None) if error is not None else future.result()
+                finished[index] = BatchResult(index, source, cmap, hexcodes, error)
+
+            if ordered:
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+            else:
+                for index in list(finished):
+                    yield finished.pop(index)
+            submit_decodes()
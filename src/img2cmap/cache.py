@@ -0,0 +1,184 @@
+import functools
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+# Bump whenever a change to the clustering makes previously cached palettes stale
+CACHE_VERSION = 1
+
+
+def pixel_digest(pixels):
+    """Hashes an array of pixels, including its shape, into a hex digest.
+
+    Args:
+        pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values.
+
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(pixels.shape).encode())
+    digest.update(np.ascontiguousarray(pixels).data)
+    return digest.hexdigest()
+
+
+def _numpy_scalar(value):
+    """Encodes numpy scalars such as ``np.int64(42)`` like the Python number they hold, so both give the same key."""
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+@functools.lru_cache(maxsize=None)
+def _sklearn_version():
+    """The installed scikit-learn version, read from the package metadata so that computing a key does not import it."""
+    try:
+        from importlib.metadata import version
+
+        return version("scikit-learn")
+    except ImportError:
+        # Python 3.7 has no importlib.metadata, and a missing distribution raises a subclass of ImportError
+        import sklearn
+
+        return sklearn.__version__
+
+
+class PaletteCache:
+    """A content-addressed cache of clustering results with LRU eviction and optional on-disk persistence.
+
+    Entries are keyed by a hash of the pixels that were clustered together with every parameter that affects the
+    result, so the same image yields a hit no matter where it was loaded from. Values are small dictionaries of numpy
+    arrays (cluster centers and SSD values). When ``directory`` is given every entry is also written there as an
+    ``.npz`` file, which survives restarts and can be shared by several processes.
+
+    Args:
+        maxsize (int, optional): The maximum number of entries kept in memory. Defaults to 256.
+        directory (str, optional): A directory for the on-disk store, ``~`` is expanded. If None, the cache only lives
+            in memory. Defaults to None.
+
+    Attributes:
+        hits (int): The number of lookups that found an entry.
+        misses (int): The number of lookups that did not.
+    """
+
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = None if directory is None else Path(directory).expanduser()
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(digest, **params):
+        """Builds a cache key from a pixel digest and the parameters of the computation.
+
+        Args:
+            digest (str): The ``pixel_digest`` of the clustered pixels.
+            **params: The parameters that affect the result, they must be JSON serializable.
+
+        Returns:
+            str: The cache key.
+        """
+        params = dict(params, cache_version=CACHE_VERSION, sklearn_version=_sklearn_version())
+        encoded = json.dumps(params, sort_keys=True, default=_numpy_scalar)
+        return hashlib.blake2b(f"{digest}:{encoded}".encode(), digest_size=20).hexdigest()
+
+    def __getstate__(self):
+        # only the settings travel, e.g. to the workers of a process pool, the entries stay on disk
+        return {"maxsize": self.maxsize, "directory": self.directory}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"], state["directory"])
+
+    def _path(self, key):
+        return self.directory / f"{key}.npz"
+
+    def get(self, key):
+        """Looks up an entry, first in memory and then on disk.
+
+        Args:
+            key (str): The cache key.
+
+        Returns:
+            dict: The cached arrays, or None on a miss.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = None
+        if self.directory is not None:
+            try:
+                with np.load(self._path(key), allow_pickle=False) as stored:
+                    value = {name: stored[name] for name in stored.files}
+            except (FileNotFoundError, OSError, ValueError):
+                value = None
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        """Stores an entry in memory and, when a directory is configured, on disk.
+
+        Args:
+            key (str): The cache key.
+            value (dict): A dictionary of numpy arrays.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._remember(key, value)
+        if self.directory is not None:
+            # write to a temporary file first so readers in other processes never see a partial entry
+            handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(handle, "wb") as f:
+                    np.savez(f, **value)
+                os.replace(temporary, self._path(key))
+            except BaseException:
+                os.unlink(temporary)
+                raise
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry from memory and disk and resets the counters.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+        if self.directory is not None:
+            for path in self.directory.glob("*.npz"):
+                path.unlink()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.directory is not None and self._path(key).exists())
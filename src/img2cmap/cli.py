@@ -0,0 +1,306 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from threadpoolctl import threadpool_limits
+
+from .cache import PaletteCache
+from .colorspace import COLOR_SPACES
+from .convert import SWEEPS
+from .convert import ImageConverter
+from .engines import engine_names
+from .sources import is_url
+
+FORMATS = ("jsonl", "csv")
+CSV_FIELDS = ["source", "n_colors", "hexcodes", "best_n_colors", "ssd", "cached", "seconds", "timings", "error"]
+
+
+def _is_image(path):
+    return path.suffix.lower() in Image.registered_extensions()
+
+
+def iter_sources(inputs, lists=()):
+    """Expands command line inputs into image sources.
+
+    Args:
+        inputs (list): Files, directories (searched recursively for image files), glob patterns or URLs.
+        lists (list, optional): Files with one source per line, "-" reads standard input. Blank lines and lines
+            starting with "#" are skipped. Defaults to ().
+
+    Yields:
+        str: Each source once, in the order given.
+    """
+    seen = set()
+
+    def expand(item):
+        if is_url(item):
+            yield item
+        elif os.path.isdir(item):
+            yield from sorted(str(path) for path in Path(item).rglob("*") if path.is_file() and _is_image(path))
+        elif any(char in item for char in "*?["):
+            yield from sorted(glob.glob(item, recursive=True))
+        else:
+            yield item
+
+    def read_lists():
+        for name in lists:
+            f = sys.stdin if name == "-" else open(name)
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        yield line
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+
+    for item in list(inputs) + list(read_lists()):
+        for source in expand(item):
+            if source not in seen:
+                seen.add(source)
+                yield source
+
+
+def _source_digest(source):
+    """Identifies an unchanged local file by its path, size and modification time, None for URLs."""
+    if is_url(source):
+        return None
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return None
+    return f"{os.path.abspath(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _options(args):
+    """The options that affect a result, part of its cache key."""
+    options = dict(
+        max_pixels=args.max_pixels,
+        remove_transparent=args.remove_transparent,
+        random_state=args.random_state,
+        engine=args.engine,
+        histogram_bits=args.histogram_bits,
+        color_space=args.color_space,
+    )
+    if args.optimal:
+        options.update(max_colors=args.max_colors, sweep=args.sweep, min_improvement=args.min_improvement, knee_patience=args.knee_patience)
+    else:
+        options.update(n_colors=args.n_colors)
+    return options
+
+
+def process(source, args, cache=None):
+    """Generates the palette of one source, never raising.
+
+    Args:
+        source (str): The image source.
+        args (argparse.Namespace): The parsed command line options.
+        cache (img2cmap.PaletteCache, optional): A cache of clustering results and of finished records of local files.
+            Defaults to None.
+
+    Returns:
+        dict: The record written to the output, with an "error" message instead of a palette on failure.
+    """
+    start = time.perf_counter()
+    record = dict(source=source, n_colors=None, hexcodes=None, best_n_colors=None, ssd=None, cached=False, timings=None, error=None)
+    options = _options(args)
+    digest = _source_digest(source) if cache is not None and args.random_state is not None else None
+    key = None if digest is None else PaletteCache.key(digest, kind="cli", **options)
+    cached = None if key is None else cache.get(key)
+    if cached is not None:
+        record.update(json.loads(str(cached["record"])), cached=True, timings={})
+        record["seconds"] = time.perf_counter() - start
+        return record
+
+    try:
+        converter = ImageConverter(source, max_pixels=args.max_pixels, cache=cache)
+        if args.remove_transparent:
+            converter.remove_transparent()
+        kwargs = dict(random_state=args.random_state, engine=args.engine, histogram_bits=args.histogram_bits, color_space=args.color_space)
+        if args.optimal:
+            _, best_n_colors, ssd = converter.generate_optimal_cmap(
+                max_colors=args.max_colors,
+                sweep=args.sweep,
+                min_improvement=args.min_improvement,
+                knee_patience=args.knee_patience,
+                **kwargs,
+            )
+            record.update(
+                best_n_colors=None if best_n_colors is None else int(best_n_colors), ssd={str(k): float(v) for k, v in ssd.items()}
+            )
+        else:
+            converter.generate_palette(args.n_colors, **kwargs)
+    except Exception as error:
+        record.update(error=f"{type(error).__name__}: {error}", seconds=time.perf_counter() - start)
+        return record
+
+    if converter.palette is not None:
+        record.update(n_colors=len(converter.hexcodes), hexcodes=converter.hexcodes)
+    timings = dict()
+    for timing in converter.timings:
+        timings[timing.stage] = timings.get(timing.stage, 0.0) + timing.seconds
+    # every clustering result came from the cache
+    record.update(cached="cache_hit" in timings and "fit" not in timings, timings=timings)
+    if key is not None:
+        stored = {name: record[name] for name in ("n_colors", "hexcodes", "best_n_colors", "ssd")}
+        cache.set(key, {"record": np.array(json.dumps(stored))})
+    record["seconds"] = time.perf_counter() - start
+    return record
+
+
+class _Writer:
+    """Writes records as JSON Lines or CSV, flushing each one so an interrupted run keeps every finished record."""
+
+    def __init__(self, f, fmt, header=True):
+        self.f = f
+        self.csv = None
+        if fmt == "csv":
+            self.csv = csv.DictWriter(f, CSV_FIELDS, extrasaction="ignore", lineterminator="\n")
+            if header:
+                self.csv.writeheader()
+
+    def write(self, record):
+        if self.csv is None:
+            self.f.write(json.dumps(record) + "\n")
+        else:
+            row = dict(record, hexcodes=" ".join(record["hexcodes"] or []))
+            for name in ("ssd", "timings"):
+                row[name] = "" if record[name] is None else json.dumps(record[name])
+            self.csv.writerow(row)
+        self.f.flush()
+
+
+def _finished_sources(path, fmt):
+    """Reads the sources already in an output file, dropping a last line cut off by an interruption.
+
+    Records with an error are not counted, so those sources are retried.
+
+    Returns:
+        set: The sources with a palette.
+        bool: Whether the file already has content, i.e. a CSV header.
+    """
+    try:
+        with open(path, "rb+") as f:
+            data = f.read()
+            complete = data.rfind(b"\n") + 1
+            if complete < len(data):
+                f.truncate(complete)
+    except FileNotFoundError:
+        return set(), False
+
+    lines = data[:complete].decode().splitlines()
+    if fmt == "csv":
+        records = csv.DictReader(lines)
+    else:
+        records = (json.loads(line) for line in lines if line.strip())
+    return {record["source"] for record in records if not record["error"]}, complete > 0
+
+
+def _positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+
+def build_parser():
+    """Builds the parser of the ``img2cmap`` command.
+
+    Returns:
+        argparse.ArgumentParser: The parser.
+    """
+    parser = argparse.ArgumentParser(
+        prog="img2cmap",
+        description="Generate color palettes from images and write one JSON Lines or CSV record per image.",
+    )
+    parser.add_argument("inputs", nargs="*", help="image files, directories, glob patterns or URLs")
+    parser.add_argument("-i", "--input-list", action="append", default=[], help="a file with one source per line, - for stdin")
+    parser.add_argument("-o", "--output", help="the output file, standard output if omitted")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="jsonl", help="the output format (default: jsonl)")
+    parser.add_argument("--resume", action="store_true", help="skip sources already in the output file and append to it")
+    parser.add_argument("-n", "--n-colors", type=int, default=4, help="the number of colors of each palette (default: 4)")
+    parser.add_argument("--optimal", action="store_true", help="find the optimal number of colors with the elbow method")
+    parser.add_argument("--max-colors", type=int, default=10, help="the largest number of colors tried by --optimal (default: 10)")
+    parser.add_argument("--sweep", choices=SWEEPS, default="independent", help="the --optimal sweep (default: independent)")
+    parser.add_argument("--min-improvement", type=float, help="stop the --optimal sweep once the SSD gain falls below this fraction")
+    parser.add_argument("--knee-patience", type=int, help="stop the --optimal sweep once the knee is stable for this many colors")
+    parser.add_argument("--engine", choices=engine_names(), default="kmeans", help="the clustering engine (default: kmeans)")
+    parser.add_argument("--histogram-bits", type=int, default=5, help="the bits per channel of the histogram engine (default: 5)")
+    parser.add_argument("--color-space", choices=COLOR_SPACES, default="rgb", help="the color space to cluster in (default: rgb)")
+    parser.add_argument("--max-pixels", type=int, help="downscale images to at most this many pixels before clustering")
+    parser.add_argument("--remove-transparent", action="store_true", help="ignore transparent pixels")
+    parser.add_argument("--random-state", type=int, default=42, help="the random seed, results are only cached with a seed (default: 42)")
+    parser.add_argument("--cache-dir", help="a directory caching results between runs, unchanged local files are skipped")
+    parser.add_argument(
+        "-j", "--workers", type=_positive_int, default=os.cpu_count() or 1, help="the number of worker threads (default: CPU count)"
+    )
+    return parser
+
+
+def main(argv=None):
+    """Runs the ``img2cmap`` command.
+
+    Args:
+        argv (list, optional): The command line arguments. If None, ``sys.argv[1:]``. Defaults to None.
+
+    Returns:
+        int: The exit status, 1 when any source failed.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.input_list:
+        parser.error("no inputs given")
+    if args.resume and not args.output:
+        parser.error("--resume requires --output")
+
+    finished, has_content = set(), False
+    if args.resume:
+        finished, has_content = _finished_sources(args.output, args.format)
+    cache = None if args.cache_dir is None else PaletteCache(directory=os.path.expanduser(args.cache_dir))
+    counts = dict(done=0, failed=0, skipped=0)
+
+    def unfinished(sources):
+        for source in sources:
+            if source in finished:
+                counts["skipped"] += 1
+            else:
+                yield source
+
+    sources = unfinished(iter_sources(args.inputs, args.input_list))
+    f = sys.stdout if args.output is None else open(args.output, "a" if args.resume else "w", newline="")
+    try:
+        writer = _Writer(f, args.format, header=not has_content)
+
+        def write(futures):
+            for future in futures:
+                record = future.result()
+                counts["failed" if record["error"] else "done"] += 1
+                writer.write(record)
+
+        # each worker runs single threaded native code, so the pool does not oversubscribe the cores
+        with ThreadPoolExecutor(args.workers) as pool, threadpool_limits(limits=1):
+            pending = set()
+            for source in sources:
+                if len(pending) >= 2 * args.workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write(done)
+                pending.add(pool.submit(process, source, args, cache))
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(done)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    print(f"{counts['done']} done, {counts['failed']} failed, {counts['skipped']} skipped", file=sys.stderr)
+    return 1 if counts["failed"] else 0
@@ -0,0 +1,120 @@
+import numpy as np
+
+COLOR_SPACES = ("rgb", "lab", "oklab")
+
+# linear sRGB to CIE XYZ and the D65 white point
+_RGB_TO_XYZ = np.array(
+    [
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ]
+)
+_WHITE = np.array([0.95047, 1.0, 1.08883])
+
+# linear sRGB to cone responses and cone responses to OKLab, see https://bottosson.github.io/posts/oklab/
+_RGB_TO_LMS = np.array(
+    [
+        [0.4122214708, 0.5363325363, 0.0514459929],
+        [0.2119034982, 0.6806995451, 0.1073969566],
+        [0.0883024619, 0.2817188376, 0.6299787005],
+    ]
+)
+_LMS_TO_OKLAB = np.array(
+    [
+        [0.2104542553, 0.7936177850, -0.0040720468],
+        [1.9779984951, -2.4285922050, 0.4505937099],
+        [0.0259040371, 0.7827717662, -0.8086757660],
+    ]
+)
+
+_DELTA = 6 / 29
+
+
+def _check(color_space):
+    if color_space not in COLOR_SPACES:
+        raise ValueError(f"color_space must be one of {COLOR_SPACES}, got {color_space!r}")
+
+
+def _to_linear(srgb):
+    return np.where(srgb <= 0.04045, srgb / 12.92, ((srgb + 0.055) / 1.055) ** 2.4)
+
+
+# sRGB decoding is per channel, so the gamma curve of every 8-bit value is computed once
+_LINEAR = _to_linear(np.arange(256) / 255).astype(np.float32)
+
+
+def _from_linear(linear, color_space):
+    """Converts linear RGB to the color space, in the precision of ``linear``."""
+    dtype = linear.dtype
+    if color_space == "oklab":
+        return np.cbrt(linear @ _RGB_TO_LMS.T.astype(dtype)) @ _LMS_TO_OKLAB.T.astype(dtype)
+
+    xyz = linear @ (_RGB_TO_XYZ.T / _WHITE).astype(dtype)
+    f = np.where(xyz > _DELTA**3, np.cbrt(xyz), xyz / dtype.type(3 * _DELTA**2) + dtype.type(4 / 29))
+    return np.stack([116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])], axis=1)
+
+
+def _to_srgb(linear):
+    linear = np.clip(linear, 0, 1)
+    return np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+
+
+def from_rgb(rgb, color_space):
+    """Converts RGB colors to a color space with exact float math, for small arrays such as color tables.
+
+    Args:
+        rgb (numpy.ndarray): A (N, 3) array of RGB colors on the 0-255 scale.
+        color_space (str): One of "rgb", "lab" (CIE L*a*b*, D65) or "oklab".
+
+    Returns:
+        numpy.ndarray: A (N, 3) float64 array of colors in the color space. "rgb" colors are returned as they are.
+    """
+    _check(color_space)
+    if color_space == "rgb":
+        return rgb
+    return _from_linear(_to_linear(np.asarray(rgb, dtype=np.float64) / 255), color_space)
+
+
+def to_rgb(colors, color_space):
+    """Converts colors from a color space back to RGB, clipping colors outside of the sRGB gamut.
+
+    Args:
+        colors (numpy.ndarray): A (N, 3) array of colors in the color space, e.g. cluster centers.
+        color_space (str): One of "rgb", "lab" or "oklab".
+
+    Returns:
+        numpy.ndarray: A (N, 3) array of RGB colors on the 0-255 scale. "rgb" colors are returned as they are.
+    """
+    _check(color_space)
+    if color_space == "rgb":
+        return colors
+    colors = np.asarray(colors, dtype=np.float64)
+    if color_space == "oklab":
+        linear = (colors @ np.linalg.inv(_LMS_TO_OKLAB).T) ** 3 @ np.linalg.inv(_RGB_TO_LMS).T
+    else:
+        fy = (colors[:, 0] + 16) / 116
+        f = np.stack([fy + colors[:, 1] / 500, fy, fy - colors[:, 2] / 200], axis=1)
+        xyz = np.where(f > _DELTA, f**3, 3 * _DELTA**2 * (f - 4 / 29)) * _WHITE
+        linear = xyz @ np.linalg.inv(_RGB_TO_XYZ).T
+    return _to_srgb(linear) * 255
+
+
+def pixels_from_rgb(pixels, color_space):
+    """Converts uint8 pixels to a color space, decoding the sRGB gamma through a 256 entry lookup table.
+
+    The lookup table only replaces the gamma curve: the channel mixing and the cube root are still computed for every
+    pixel, in float32. That takes a few tens of milliseconds per million pixels, and converting only the unique colors
+    is slower for photos, where finding them costs more than the math it saves.
+
+    Args:
+        pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values.
+        color_space (str): One of "rgb", "lab" or "oklab".
+
+    Returns:
+        numpy.ndarray: A (N, 3) float32 array of colors in the color space. "rgb" pixels are returned as they are.
+    """
+    _check(color_space)
+    if color_space == "rgb":
+        return pixels
+    return _from_linear(_LINEAR[pixels], color_space)
@@ -1,52 +1,725 @@
-import colorsys
-from pathlib import Path
-from urllib.error import HTTPError
-from urllib.error import URLError
-from urllib.request import urlopen
+import functools
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import time
+import weakref
+from collections import namedtuple
 
-import matplotlib as mpl
 import numpy as np
-from kneed import KneeLocator
 from PIL import Image
-from sklearn.cluster import MiniBatchKMeans
+
+from .cache import pixel_digest
+from .colorspace import COLOR_SPACES
+from .colorspace import from_rgb
+from .colorspace import pixels_from_rgb
+from .colorspace import to_rgb
+from .engines import engine_names
+from .engines import get_engine
+from .fetch import DEFAULT_MAX_BYTES
+from .fetch import DEFAULT_TIMEOUT
+from .fetch import fetch_bytes_async
+from .fetch import fetch_many
+from .palette import finalize_palette
+from .palette import finalize_palettes
+from .sources import open_source
+from .sources import source_name
+from .stream import ColorAccumulator
+from .stream import image_size
+from .stream import stream_image
+
+# the built-in engines, more can be added with img2cmap.engines.register_engine
+ENGINES = engine_names()
+SWEEPS = ("independent", "incremental")
+STREAM_SAMPLE_SIZE = 1_000_000
+STREAM_HISTOGRAM_BITS = 5
+# arrays larger than this go to parallel jobs as memory maps, the default threshold of joblib
+SHARED_BYTES = 1_000_000
+
+logger = logging.getLogger(__name__)
+
+StageTiming = namedtuple("StageTiming", ["stage", "seconds", "pixels", "n_colors", "iterations"])
+StageTiming.__doc__ = """The duration of one stage of an ``ImageConverter``, see ``ImageConverter.timings``.
+
+Stages are "download" (``from_url`` only), "open", "stream" (``streaming=True`` only), "decode", "pixels", "resize",
+"remove_transparent", "histogram", "sample", "color_space" (a ``color_space`` other than "rgb" only), "fit",
+"cache_hit", "palette" and "knee". "open" includes the download of URLs passed to the constructor.
+
+Attributes:
+    stage (str): The name of the stage.
+    seconds (float): The wall-clock duration of the stage.
+    pixels (int): The number of pixels (or color table entries) the stage worked on, None when not applicable.
+    n_colors (int): The number of colors of a "fit" or "cache_hit", None otherwise.
+    iterations (int): The number of k-means iterations of a "fit", None otherwise.
+"""
+
+
+def color_histogram(pixels, bits=5):
+    """Collapses an array of pixels into a weighted table of representative colors.
+
+    Each channel is quantized to ``bits`` bits and every occupied bin is represented by the mean color of
+    the pixels that fall into it. With ``bits=8`` the table holds the exact unique colors of the image.
+
+    Args:
+        pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values.
+        bits (int, optional): The number of bits kept per channel, between 1 and 8. Defaults to 5.
+
+    Returns:
+        numpy.ndarray: A (M, 3) float32 array of representative colors.
+        numpy.ndarray: A (M,) float64 array with the number of pixels behind each color.
+    """
+    if not 1 <= bits <= 8:
+        raise ValueError(f"bits must be between 1 and 8, got {bits}")
+    pixels = np.asarray(pixels, dtype=np.uint8)
+    if bits == 8:
+        # every bin holds a single color, so the packed colors are the keys
+        channels = [pixels[:, i].astype(np.uint32) for i in range(3)]
+        keys = (channels[0] << 16) | (channels[1] << 8) | channels[2]
+        keys, counts = np.unique(keys, return_counts=True)
+        colors = np.stack([(keys >> 16) & 255, (keys >> 8) & 255, keys & 255], axis=1)
+        return colors.astype(np.float32), counts.astype(np.float64)
+
+    accumulator = ColorAccumulator(bits)
+    accumulator.update(pixels)
+    return accumulator.result()
+
+
+def _fit_kmeans(data, sample_weight, n_colors, random_state):
+    """Fits a k-means model to pixels, or to a weighted color table when ``sample_weight`` is given.
+
+    Args:
+        data (numpy.ndarray): A (N, 3) array of pixels or colors.
+        sample_weight (numpy.ndarray): A (N,) array of weights, or None for unweighted pixels.
+        n_colors (int): The number of clusters.
+        random_state (int): A random seed.
+
+    Returns:
+        sklearn.cluster.KMeans or sklearn.cluster.MiniBatchKMeans: The fitted model.
+    """
+    # scikit-learn takes over a second to import, so it is only loaded once something is clustered
+    from sklearn.cluster import KMeans
+    from sklearn.cluster import MiniBatchKMeans
+
+    if sample_weight is None:
+        kmeans = MiniBatchKMeans(n_clusters=n_colors, random_state=random_state, n_init=3)
+        # the uint8 pixels are only promoted to float here
+        kmeans.fit(np.asarray(data, dtype=np.float32))
+    else:
+        # the table is small, so full weighted k-means is affordable and minimizes the same inertia as the pixels
+        kmeans = KMeans(n_clusters=n_colors, random_state=random_state, n_init=3)
+        kmeans.fit(data, sample_weight=sample_weight)
+    return kmeans
+
+
+def _fit_centers(data, sample_weight, n_colors, random_state, quantizer=None):
+    """Runs ``_fit_kmeans`` (or a quantizer engine) in a worker and only sends back the centers, the inertia and the fit
+    statistics."""
+    start = time.perf_counter()
+    if quantizer is not None:
+        centers, inertia = quantizer(data, n_colors, random_state)
+        return centers, inertia, None, time.perf_counter() - start
+    kmeans = _fit_kmeans(data, sample_weight, n_colors, random_state)
+    return kmeans.cluster_centers_, kmeans.inertia_, kmeans.n_iter_, time.perf_counter() - start
+
+
+class _SharedArrays:
+    """Writes the large arrays of a parallel sweep to memory-mapped files once, however many jobs use them.
+
+    joblib memory-maps large arguments itself, but hashes and checks every argument of every job to do so. A memory
+    map is handed to the workers as its file name.
+    """
+
+    def __init__(self):
+        self._folder = tempfile.mkdtemp(prefix="img2cmap-")
+        # id -> (array, memory map), the arrays are kept so their ids are not reused
+        self._maps = dict()
+
+    def get(self, array):
+        if array is None or array.nbytes <= SHARED_BYTES:
+            return array
+        if id(array) not in self._maps:
+            path = os.path.join(self._folder, f"{len(self._maps)}.npy")
+            np.save(path, array)
+            self._maps[id(array)] = array, np.load(path, mmap_mode="r")
+        return self._maps[id(array)][1]
+
+    def close(self):
+        self._maps.clear()
+        shutil.rmtree(self._folder, ignore_errors=True)
+
+
+def _split_worst_cluster(data, weights, centers, labels):
+    """Builds k + 1 initial centers by bisecting the cluster with the largest sum of squared distances.
+
+    The worst cluster is replaced by two centers placed one standard deviation apart along its principal axis.
+
+    Args:
+        data (numpy.ndarray): A (N, 3) array of colors.
+        weights (numpy.ndarray): A (N,) array of sample weights.
+        centers (numpy.ndarray): A (k, 3) array of fitted centers.
+        labels (numpy.ndarray): A (N,) array with the center index of each color.
+
+    Returns:
+        numpy.ndarray: A (k + 1, 3) array of initial centers.
+    """
+    squared_distances = ((data - centers[labels]) ** 2).sum(axis=1) * weights
+    worst = np.argmax(np.bincount(labels, weights=squared_distances, minlength=len(centers)))
+
+    members = labels == worst
+    diff = data[members] - centers[worst]
+    member_weights = weights[members]
+    covariance = (diff * member_weights[:, None]).T @ diff / member_weights.sum()
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    offset = np.sqrt(max(eigenvalues[-1], 0)) * eigenvectors[:, -1]
+
+    remaining = np.delete(centers, worst, axis=0)
+    return np.vstack([remaining, centers[worst] - offset, centers[worst] + offset]).astype(data.dtype)
+
+
+class _EarlyStopping:
+    """Decides when a sweep over an increasing number of colors has gone far enough.
+
+    Args:
+        min_improvement (float): Stop once one more color reduces the SSD by less than this fraction. None disables it.
+        knee_patience (int): Stop once the knee of the SSD curve evaluated so far has stayed the same for this many
+            consecutive numbers of colors. None disables it.
+    """
+
+    def __init__(self, min_improvement=None, knee_patience=None):
+        if min_improvement is not None and not 0 <= min_improvement < 1:
+            raise ValueError(f"min_improvement must be between 0 and 1, got {min_improvement}")
+        if knee_patience is not None and knee_patience < 1:
+            raise ValueError(f"knee_patience must be a positive integer, got {knee_patience}")
+        self.min_improvement = min_improvement
+        self.knee_patience = knee_patience
+        self.knees = []
+
+    @property
+    def enabled(self):
+        return self.min_improvement is not None or self.knee_patience is not None
+
+    def update(self, ssd):
+        """Checks the SSD curve after a new number of colors has been fitted.
+
+        Args:
+            ssd (dict): The SSD values evaluated so far, keyed by increasing number of colors.
+
+        Returns:
+            bool: True when the sweep should stop.
+        """
+        # a knee needs at least three points, so never stop before that
+        if not self.enabled or len(ssd) < 3:
+            return False
+        values = list(ssd.values())
+        if self.min_improvement is not None and (values[-2] <= 0 or (values[-2] - values[-1]) / values[-2] < self.min_improvement):
+            return True
+        if self.knee_patience is not None:
+            from kneed import KneeLocator
+
+            self.knees.append(KneeLocator(list(ssd), values, curve="convex", direction="decreasing").knee)
+            if len(self.knees) < self.knee_patience:
+                return False
+            start = len(self.knees) - self.knee_patience
+            return self.knees[-1] is not None and len(set(self.knees[start:])) == 1
+        return False
+
+
+def _remove_file(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _pack_image(array):
+    """Packs an image array for pickling, see ``ImageConverter.__getstate__``.
+
+    Returns:
+        tuple: ("memmap", filename, dtype, offset, shape) for a memory-mapped array, ("mask", rgb, packed transparency,
+        shape) for an alpha channel that is only opaque or transparent, ("array", array) otherwise.
+    """
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.filename is not None:
+        return ("memmap", array.filename, array.dtype.str, array.offset, array.shape)
+    if array.ndim == 3 and array.shape[2] == 4:
+        alpha = array[:, :, 3]
+        transparent = alpha == 0
+        if np.count_nonzero(transparent) + np.count_nonzero(alpha == 255) == alpha.size:
+            return ("mask", np.ascontiguousarray(array[:, :, :3]), np.packbits(transparent), alpha.shape)
+    return ("array", np.ascontiguousarray(array))
+
+
+def _unpack_image(state):
+    """Rebuilds the image array packed by ``_pack_image``."""
+    kind = state[0]
+    if kind == "memmap":
+        _, filename, dtype, offset, shape = state
+        return np.memmap(filename, dtype=np.dtype(dtype), mode="r", offset=offset, shape=shape)
+    if kind == "mask":
+        _, rgb, packed, shape = state
+        transparent = np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        array = np.empty(shape + (4,), dtype=np.uint8)
+        array[:, :, :3] = rgb
+        array[:, :, 3] = np.where(transparent, 0, 255)
+        return array
+    return state[1]
 
 
 class ImageConverter:
     """Converts an image to numpy array of RGB values.
 
     Args:
-        image_path str: The path to the image. Can be a local file or a URL.
+        image_path: The image. Can be a local path, a URL, encoded image bytes, a binary file-like object,
+            a ``PIL.Image.Image`` or a uint8 numpy array of shape (height, width, 3) or (height, width, 4).
+            Images and arrays are used without re-encoding, and arrays without copying, see
+            ``img2cmap.sources.open_source``.
+        max_pixels (int, optional): An upper bound on the number of pixels kept for clustering. Larger images are
+            downscaled (preserving the aspect ratio) when they are loaded, JPEGs are decoded directly at a reduced
+            scale. If None, the image is kept at full resolution. Defaults to None.
+        cache (img2cmap.PaletteCache, optional): A cache for clustering results. Results are looked up by a hash of the
+            pixels and the clustering parameters, so repeated images skip k-means. Only calls with a ``random_state``
+            are cached. On a cache hit ``kmeans`` is set to None. Defaults to None.
+        on_stage (callable, optional): Called with a ``StageTiming`` as soon as each stage finishes, e.g. to ship the
+            durations to a monitoring system. Defaults to None.
+        streaming (bool, optional): Reads the image strip by strip instead of loading it, for images too large to hold
+            in memory. ``pixels`` is then a uniform sample of ``max_pixels`` pixels (1,000,000 if None) and ``image`` a
+            single row image of that sample, while the "histogram" engine with the default ``histogram_bits=5`` uses
+            a histogram of every pixel of the image. Uncompressed TIFF, BMP and PPM files are memory-mapped, so memory
+            stays bounded whatever the image size; other formats are decoded in full once, but never converted or
+            copied. Defaults to False.
+
+    Every stage is also logged at DEBUG level on the ``img2cmap.convert`` logger. Recording costs a clock read per
+    stage, so it stays negligible when neither the callback nor debug logging is enabled.
 
     Attributes:
-        image_path (str): The path to the image. Can be a local file or a URL.
-        image (PIL.Image): The image object.
-        pixels (numpy.ndarray): A numpy array of RGB values.
+        image_path: The image as it was passed in.
+        name (str): The name of the image, the default palette name.
+        image (PIL.Image): The image object. For array inputs it is only built when first accessed.
+        pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values. For array inputs it is a view on the input array.
+            For images it is a view on one uint8 copy of the image data, since PIL does not expose its buffer.
+        transparent_pixels (numpy.ndarray): A (N,) boolean mask of the fully transparent pixels.
+        palette (img2cmap.Palette): The palette of the last generated colormap (the optimal one after
+            ``generate_optimal_cmap``).
+        palettes (dict): The palettes of the last ``generate_optimal_cmap`` call keyed by number of colors.
+        hexcodes (list): The hex codes of ``palette``.
+        timings (list): A ``StageTiming`` for every stage run so far, in order. Clear it to time a single call.
     """
 
-    def __init__(self, image_path):
+    def __init__(self, image_path, max_pixels=None, cache=None, on_stage=None, streaming=False):
         self.image_path = image_path
-        # try to open the image
-        try:
-            self.image = Image.open(self.image_path)
-        except (FileNotFoundError, OSError):
-            try:
-                self.image = Image.open(urlopen(self.image_path))
-            except (URLError, HTTPError) as error:
-                raise URLError(f"Could not open {self.image_path} {error}") from error
-            except ValueError as error:
-                raise ValueError(f"Could not open {self.image_path} {error}") from error
+        self.max_pixels = max_pixels
+        self.cache = cache
+        self.on_stage = on_stage
+        self.timings = []
+        self.name = source_name(image_path)
+        self._image = None
+        self._array = None
+        # whether resize may modify the image in place, images passed in by the caller are copied first
+        self._owns_image = True
+        self._transparent_removed = False
+        self._streamed_histograms = None
+        self._streamed = streaming
+        self.pixels = None
+
+        start = time.perf_counter()
+        source = open_source(self.image_path)
+        self._record("open", time.perf_counter() - start)
+        if streaming:
+            self._stream(source)
+        else:
+            if isinstance(source, np.ndarray):
+                height, width = source.shape[:2]
+                if self.max_pixels is None or height * width <= self.max_pixels:
+                    self._array = source
+                else:
+                    source = Image.fromarray(source)
+            if self._array is None:
+                self._open_image(source)
+
+        # resizing to the pixel budget has already extracted the pixels
+        if self.pixels is None:
+            self._extract_pixels()
+        self.kmeans = None
+        self.palette = None
+        self.palettes = None
+        self.hexcodes = None
+
+    def _open_image(self, image):
+        """Prepares a PIL image for pixel extraction, applying the pixel budget.
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        # JPEGs can be decoded straight at a reduced scale, this is a no-op for other formats. draft modifies the image
+        # in place, so an image passed in by the caller is left alone and resized on a copy below
+        if self.max_pixels is not None and image is not self.image_path:
+            image.draft(None, self._budget_size(image.size, self.max_pixels))
 
         # convert the image to a numpy array
-        self.image = self.image.convert("RGBA")
-        self.pixels = np.array(self.image.getdata())
+        if image.mode == "RGBA":
+            self._owns_image = image is not self.image_path
+            image.load()
+        else:
+            image = image.convert("RGBA")
+        self._image = image
+        self._record("decode", time.perf_counter() - start, image.width * image.height)
+        if self.max_pixels is not None:
+            self.resize(self._budget_size(self._image.size, self.max_pixels))
+
+    def _stream(self, source):
+        """Reads the image strip by strip into a uniform sample of pixels and color histograms of every pixel.
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        sample_size = STREAM_SAMPLE_SIZE if self.max_pixels is None else self.max_pixels
+        sample, histogram, opaque_histogram = stream_image(source, sample_size, STREAM_HISTOGRAM_BITS)
+        # memory-mapped files are never loaded by PIL, so the file it opened has to be closed here
+        if isinstance(source, Image.Image) and source is not self.image_path:
+            source.close()
+        # the sample is laid out as a single row image, so it is handled like any other array input from here on
+        self._array = sample.reshape(1, len(sample), sample.shape[1])
+        self._streamed_histograms = {False: histogram, True: opaque_histogram}
+        width, height = image_size(source)
+        self._record("stream", time.perf_counter() - start, width * height)
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.fromarray(self._array)
+        return self._image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+        self._array = None
+        self._owns_image = True
 
+    @classmethod
+    def _from_bytes(cls, data, url, download_seconds=None, **kwargs):
+        converter = cls(data, **kwargs)
+        converter.image_path = url
+        converter.name = source_name(url)
+        if download_seconds is not None:
+            converter._record("download", download_seconds, index=0)
+        return converter
+
+    @classmethod
+    async def from_url(cls, url, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, pool=None, **kwargs):
+        """Downloads and decodes an image without blocking the event loop.
+
+        Useage:
+            >>> converter = await ImageConverter.from_url("https://example.com/logo.png", max_pixels=250_000)
+
+        Args:
+            url (str): The URL of the image.
+            timeout (float, optional): The total number of seconds the download may take. Defaults to 10.
+            max_bytes (int, optional): The largest download accepted, larger ones are aborted early. Defaults to 50 MiB.
+            pool (img2cmap.fetch.ConnectionPool, optional): A pool of keep-alive connections. If None, a pool shared by
+                the whole process. Defaults to None.
+            **kwargs: Passed on to ``ImageConverter``.
+
+        Returns:
+            ImageConverter: The converter, with ``image_path`` set to ``url``.
+        """
+        import asyncio
+
+        start = time.perf_counter()
+        data = await fetch_bytes_async(url, timeout=timeout, max_bytes=max_bytes, pool=pool)
+        download_seconds = time.perf_counter() - start
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(cls._from_bytes, data, url, download_seconds, **kwargs))
+
+    @classmethod
+    async def from_urls(cls, urls, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, pool=None, concurrency=16, **kwargs):
+        """Downloads and decodes many images concurrently, see ``from_url`` and ``img2cmap.fetch.fetch_many``.
+
+        Args:
+            urls (iterable): The URLs of the images.
+            timeout (float, optional): The total number of seconds each download may take. Defaults to 10.
+            max_bytes (int, optional): The largest download accepted. Defaults to 50 MiB.
+            pool (img2cmap.fetch.ConnectionPool, optional): A pool of keep-alive connections, which also bounds the
+                number of concurrent requests per host. Defaults to None.
+            concurrency (int, optional): The maximum number of downloads in flight. Defaults to 16.
+            **kwargs: Passed on to ``ImageConverter``.
+
+        Returns:
+            list: The converters in input order. An image that could not be downloaded or decoded is returned as its
+            exception.
+        """
+        import asyncio
+
+        urls = list(urls)
+        bodies = await fetch_many(urls, timeout=timeout, max_bytes=max_bytes, pool=pool, concurrency=concurrency)
+        loop = asyncio.get_running_loop()
+
+        async def decode(data, url):
+            if isinstance(data, BaseException):
+                return data
+            return await loop.run_in_executor(None, functools.partial(cls._from_bytes, data, url, **kwargs))
+
+        return await asyncio.gather(*(decode(data, url) for data, url in zip(bodies, urls)), return_exceptions=True)
+
+    def _extract_pixels(self, record=True):
+        """Builds the pixels as views on the input array, or on a single uint8 copy of the image data.
+
+        ``np.asarray`` copies a PIL image once through ``tobytes``, without going through a Python sequence, and the
+        pixels are a view of that copy. Removing the transparent pixels makes a compact copy of the rest.
+
+        Args:
+            record (bool, optional): Whether to record the "pixels" stage, unpickling rebuilds the pixels silently.
+                Defaults to True.
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        array = np.asarray(self.image) if self._array is None else self._array
+        if array.ndim == 2:
+            # grayscale data is copied into three channels
+            array = np.repeat(array[:, :, None], 3, axis=2)
+        channels = array.shape[2]
+        array = array.reshape(-1, channels)
         # Find transparent pixels and store them in case we want to remove transparency
-        self.transparent_pixels = self.pixels[:, 3] == 0
-        self.pixels = self.pixels[:, :3]
+        if channels == 4:
+            self.transparent_pixels = array[:, 3] == 0
+        else:
+            self.transparent_pixels = np.zeros(len(array), dtype=bool)
+        self.pixels = array[:, :3]
+        if self._transparent_removed:
+            self.pixels = self.pixels[~self.transparent_pixels]
+        self._histograms = {}
+        self._converted = {}
+        self._pixel_digest = None
+        if record:
+            self._record("pixels", time.perf_counter() - start, len(self.pixels))
+
+    def to_memmap(self, path=None):
+        """Moves the image array into a memory-mapped ``.npy`` file, so pickles carry its path instead of the pixels.
+
+        Process pools and caches then send a converter in a few kilobytes and every worker maps the same pages. The
+        file must stay readable for as long as pickled copies are loaded.
+
+        Useage:
+            >>> converter.to_memmap()
+            >>> pool.submit(process, converter)
+
+        Args:
+            path (str, optional): The file to write. If None, a temporary file that is deleted together with this
+                converter. Defaults to None.
+
+        Returns:
+            str: The path of the file.
+        """
+        array = self._image_array()
+        if path is None:
+            handle, path = tempfile.mkstemp(suffix=".npy", prefix="img2cmap-")
+            os.close(handle)
+            weakref.finalize(self, _remove_file, path)
+        np.save(path, array)
+        self._array = np.load(path, mmap_mode="r")
+        self._image = None
+        # the pixels point into the file from now on, what was computed from them still holds
+        derived = self._histograms, self._converted, self._pixel_digest
+        self._extract_pixels(record=False)
+        self._histograms, self._converted, self._pixel_digest = derived
+        return str(path)
+
+    def _image_array(self):
+        return np.asarray(self.image) if self._array is None else self._array
+
+    def __getstate__(self):
+        """Pickles the image once, as compact uint8 data, without the derived arrays and the fitted model.
+
+        The pixels and the transparency mask are views of the image and are rebuilt on unpickling, an alpha channel
+        that is only opaque or transparent is stored as a bit mask, and a memory-mapped image is stored as a handle to
+        its file. ``kmeans`` is not kept, the palettes hold the fitted colors. Images passed in as objects rather than
+        paths are not kept in ``image_path``.
+        """
+        state = self.__dict__.copy()
+        for name in ("_image", "_array", "pixels", "transparent_pixels", "kmeans", "_histograms", "_converted"):
+            state.pop(name, None)
+        if not isinstance(self.image_path, (str, os.PathLike)):
+            state["image_path"] = None
+        state["_pixel_state"] = _pack_image(self._image_array())
+        return state
+
+    def __setstate__(self, state):
+        pixel_state = state.pop("_pixel_state")
+        digest = state["_pixel_digest"]
+        self.__dict__.update(state)
         self.kmeans = None
-        self.hexcodes = None
+        self._image = None
+        self._array = _unpack_image(pixel_state)
+        self._extract_pixels(record=False)
+        self._pixel_digest = digest
+
+    def _record(self, stage, seconds, pixels=None, n_colors=None, iterations=None, index=None):
+        """Records the duration of a stage, then hands it to the ``on_stage`` callback and the logger.
+
+        Returns:
+            None
+        """
+        timing = StageTiming(stage, seconds, pixels, n_colors, iterations)
+        if index is None:
+            self.timings.append(timing)
+        else:
+            self.timings.insert(index, timing)
+        if self.on_stage is not None:
+            self.on_stage(timing)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s: %s took %.4fs (pixels=%s, n_colors=%s, iterations=%s)", self.name, *timing)
+
+    @staticmethod
+    def _budget_size(size, max_pixels):
+        """Finds the largest size with the same aspect ratio as ``size`` that fits in ``max_pixels``.
 
-    def generate_cmap(self, n_colors=4, palette_name=None, random_state=None):
+        Args:
+            size (tuple): The (width, height) of the image.
+            max_pixels (int): The maximum number of pixels.
+
+        Returns:
+            tuple: The (width, height) that fits the budget.
+        """
+        width, height = size
+        if max_pixels < 1:
+            raise ValueError(f"max_pixels must be a positive integer, got {max_pixels}")
+        if width * height <= max_pixels:
+            return size
+        scale = (max_pixels / (width * height)) ** 0.5
+        return max(1, int(width * scale)), max(1, int(height * scale))
+
+    @staticmethod
+    def _resampling_technique():
+        try:
+            return Image.Resampling.LANCZOS
+        # py36
+        except AttributeError:
+            return Image.LANCZOS
+
+    def _histogram(self, bits):
+        """Returns the color histogram of the current pixels, computed once per pixel set.
+
+        A streamed image uses the histogram of every pixel it read instead of the histogram of the sample.
+        """
+        if bits not in self._histograms and self._streamed_histograms is not None and bits == STREAM_HISTOGRAM_BITS:
+            self._histograms[bits] = self._streamed_histograms[self._transparent_removed]
+        if bits not in self._histograms:
+            start = time.perf_counter()
+            self._histograms[bits] = color_histogram(self.pixels, bits)
+            self._record("histogram", time.perf_counter() - start, len(self.pixels))
+        return self._histograms[bits]
+
+    @staticmethod
+    def _check_options(engine, color_space):
+        if engine not in engine_names():
+            raise ValueError(f"engine must be one of {engine_names()}, got {engine!r}")
+        if color_space not in COLOR_SPACES:
+            raise ValueError(f"color_space must be one of {COLOR_SPACES}, got {color_space!r}")
+        if color_space != "rgb" and get_engine(engine) is not None:
+            raise ValueError(f"The {engine!r} engine only quantizes in the 'rgb' color space, got {color_space!r}")
+
+    def _histogram_in(self, bits, color_space):
+        """Returns the color histogram with its colors converted to ``color_space``, converted once per pixel set."""
+        colors, counts = self._histogram(bits)
+        if color_space != "rgb" and (bits, color_space) not in self._converted:
+            start = time.perf_counter()
+            self._converted[(bits, color_space)] = from_rgb(colors, color_space).astype(np.float32)
+            self._record("color_space", time.perf_counter() - start, len(colors))
+        return self._converted.get((bits, color_space), colors), counts
+
+    def _pixels_in(self, pixels, color_space):
+        """Converts pixels to float32 in ``color_space``, this takes the place of the float32 copy k-means makes anyway."""
+        if color_space == "rgb":
+            return pixels
+        start = time.perf_counter()
+        converted = pixels_from_rgb(pixels, color_space)
+        self._record("color_space", time.perf_counter() - start, len(pixels))
+        return converted
+
+    def _fit_inputs(self, n_colors, engine, histogram_bits, color_space="rgb"):
+        """Returns the data and sample weights the requested engine clusters.
+
+        Returns:
+            numpy.ndarray: The pixels or the color table, in ``color_space``.
+            numpy.ndarray: The weights of the color table, None for the pixels.
+        """
+        self._check_options(engine, color_space)
+        if engine == "histogram":
+            colors, counts = self._histogram_in(histogram_bits, color_space)
+            # an image with fewer distinct colors than clusters falls through to the full pixel fit
+            if len(colors) >= n_colors:
+                return colors, counts
+        # converted once per pixel set, a sweep fits the same converted pixels for every number of colors
+        if color_space != "rgb" and ("pixels", color_space) not in self._converted:
+            self._converted[("pixels", color_space)] = self._pixels_in(self.pixels, color_space)
+        return self._converted.get(("pixels", color_space), self.pixels), None
+
+    def _fit(self, n_colors, random_state, engine, histogram_bits, color_space="rgb"):
+        """Fits the pixels with the requested engine, k-means engines keep their model in ``self.kmeans``.
+
+        Returns:
+            numpy.ndarray: The cluster centers, in ``color_space``.
+            float: The inertia.
+        """
+        data, sample_weight = self._fit_inputs(n_colors, engine, histogram_bits, color_space)
+        start = time.perf_counter()
+        quantizer = get_engine(engine)
+        if quantizer is not None:
+            self.kmeans = None
+            cluster_centers, inertia = quantizer(data, n_colors, random_state)
+            self._record("fit", time.perf_counter() - start, len(data), n_colors)
+            return np.asarray(cluster_centers, dtype=np.float64), float(inertia)
+        self.kmeans = _fit_kmeans(data, sample_weight, n_colors, random_state)
+        self._record("fit", time.perf_counter() - start, len(data), n_colors, self.kmeans.n_iter_)
+        return self.kmeans.cluster_centers_, self.kmeans.inertia_
+
+    def _cache_key(self, kind, random_state, engine, histogram_bits, color_space="rgb", **params):
+        """Builds the cache key of a computation on the current pixels, None when the result should not be cached."""
+        if self.cache is None or random_state is None:
+            return None
+        if self._pixel_digest is None:
+            self._pixel_digest = pixel_digest(self.pixels)
+        if engine == "histogram":
+            params["histogram_bits"] = histogram_bits
+        if color_space != "rgb":
+            params["color_space"] = color_space
+        if self._streamed_histograms is not None:
+            params["streamed"] = True
+        return self.cache.key(
+            self._pixel_digest,
+            kind=kind,
+            random_state=random_state,
+            engine=engine,
+            transparent_removed=self._transparent_removed,
+            **params,
+        )
+
+    def _fit_cached(self, n_colors, random_state, engine, histogram_bits, color_space="rgb"):
+        """Fits ``self.kmeans`` unless the result is already in the cache.
+
+        Returns:
+            numpy.ndarray: The cluster centers, in RGB.
+            float: The inertia, in ``color_space``.
+        """
+        start = time.perf_counter()
+        key = self._cache_key("fit", random_state, engine, histogram_bits, color_space, n_colors=n_colors)
+        cached = None if key is None else self.cache.get(key)
+        if cached is not None:
+            self.kmeans = None
+            self._record("cache_hit", time.perf_counter() - start, n_colors=n_colors)
+            return cached["centers"], float(cached["inertia"])
+
+        cluster_centers, inertia = self._fit(n_colors, random_state, engine, histogram_bits, color_space)
+        cluster_centers = to_rgb(cluster_centers, color_space)
+        if key is not None:
+            self.cache.set(key, {"centers": cluster_centers, "inertia": np.array(inertia)})
+        return cluster_centers, inertia
+
+    def generate_cmap(self, n_colors=4, palette_name=None, random_state=None, engine="kmeans", histogram_bits=5, color_space="rgb"):
         """Generates a matplotlib ListedColormap from an image.
 
         Args:
@@ -57,35 +730,84 @@ class ImageConverter:
                 The k-means algorithm has a random initialization step and doesn't always converge on the same
                 solution because of this. If None will be a different seed each time this method is called.
                 Defaults to None.
+            engine (str, optional): The clustering engine. "kmeans" clusters every pixel, "histogram" first collapses the
+                pixels into a weighted table of representative colors (see ``color_histogram``) and clusters that table,
+                which is much faster on large images and gives nearly the same palette. "median_cut", "octree" and
+                "libimagequant" (when Pillow is built with it) are single pass quantizers from ``PIL.Image.quantize``,
+                much faster still and good enough for thumbnails, logos and previews. They only support the "rgb" color
+                space and may return fewer colors than requested. Engines added with
+                ``img2cmap.engines.register_engine`` are accepted too. Defaults to "kmeans".
+            histogram_bits (int, optional): The number of bits per channel kept by the "histogram" engine. 8 keeps the
+                exact unique colors. Defaults to 5.
+            color_space (str, optional): The color space the colors are clustered in. "rgb" clusters the raw sRGB
+                values, "lab" (CIE L*a*b*) and "oklab" are perceptual spaces where distances follow perceived color
+                differences, so the palette has fewer near-duplicates. The centers are mapped back to sRGB, ``kmeans``
+                holds the model fitted in the perceptual space. Defaults to "rgb".
 
         Returns:
             matplotlib.colors.ListedColormap: A matplotlib ListedColormap object.
         """
-        # create a kmeans model
-        self.kmeans = MiniBatchKMeans(n_clusters=n_colors, random_state=random_state, n_init=3)
-        # fit the model to the pixels
-        self.kmeans.fit(self.pixels)
-        # get the cluster centers
-        centroids = self.kmeans.cluster_centers_ / 255
-        # return the palette
-        if palette_name is None:
-            palette_name = Path(self.image_path).stem
+        cluster_centers, _ = self._fit_cached(n_colors, random_state, engine, histogram_bits, color_space)
+        return self._build_cmap(cluster_centers, palette_name)
 
-        cmap = mpl.colors.ListedColormap(centroids, name=palette_name)
+    def generate_palette(self, n_colors=4, random_state=None, engine="kmeans", histogram_bits=5, color_space="rgb"):
+        """Generates a hue sorted ``Palette`` from an image, without building a matplotlib colormap.
 
-        # Handle 4 dimension RGBA colors
-        cmap.colors = cmap.colors[:, :3]
+        Args:
+            n_colors (int, optional): The number of colors in the palette. Defaults to 4.
+            random_state (int, optional): A random seed for reproducing palettes. Defaults to None.
+            engine (str, optional): The clustering engine, see ``generate_cmap``. Defaults to "kmeans".
+            histogram_bits (int, optional): The number of bits per channel kept by the "histogram" engine. Defaults to 5.
+            color_space (str, optional): The color space the colors are clustered in, see ``generate_cmap``.
+                Defaults to "rgb".
 
-        # Sort colors by hue
-        cmap.colors = sorted(cmap.colors, key=lambda rgb: colorsys.rgb_to_hsv(*rgb))
-        # Handle cases where all rgb values evaluate to 1 or 0. This is a temporary fix
-        cmap.colors = np.where(np.isclose(cmap.colors, 1), 1 - 1e-6, cmap.colors)
-        cmap.colors = np.where(np.isclose(cmap.colors, 0), 1e-6, cmap.colors)
+        Returns:
+            img2cmap.Palette: The palette, with uint8 RGB values, 0-1 float colors and hex codes.
+        """
+        cluster_centers, _ = self._fit_cached(n_colors, random_state, engine, histogram_bits, color_space)
+        self._finalize(cluster_centers)
+        return self.palette
+
+    def _build_cmap(self, cluster_centers, palette_name):
+        """Turns cluster centers on the 0-255 scale into a hue sorted ListedColormap and records the hex codes.
+
+        Args:
+            cluster_centers (numpy.ndarray): A (n_colors, 3) array of cluster centers.
+            palette_name (str): A name for the palette. If None, defaults to the image name.
 
-        self.hexcodes = [mpl.colors.rgb2hex(c) for c in cmap.colors]
-        return cmap
+        Returns:
+            matplotlib.colors.ListedColormap: A matplotlib ListedColormap object.
+        """
+        if palette_name is None:
+            palette_name = self.name
+        self._finalize(cluster_centers)
+        return self.palette.to_cmap(palette_name)
+
+    def _finalize(self, cluster_centers):
+        """Sets ``palette`` and ``hexcodes`` from cluster centers on the 0-255 scale.
+
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        self.palette = finalize_palette(cluster_centers)
+        self.hexcodes = self.palette.hexcodes
+        self._record("palette", time.perf_counter() - start, n_colors=len(cluster_centers))
 
-    def generate_optimal_cmap(self, max_colors=10, palette_name=None, random_state=None):
+    def generate_optimal_cmap(
+        self,
+        max_colors=10,
+        palette_name=None,
+        random_state=None,
+        engine="kmeans",
+        histogram_bits=5,
+        sweep="independent",
+        sample_size=100_000,
+        n_jobs=None,
+        min_improvement=None,
+        knee_patience=None,
+        color_space="rgb",
+    ):
         """Generates an optimal matplotlib ListedColormap from an image by finding the optimal number of clusters using the elbow method.
 
         Useage:
@@ -100,6 +822,34 @@ class ImageConverter:
             palette_name (_type_, optional): _description_. Defaults to None.
             random_state (_type_, optional): _description_. Defaults to None.
             remove_background (_type_, optional): _description_. Defaults to None.
+            engine (str, optional): The clustering engine, see ``generate_cmap``. Defaults to "kmeans".
+            histogram_bits (int, optional): The number of bits per channel kept by the "histogram" engine. Defaults to 5.
+            sweep (str, optional): How the number of colors is swept. "independent" fits every number of colors from
+                scratch. "incremental" fits once on a shared subsample of pixels (or on the color table with the "histogram"
+                engine), then warm-starts each next number of colors from the previous centers with the worst cluster
+                split in two, which is several times faster. Defaults to "independent".
+            sample_size (int, optional): The number of pixels in the shared subsample of the "incremental" sweep.
+                Defaults to 100_000.
+            n_jobs (int, optional): The number of parallel jobs for the "independent" sweep, -1 uses every core.
+                Large arrays are memory-mapped into the workers rather than pickled and each number of colors uses the
+                same ``random_state``, so the result does not depend on the number of jobs. The default joblib backend
+                uses processes, wrap the call in ``joblib.parallel_backend("threading")`` for threads. When the sweep runs
+                in parallel the fitted models stay in the workers and ``kmeans`` is set to None. None means 1 unless in a
+                ``joblib.parallel_backend`` context. The "incremental" sweep is sequential and ignores this.
+                Defaults to None.
+            min_improvement (float, optional): Stops the sweep early once one more color reduces the SSD by less than
+                this fraction, e.g. 0.05. If None, this criterion is not used. Defaults to None.
+            knee_patience (int, optional): Stops the sweep early once the knee of the SSD curve evaluated so far has
+                been the same for this many consecutive numbers of colors, e.g. 3. If None, this criterion is not used.
+                Defaults to None.
+            color_space (str, optional): The color space the colors are clustered in, see ``generate_cmap``. The SSD
+                values are measured in that space. Defaults to "rgb".
+
+        With ``min_improvement`` or ``knee_patience`` the numbers of colors are evaluated in increasing order and the
+        sweep stops as soon as either criterion is met (but never before 4 colors), so most images skip the expensive
+        fits with many colors. The returned dictionaries then only hold the numbers of colors that were evaluated and the
+        knee is located on that shorter curve. A parallel sweep fits one batch of ``n_jobs`` numbers of colors at a
+        time and stops at the same number of colors as a sequential one.
 
         Returns:
             dict: A dictionary of matplotlib ListedColormap objects.
@@ -108,23 +858,189 @@ class ImageConverter:
             dict: A dictionary of the sum of square distances from each point to the cluster center.
             Keys are the number of colors (clusters) and values are the SSD value.
         """
+        if sweep not in SWEEPS:
+            raise ValueError(f"sweep must be one of {SWEEPS}, got {sweep!r}")
+
+        if sweep == "incremental" and get_engine(engine) is not None:
+            raise ValueError(f"The incremental sweep warm-starts k-means, it does not support the {engine!r} engine")
+        stopping = _EarlyStopping(min_improvement, knee_patience)
+        if sweep == "incremental":
+            centers, ssd = self._incremental_sweep(max_colors, random_state, engine, histogram_bits, sample_size, stopping, color_space)
+        elif n_jobs not in (None, 1):
+            centers, ssd = self._parallel_sweep(max_colors, random_state, engine, histogram_bits, n_jobs, stopping, color_space)
+        else:
+            ssd = dict()
+            centers = dict()
+            for n_colors in range(2, max_colors + 1):
+                centers[n_colors], ssd[n_colors] = self._fit_cached(n_colors, random_state, engine, histogram_bits, color_space)
+                if stopping.update(ssd):
+                    break
+
+        if palette_name is None:
+            palette_name = self.name
+        start = time.perf_counter()
+        self.palettes = dict(zip(centers, finalize_palettes(list(centers.values()))))
+        cmaps = {n_colors: palette.to_cmap(palette_name) for n_colors, palette in self.palettes.items()}
+        self._record("palette", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        # kneed pulls in scipy and matplotlib, so it is only loaded by the sweep
+        from kneed import KneeLocator
+
+        best_n_colors = KneeLocator(list(ssd.keys()), list(ssd.values()), curve="convex", direction="decreasing").knee
+        self._record("knee", time.perf_counter() - start)
+        # Kneed may not find an optimal point, then we don't record any hex values
+        self.palette = self.palettes.get(best_n_colors)
+        self.hexcodes = None if self.palette is None else self.palette.hexcodes
+        return cmaps, best_n_colors, ssd
+
+    def _sweep_data(self, max_colors, random_state, engine, histogram_bits, sample_size, color_space):
+        """Returns the colors, weights and SSD scale shared by every number of colors in an incremental sweep."""
+        self._check_options(engine, color_space)
+        if engine == "histogram":
+            colors, counts = self._histogram_in(histogram_bits, color_space)
+            # like _fit_inputs, an image with fewer distinct colors than clusters falls through to the pixels
+            if len(colors) >= max_colors:
+                return colors, counts, 1.0
+
+        start = time.perf_counter()
+        n_pixels = len(self.pixels)
+        if n_pixels > sample_size:
+            rng = np.random.default_rng(random_state)
+            sample = self.pixels[rng.choice(n_pixels, size=sample_size, replace=False)]
+        else:
+            sample = self.pixels
+        self._record("sample", time.perf_counter() - start, len(sample))
+        sample = self._pixels_in(sample, color_space).astype(np.float32, copy=False)
+        # scale the SSD of the subsample up so it is comparable to an SSD over every pixel
+        return sample, np.ones(len(sample)), n_pixels / len(sample)
+
+    def _incremental_sweep(self, max_colors, random_state, engine, histogram_bits, sample_size, stopping, color_space):
+        """Fits 2 to ``max_colors`` colors, warm-starting each fit from the previous one.
+
+        Returns:
+            dict: The cluster centers keyed by number of colors.
+            dict: The SSD values keyed by number of colors.
+        """
+        key = self._cache_key(
+            "incremental",
+            random_state,
+            engine,
+            histogram_bits,
+            color_space,
+            max_colors=max_colors,
+            sample_size=sample_size,
+            min_improvement=stopping.min_improvement,
+            knee_patience=stopping.knee_patience,
+        )
+        cached = None if key is None else self.cache.get(key)
+        if cached is not None:
+            self.kmeans = None
+            # an early stopped sweep holds fewer than max_colors - 1 entries
+            evaluated = range(2, len(cached["ssd"]) + 2)
+            self._record("cache_hit", 0.0, n_colors=evaluated[-1])
+            centers = {n_colors: cached[f"centers_{n_colors}"] for n_colors in evaluated}
+            return centers, dict(zip(evaluated, cached["ssd"].tolist()))
+
+        from sklearn.cluster import KMeans
+
+        data, weights, scale = self._sweep_data(max_colors, random_state, engine, histogram_bits, sample_size, color_space)
         ssd = dict()
-        cmaps = dict()
+        centers = dict()
         for n_colors in range(2, max_colors + 1):
-            cmap = self.generate_cmap(n_colors=n_colors, palette_name=palette_name, random_state=random_state)
-            cmaps[n_colors] = cmap
-            ssd[n_colors] = self.kmeans.inertia_
+            start = time.perf_counter()
+            if n_colors == 2:
+                self.kmeans = KMeans(n_clusters=n_colors, random_state=random_state, n_init=3)
+            else:
+                init = _split_worst_cluster(data, weights, self.kmeans.cluster_centers_, self.kmeans.labels_)
+                self.kmeans = KMeans(n_clusters=n_colors, init=init, random_state=random_state, n_init=1)
+            self.kmeans.fit(data, sample_weight=weights)
+            self._record("fit", time.perf_counter() - start, len(data), n_colors, self.kmeans.n_iter_)
+            centers[n_colors] = to_rgb(self.kmeans.cluster_centers_, color_space)
+            ssd[n_colors] = self.kmeans.inertia_ * scale
+            if stopping.update(ssd):
+                break
+        if key is not None:
+            arrays = {f"centers_{n_colors}": cluster_centers for n_colors, cluster_centers in centers.items()}
+            self.cache.set(key, dict(arrays, ssd=np.array(list(ssd.values()))))
+        return centers, ssd
 
-        best_n_colors = KneeLocator(list(ssd.keys()), list(ssd.values()), curve="convex", direction="decreasing").knee
+    def _parallel_sweep(self, max_colors, random_state, engine, histogram_bits, n_jobs, stopping, color_space):
+        """Fits every number of colors from 2 to ``max_colors`` independently in parallel jobs.
+
+        When early stopping is enabled the numbers of colors are dispatched in batches of ``n_jobs``.
+
+        Returns:
+            dict: The cluster centers keyed by number of colors.
+            dict: The SSD values keyed by number of colors.
+        """
+        from joblib import Parallel
+        from joblib import effective_n_jobs
+
+        candidates = list(range(2, max_colors + 1))
+        batch_size = effective_n_jobs(n_jobs) if stopping.enabled else max(1, len(candidates))
+        centers = dict()
+        ssd = dict()
+        # mmap_mode="r" hands large arrays to the workers as read-only memory maps instead of pickled copies, and the
+        # inputs of the sweep are written to a memory map once, shared by every number of colors
+        shared = _SharedArrays() if effective_n_jobs(n_jobs) > 1 else None
         try:
-            self.hexcodes = [mpl.colors.rgb2hex(c) for c in cmaps[best_n_colors].colors]
-        except KeyError:
-            # Kneed did not find an optimal point so we don't record any hex values
-            self.hexcodes = None
-        return cmaps, best_n_colors, ssd
+            with Parallel(n_jobs=n_jobs, mmap_mode="r", max_nbytes=SHARED_BYTES) as parallel:
+                for start in range(0, len(candidates), batch_size):
+                    stop = start + batch_size
+                    batch = candidates[start:stop]
+                    results = self._parallel_fits(parallel, batch, random_state, engine, histogram_bits, color_space, shared)
+                    for n_colors, result in results.items():
+                        centers[n_colors] = result["centers"]
+                        ssd[n_colors] = float(result["inertia"])
+                        if stopping.update(ssd):
+                            self.kmeans = None
+                            return centers, ssd
+        finally:
+            if shared is not None:
+                shared.close()
+
+        self.kmeans = None
+        return centers, ssd
+
+    def _parallel_fits(self, parallel, candidates, random_state, engine, histogram_bits, color_space, shared=None):
+        """Fits the given numbers of colors in parallel, skipping those already in the cache.
+
+        Large inputs are handed to the jobs through ``shared``, a ``_SharedArrays`` of the sweep, if given.
+
+        Returns:
+            dict: The RGB centers and inertia of each number of colors, in the order of ``candidates``.
+        """
+        keys = {
+            n_colors: self._cache_key("fit", random_state, engine, histogram_bits, color_space, n_colors=n_colors)
+            for n_colors in candidates
+        }
+        results = {n_colors: None if key is None else self.cache.get(key) for n_colors, key in keys.items()}
+        missing = [n_colors for n_colors, cached in results.items() if cached is None]
+        for n_colors in candidates:
+            if results[n_colors] is not None:
+                self._record("cache_hit", 0.0, n_colors=n_colors)
+
+        from joblib import delayed
+
+        inputs = {n_colors: self._fit_inputs(n_colors, engine, histogram_bits, color_space) for n_colors in missing}
+        if shared is not None:
+            inputs = {n_colors: tuple(shared.get(array) for array in arrays) for n_colors, arrays in inputs.items()}
+        quantizer = get_engine(engine)
+        fitted = parallel(delayed(_fit_centers)(*inputs[n_colors], n_colors, random_state, quantizer) for n_colors in missing)
+        for n_colors, (cluster_centers, inertia, iterations, seconds) in zip(missing, fitted):
+            self._record("fit", seconds, len(inputs[n_colors][0]), n_colors, iterations)
+            results[n_colors] = {"centers": to_rgb(cluster_centers, color_space), "inertia": np.array(inertia)}
+            if keys[n_colors] is not None:
+                self.cache.set(keys[n_colors], results[n_colors])
+        return results
 
     def resize(self, size=(512, 512)):
-        """Resizes the image to the specified size.
+        """Resizes the image to fit within the specified size, preserving the aspect ratio.
+
+        The pixels used for clustering are rebuilt from the resized image, so subsequent calls to
+        ``generate_cmap`` only cluster the reduced pixel set. The sample of a streamed image is not an image, so it is
+        never resampled: every n-th sampled pixel is kept, at most ``size[0] * size[1]`` of them.
 
         Args:
             size (tuple): The new size of the image.
@@ -132,13 +1048,36 @@ class ImageConverter:
         Returns:
             None
         """
-        try:
-            resampling_technique = Image.Resampling.LANCZOS
-        # py36
-        except AttributeError:
-            resampling_technique = Image.LANCZOS
+        if self._streamed:
+            self._subsample(size[0] * size[1])
+            return
+        original_size = self.image.size
+        if size[0] >= original_size[0] and size[1] >= original_size[1]:
+            return
+        start = time.perf_counter()
+        if not self._owns_image:
+            self.image = self.image.copy()
+        self.image.thumbnail(size, self._resampling_technique())
+        self._array = None
+        # the histograms of a streamed image describe the original pixels, not the resized ones
+        self._streamed_histograms = None
+        self._record("resize", time.perf_counter() - start, self.image.width * self.image.height)
+        self._extract_pixels()
 
-        self.image.thumbnail(size, resampling_technique)
+    def _subsample(self, n_pixels):
+        """Keeps every n-th pixel of a streamed sample, filtering across unrelated samples would blend their colors."""
+        array = self._image_array()
+        if array.shape[1] <= n_pixels:
+            return
+        start = time.perf_counter()
+        # the sampled positions are sorted, so a stride keeps the sample spread over the whole image
+        step = -(-array.shape[1] // n_pixels)
+        self._array = np.ascontiguousarray(array[:, ::step])
+        self._image = None
+        # the histograms of a streamed image describe the original pixels, not the reduced sample
+        self._streamed_histograms = None
+        self._record("resize", time.perf_counter() - start, self._array.shape[1])
+        self._extract_pixels()
 
     def remove_transparent(self):
         """Removes the transparent pixels from an image array.
@@ -146,4 +1085,11 @@ class ImageConverter:
         Returns:
             None
         """
-        self.pixels = self.pixels[~self.transparent_pixels]
+        if not self._transparent_removed:
+            start = time.perf_counter()
+            self._transparent_removed = True
+            self.pixels = self.pixels[~self.transparent_pixels]
+            self._histograms = {}
+            self._converted = {}
+            self._pixel_digest = None
+            self._record("remove_transparent", time.perf_counter() - start, len(self.pixels))
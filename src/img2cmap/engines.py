@@ -0,0 +1,112 @@
+import numpy as np
+from PIL import Image
+from PIL import features
+
+# PIL.Image.Quantize values, passed as plain integers so Pillow releases without the enum work too
+QUANTIZE_METHODS = {"median_cut": 0, "octree": 2, "libimagequant": 3}
+
+# name -> fit(pixels, n_colors, random_state) of the quantizer engines
+_ENGINES = dict()
+
+
+def palette_inertia(pixels, labels, centers):
+    """The sum of squared distances from each pixel to its assigned palette color, the k-means inertia of a palette.
+
+    Args:
+        pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values.
+        labels (numpy.ndarray): A (N,) array with the index of the palette color of each pixel.
+        centers (numpy.ndarray): A (k, 3) array of palette colors.
+
+    Returns:
+        float: The inertia.
+    """
+    # |p - c|^2 summed per channel from per-color sums, so no (N, 3) float array is materialized
+    centers = np.asarray(centers, dtype=np.float64)
+    counts = np.bincount(labels, minlength=len(centers))
+    inertia = float(counts @ (centers**2).sum(axis=1))
+    for channel in range(3):
+        values = pixels[:, channel]
+        inertia += float(np.bincount(values, minlength=256) @ np.arange(256.0) ** 2)
+        inertia -= 2 * float(np.bincount(labels, weights=values, minlength=len(centers)) @ centers[:, channel])
+    return max(inertia, 0.0)
+
+
+class PILQuantizer:
+    """A single pass quantizer engine built on ``PIL.Image.quantize``.
+
+    Median cut and octree quantization are tens of times faster than k-means and need no random seed. The palette is
+    the one Pillow chooses, the inertia is measured against Pillow's assignment of the pixels.
+
+    Args:
+        method (int): A ``PIL.Image.Quantize`` value, see ``QUANTIZE_METHODS``.
+    """
+
+    def __init__(self, method):
+        self.method = method
+
+    def __call__(self, pixels, n_colors, random_state=None):
+        """Quantizes pixels to at most ``n_colors`` colors.
+
+        Args:
+            pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values.
+            n_colors (int): The number of colors.
+            random_state (int, optional): Unused, the quantizers are deterministic. Defaults to None.
+
+        Returns:
+            numpy.ndarray: A (k, 3) float array of palette colors, k <= n_colors when the image has fewer colors.
+            float: The inertia of the palette, see ``palette_inertia``.
+        """
+        if self.method == QUANTIZE_METHODS["libimagequant"] and not features.check_feature("libimagequant"):
+            raise ValueError("The libimagequant engine requires Pillow built with libimagequant")
+        pixels = np.ascontiguousarray(pixels[:, :3])
+        quantized = Image.fromarray(pixels.reshape(1, len(pixels), 3)).quantize(n_colors, method=self.method)
+        labels = np.asarray(quantized).ravel()
+        palette = np.asarray(quantized.getpalette()[: 3 * 256], dtype=np.float64).reshape(-1, 3)
+        # Pillow pads the palette, only the entries that were assigned are palette colors
+        used = np.flatnonzero(np.bincount(labels, minlength=len(palette)))
+        relabel = np.zeros(len(palette), dtype=np.intp)
+        relabel[used] = np.arange(len(used))
+        centers = palette[used]
+        return centers, palette_inertia(pixels, relabel[labels], centers)
+
+
+def register_engine(name, fit):
+    """Registers a quantizer engine, which is then accepted as ``engine=name`` everywhere a palette is generated.
+
+    Useage:
+        >>> def grayscale_ramp(pixels, n_colors, random_state=None):
+        ...     centers = np.linspace(0, 255, n_colors)[:, None].repeat(3, axis=1)
+        ...     labels = np.abs(pixels.mean(axis=1)[:, None] - centers[:, 0]).argmin(axis=1)
+        ...     return centers, palette_inertia(pixels, labels, centers)
+        >>> register_engine("grayscale_ramp", grayscale_ramp)
+
+    Args:
+        name (str): The engine name, "kmeans" and "histogram" are reserved.
+        fit (callable): ``fit(pixels, n_colors, random_state)`` taking a (N, 3) uint8 array of RGB pixels and
+            returning a (k, 3) array of palette colors on the 0-255 scale and their inertia, the sum of squared
+            distances from each pixel to its palette color. It must be picklable to run in parallel sweeps.
+
+    Returns:
+        None
+    """
+    if name in ("kmeans", "histogram"):
+        raise ValueError(f"{name!r} is a built-in engine")
+    _ENGINES[name] = fit
+
+
+def get_engine(name):
+    """Returns the fit function of a quantizer engine, None for "kmeans", "histogram" and unknown names."""
+    return _ENGINES.get(name)
+
+
+def engine_names():
+    """Returns the names of every engine, built-in and registered.
+
+    Returns:
+        tuple: The engine names.
+    """
+    return ("kmeans", "histogram") + tuple(_ENGINES)
+
+
+for _name, _method in QUANTIZE_METHODS.items():
+    register_engine(_name, PILQuantizer(_method))
@@ -0,0 +1,263 @@
+import functools
+import http.client
+import socket
+import threading
+import time
+from collections import defaultdict
+from urllib.error import HTTPError
+from urllib.error import URLError
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+# without an explicit list of schemes, redirects are only followed to these, as urlopen does
+_REDIRECT_SCHEMES = ("http", "https")
+_USER_AGENT = "img2cmap"
+
+
+def _read_capped(response, max_bytes, deadline, url):
+    """Reads a response body in chunks, aborting as soon as it exceeds ``max_bytes`` or the deadline passes."""
+    length = response.headers.get("Content-Length")
+    if max_bytes is not None and length is not None and length.isdigit() and int(length) > max_bytes:
+        raise ValueError(f"{url} is {length} bytes, more than max_bytes={max_bytes}")
+
+    chunks = []
+    size = 0
+    while True:
+        if time.monotonic() > deadline:
+            raise URLError(f"timed out reading {url}")
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if max_bytes is not None and size > max_bytes:
+            raise ValueError(f"{url} is more than max_bytes={max_bytes} bytes")
+        chunks.append(chunk)
+
+
+class ConnectionPool:
+    """A thread-safe pool of keep-alive HTTP(S) connections with a bounded number of concurrent requests per host.
+
+    Args:
+        max_per_host (int, optional): The maximum number of concurrent requests to a single host. Defaults to 4.
+
+    Attributes:
+        connections_opened (int): The number of connections opened so far, useful to check connection reuse.
+    """
+
+    def __init__(self, max_per_host=4):
+        self.max_per_host = max_per_host
+        self.connections_opened = 0
+        self._idle = defaultdict(list)
+        self._slots = dict()
+        self._lock = threading.Lock()
+
+    def _slot(self, scheme, netloc):
+        # created under the lock, two threads reaching a new host at once must share one semaphore
+        with self._lock:
+            return self._slots.setdefault((scheme, netloc), threading.BoundedSemaphore(self.max_per_host))
+
+    def _checkout(self, scheme, netloc, timeout):
+        with self._lock:
+            idle = self._idle[(scheme, netloc)]
+            if idle:
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock is not None:
+                    connection.sock.settimeout(timeout)
+                return connection, True
+            self.connections_opened += 1
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(netloc, timeout=timeout), False
+
+    def _checkin(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle[(scheme, netloc)].append(connection)
+
+    def get(self, url, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, schemes=None):
+        """Downloads a URL, reusing an idle connection to the same host when there is one.
+
+        Redirects are followed. Schemes other than http and https are handed to ``urllib.request.urlopen``. Unless
+        ``schemes`` lists them, redirects to them are refused, so a server cannot redirect to a local ``file://`` URL.
+
+        Args:
+            url (str): The URL to download.
+            timeout (float, optional): The total number of seconds the request may take. Defaults to 10.
+            max_bytes (int, optional): The largest body accepted. Larger bodies are aborted as soon as the limit is
+                exceeded. If None, there is no limit. Defaults to 50 MiB.
+            schemes (tuple, optional): The schemes allowed for the URL and every redirect, e.g. ``("http", "https")``
+                for URLs from untrusted clients. If None, the URL may use every scheme ``urlopen`` supports and
+                redirects may only go to http and https. Defaults to None.
+
+        Returns:
+            bytes: The response body.
+
+        Raises:
+            urllib.error.HTTPError: The server answered with an error status.
+            urllib.error.URLError: The host could not be reached or the request timed out.
+            ValueError: The URL is invalid, its scheme is not allowed or the body is larger than ``max_bytes``.
+        """
+        deadline = time.monotonic() + timeout
+        for redirects in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            allowed = schemes if schemes is not None or not redirects else _REDIRECT_SCHEMES
+            if allowed is not None and parts.scheme not in allowed:
+                raise ValueError(f"the {parts.scheme!r} scheme is not allowed: {url!r}")
+            if parts.scheme not in ("http", "https"):
+                return self._get_other(url, timeout, max_bytes, deadline)
+            if not parts.netloc:
+                raise ValueError(f"unknown url type: {url!r}")
+
+            with self._slot(parts.scheme, parts.netloc):
+                status, location, body = self._request(parts, url, deadline, max_bytes)
+            if status in _REDIRECT_CODES and location:
+                url = urljoin(url, location)
+                continue
+            if status >= 400:
+                raise HTTPError(url, status, http.client.responses.get(status, "Error"), None, None)
+            return body
+        raise URLError(f"too many redirects for {url}")
+
+    def _request(self, parts, url, deadline, max_bytes):
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        headers = {"User-Agent": _USER_AGENT, "Connection": "keep-alive"}
+
+        # an idle connection may have been closed by the server, so a reused connection gets one retry
+        for attempt in range(2):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise URLError(f"timed out requesting {url}")
+            connection, reused = self._checkout(parts.scheme, parts.netloc, remaining)
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                location = response.getheader("Location")
+                if response.status in _REDIRECT_CODES or response.status >= 400:
+                    response.read()
+                    body = None
+                else:
+                    body = _read_capped(response, max_bytes, deadline, url)
+            except URLError:
+                connection.close()
+                raise
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as error:
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise URLError(error) from error
+            except (socket.timeout, OSError, http.client.HTTPException) as error:
+                connection.close()
+                raise URLError(error) from error
+            except BaseException:
+                connection.close()
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(parts.scheme, parts.netloc, connection)
+            return response.status, location, body
+
+    @staticmethod
+    def _get_other(url, timeout, max_bytes, deadline):
+        try:
+            with urlopen(url, timeout=timeout) as response:
+                return _read_capped(response, max_bytes, deadline, url)
+        except ValueError:
+            raise
+        except (socket.timeout, OSError) as error:
+            if isinstance(error, URLError):
+                raise
+            raise URLError(error) from error
+
+    def close(self):
+        """Closes every idle connection.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            for connections in self._idle.values():
+                for connection in connections:
+                    connection.close()
+            self._idle.clear()
+
+
+default_pool = ConnectionPool()
+
+
+def fetch_bytes(url, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, pool=None, schemes=None):
+    """Downloads a URL through a pool of keep-alive connections.
+
+    Args:
+        url (str): The URL to download.
+        timeout (float, optional): The total number of seconds the request may take. Defaults to 10.
+        max_bytes (int, optional): The largest body accepted. If None, there is no limit. Defaults to 50 MiB.
+        pool (ConnectionPool, optional): The pool to use. If None, a pool shared by the whole process. Defaults to None.
+        schemes (tuple, optional): The schemes allowed for the URL and every redirect, see ``ConnectionPool.get``.
+            Defaults to None.
+
+    Returns:
+        bytes: The response body.
+    """
+    pool = default_pool if pool is None else pool
+    return pool.get(url, timeout=timeout, max_bytes=max_bytes, schemes=schemes)
+
+
+async def fetch_bytes_async(url, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, pool=None, executor=None):
+    """Downloads a URL without blocking the event loop, see ``fetch_bytes``.
+
+    Args:
+        url (str): The URL to download.
+        timeout (float, optional): The total number of seconds the request may take. Defaults to 10.
+        max_bytes (int, optional): The largest body accepted. If None, there is no limit. Defaults to 50 MiB.
+        pool (ConnectionPool, optional): The pool to use. If None, a pool shared by the whole process. Defaults to None.
+        executor (concurrent.futures.Executor, optional): The executor running the blocking I/O. If None, the default
+            executor of the event loop. Defaults to None.
+
+    Returns:
+        bytes: The response body.
+    """
+    # asyncio is already loaded whenever a coroutine runs, so synchronous users never pay for importing it
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fetch_bytes, url, timeout, max_bytes, pool))
+
+
+async def fetch_many(urls, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES, pool=None, concurrency=16, executor=None):
+    """Downloads many URLs concurrently.
+
+    At most ``concurrency`` requests run at once and at most ``pool.max_per_host`` per host. Waiting requests do not
+    hold an executor thread.
+
+    Args:
+        urls (iterable): The URLs to download.
+        timeout (float, optional): The total number of seconds each request may take. Defaults to 10.
+        max_bytes (int, optional): The largest body accepted. If None, there is no limit. Defaults to 50 MiB.
+        pool (ConnectionPool, optional): The pool to use. If None, a pool shared by the whole process. Defaults to None.
+        concurrency (int, optional): The maximum number of requests in flight. Defaults to 16.
+        executor (concurrent.futures.Executor, optional): The executor running the blocking I/O. Defaults to None.
+
+    Returns:
+        list: The response bodies in input order. A failed download is returned as its exception.
+    """
+    import asyncio
+
+    pool = default_pool if pool is None else pool
+    overall = asyncio.Semaphore(concurrency)
+    per_host = defaultdict(lambda: asyncio.Semaphore(pool.max_per_host))
+
+    async def fetch(url):
+        async with overall, per_host[urlsplit(url).netloc]:
+            return await fetch_bytes_async(url, timeout, max_bytes, pool, executor)
+
+    return await asyncio.gather(*(fetch(url) for url in urls), return_exceptions=True)
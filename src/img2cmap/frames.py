@@ -0,0 +1,164 @@
+from collections import namedtuple
+
+import numpy as np
+from PIL import ImageSequence
+
+from .convert import ImageConverter
+from .convert import _fit_kmeans
+from .palette import finalize_palette
+from .sources import open_source
+from .stream import ColorAccumulator
+
+FramePalette = namedtuple("FramePalette", ["index", "palette", "keyframe", "change"])
+FramePalette.__doc__ = """The palette of one frame in ``generate_frame_palettes``.
+
+Attributes:
+    index (int): The position of the frame.
+    palette (img2cmap.Palette): The palette of the frame. A frame without pixels, e.g. a blank frame with
+        ``remove_transparent``, reuses the palette of the last keyframe with a change of 0, and is None before the
+        first keyframe.
+    keyframe (int): The index of the frame the palette was clustered on. Frames that share a keyframe form a scene.
+    change (float): How much worse the palette of the last keyframe fits this frame than it fit the keyframe itself,
+        as the relative increase of the mean squared distance from each pixel to its nearest palette color. 0.1
+        means 10% worse. For a keyframe it is measured against the previous keyframe, None for the first frame.
+"""
+
+
+def iter_frames(source):
+    """Iterates over the frames of an animation or a clip.
+
+    Args:
+        source: A multi-frame image (anything ``img2cmap.sources.open_source`` opens, e.g. an animated GIF, PNG or
+            WebP, or a multi-page TIFF), a uint8 array of shape (n_frames, height, width, channels), or an iterable
+            of frames as arrays or ``PIL.Image.Image`` objects, e.g. decoded video frames. A still image has one frame.
+
+    Yields:
+        numpy.ndarray or PIL.Image.Image: Each frame, in a form ``ImageConverter`` accepts.
+    """
+    if isinstance(source, np.ndarray):
+        if source.ndim != 4:
+            raise ValueError(f"Frame arrays must have shape (n_frames, height, width, channels), got {source.shape}")
+        yield from source
+    elif isinstance(source, (list, tuple)) or (hasattr(source, "__next__") and not hasattr(source, "read")):
+        yield from source
+    else:
+        image = open_source(source)
+        try:
+            # the iterator seeks the same image object, so each frame is converted into an image of its own
+            for frame in ImageSequence.Iterator(image):
+                yield frame.convert("RGBA")
+        finally:
+            # multi-frame files stay open until closed, images passed in by the caller are left alone
+            if image is not source:
+                image.close()
+
+
+def _frame_pixels(frame, max_pixels, remove_transparent):
+    """Extracts the pixels of one frame, with the same budget and transparency handling as ``ImageConverter``."""
+    converter = ImageConverter(frame, max_pixels=max_pixels)
+    if remove_transparent:
+        converter.remove_transparent()
+    return converter.pixels
+
+
+def _quantization_error(colors, counts, centers):
+    """The mean squared distance from each pixel of a color histogram to its nearest center."""
+    squared_distances = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+    return float(squared_distances @ counts / counts.sum())
+
+
+def _relative_change(error, keyframe_error):
+    if keyframe_error == 0:
+        return 0.0 if error == 0 else float("inf")
+    return max(0.0, error / keyframe_error - 1)
+
+
+def generate_frame_palettes(
+    source,
+    n_colors=4,
+    random_state=None,
+    max_pixels=None,
+    remove_transparent=False,
+    histogram_bits=5,
+    threshold=0.1,
+):
+    """Generates a palette per frame of an animation or a clip.
+
+    Every frame is collapsed into a weighted color histogram (as with the "histogram" engine of
+    ``ImageConverter.generate_cmap``). When the palette of the last keyframe still fits the histogram of a frame
+    nearly as well as it fit the keyframe, the frame reuses that palette without clustering. Otherwise the frame
+    becomes a keyframe and k-means is warm-started from the centers of the previous keyframe, which converges in a
+    few iterations and keeps colors stable from one scene to the next. Comparing fits rather than raw histogram bins
+    keeps dithering and compression noise from triggering a new keyframe on every frame.
+
+    Useage:
+        >>> for frame in generate_frame_palettes("animation.gif", n_colors=5, random_state=42):
+        ...     print(frame.index, frame.keyframe, frame.palette.hexcodes)
+
+    Args:
+        source: The frames, see ``iter_frames``.
+        n_colors (int, optional): The number of colors in each palette. Defaults to 4.
+        random_state (int, optional): A random seed for the first keyframe. Defaults to None.
+        max_pixels (int, optional): The pixel budget of each frame, see ``ImageConverter``. Defaults to None.
+        remove_transparent (bool, optional): Whether to ignore transparent pixels. Defaults to False.
+        histogram_bits (int, optional): The number of bits per channel of the histograms, between 1 and 7.
+            Defaults to 5.
+        threshold (float, optional): The largest ``FramePalette.change`` for which a frame reuses the palette of its
+            keyframe, e.g. 0.1 reuses it while it fits at most 10% worse. 0 clusters every frame. Defaults to 0.1.
+
+    Yields:
+        FramePalette: One palette per frame, in order.
+    """
+    from sklearn.cluster import KMeans
+
+    keyframe = keyframe_error = centers = palette = None
+    for index, frame in enumerate(iter_frames(source)):
+        pixels = _frame_pixels(frame, max_pixels, remove_transparent)
+        accumulator = ColorAccumulator(histogram_bits)
+        accumulator.update(pixels)
+        colors, counts = accumulator.result()
+        if not len(pixels):
+            # nothing to cluster or to compare, the scene simply goes on
+            yield FramePalette(index, palette, keyframe, None if keyframe is None else 0.0)
+            continue
+        change = None
+        if keyframe is not None:
+            change = _relative_change(_quantization_error(colors, counts, centers), keyframe_error)
+            if change < threshold:
+                yield FramePalette(index, palette, keyframe, change)
+                continue
+
+        if keyframe is not None and len(colors) >= n_colors:
+            kmeans = KMeans(n_clusters=n_colors, init=centers, n_init=1, random_state=random_state)
+            kmeans.fit(colors, sample_weight=counts)
+        elif len(colors) >= n_colors:
+            kmeans = _fit_kmeans(colors, counts, n_colors, random_state)
+        else:
+            # a frame with fewer colors than clusters falls through to the full pixel fit
+            kmeans = _fit_kmeans(pixels, None, n_colors, random_state)
+        centers = kmeans.cluster_centers_
+        palette = finalize_palette(centers)
+        keyframe, keyframe_error = index, _quantization_error(colors, counts, centers)
+        yield FramePalette(index, palette, keyframe, change)
+
+
+def generate_aggregate_palette(source, n_colors=4, random_state=None, max_pixels=None, remove_transparent=False, histogram_bits=5):
+    """Generates a single palette for a whole animation or clip from the combined color histogram of every frame.
+
+    Args:
+        source: The frames, see ``iter_frames``.
+        n_colors (int, optional): The number of colors in the palette. Defaults to 4.
+        random_state (int, optional): A random seed for reproducing palettes. Defaults to None.
+        max_pixels (int, optional): The pixel budget of each frame, see ``ImageConverter``. Defaults to None.
+        remove_transparent (bool, optional): Whether to ignore transparent pixels. Defaults to False.
+        histogram_bits (int, optional): The number of bits per channel of the histogram, between 1 and 7.
+            Defaults to 5.
+
+    Returns:
+        img2cmap.Palette: The palette.
+    """
+    accumulator = ColorAccumulator(histogram_bits)
+    for frame in iter_frames(source):
+        accumulator.update(_frame_pixels(frame, max_pixels, remove_transparent))
+    colors, counts = accumulator.result()
+    return finalize_palette(_fit_kmeans(colors, counts, n_colors, random_state).cluster_centers_)
@@ -0,0 +1,290 @@
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from .colorspace import COLOR_SPACES
+from .colorspace import from_rgb
+from .palette import Palette
+from .palette import from_hex
+
+# Bump whenever the on-disk layout of a PaletteIndex changes
+INDEX_VERSION = 1
+
+# the number of distance matrix entries computed per block, bounds the memory of a query
+_BLOCK_ENTRIES = 1 << 18
+
+
+def _palette_rgb(palette):
+    """Returns the (n_colors, 3) RGB colors on the 0-255 scale of a ``Palette``, a list of hex codes or an array."""
+    if isinstance(palette, Palette):
+        return palette.rgb
+    if len(palette) and isinstance(palette[0], str):
+        return from_hex(palette)
+    colors = np.asarray(palette, dtype=np.float64)
+    if colors.ndim != 2 or colors.shape[1] != 3 or not len(colors):
+        raise ValueError(f"A palette must be a Palette, hex codes or an array of shape (n_colors, 3), got shape {colors.shape}")
+    return colors
+
+
+def _weights(counts, max_colors):
+    """Spreads a weight of 1 over the colors of each palette, the padding slots get 0."""
+    counts = np.asarray(counts)
+    return (np.arange(max_colors) < counts[:, None]) / counts[:, None].astype(np.float32)
+
+
+def _distances(query_colors, query_counts, colors, counts):
+    """The palette distance between every query and every palette.
+
+    Args:
+        query_colors (numpy.ndarray): A (Q, K, 3) float32 array of padded query palettes.
+        query_counts (numpy.ndarray): The number of colors of each query.
+        colors (numpy.ndarray): A (N, K, 3) float32 array of padded palettes.
+        counts (numpy.ndarray): The number of colors of each palette.
+
+    Returns:
+        numpy.ndarray: A (Q, N) float32 array of distances.
+    """
+    n, max_colors = colors.shape[:2]
+    q = len(query_colors)
+    # slot major (K, N) order, so every minimum below reduces whole contiguous rows instead of short inner axes
+    augmented = np.empty((max_colors, n, 4), dtype=np.float32)
+    augmented[:, :, :3] = colors.transpose(1, 0, 2)
+    augmented[:, :, 3] = 1
+    norms = np.einsum("kni,kni->kn", augmented[:, :, :3], augmented[:, :, :3])
+    query_flat = query_colors.reshape(-1, 3)
+    # |p - c|^2 = |p|^2 + |c|^2 - 2 p.c, the last two terms come out of a single matrix product
+    query_augmented = np.concatenate([-2 * query_flat, (query_flat**2).sum(axis=1)[:, None]], axis=1)
+    squared = (query_augmented @ augmented.reshape(-1, 4).T).reshape(q, max_colors, max_colors, n)
+    # padding slots repeat the first color, so they never change a minimum and only the weights skip them
+    backward = squared.min(axis=1)
+    backward += norms
+    squared += norms
+    forward = squared.min(axis=2)
+    distances = np.einsum("qkn,qk->qn", np.sqrt(np.maximum(forward, 0, out=forward)), _weights(query_counts, max_colors))
+    distances += np.einsum("qkn,kn->qn", np.sqrt(np.maximum(backward, 0, out=backward)), _weights(counts, max_colors).T)
+    distances *= 0.5
+    return distances
+
+
+class PaletteIndex:
+    """A searchable catalog of palettes, e.g. to find the images whose palettes look like a given one.
+
+    Palettes are stored as a compact (n_palettes, max_colors, 3) float32 array in a perceptual color space, shorter
+    palettes are padded. The distance between two palettes does not depend on the order of their colors: each color
+    is matched to the nearest color of the other palette, and the distance is the mean of the matched color distances
+    in both directions. Queries compare a batch of palettes to the whole catalog with a few matrix products, so a
+    query over a million palettes takes a fraction of a second.
+
+    With a ``path`` the index lives in that directory and is memory-mapped, so it opens instantly, its pages are
+    shared between processes and it only takes as much memory as the queries touch. Palettes are appended with
+    ``add``, the size recorded in ``index.json`` is only updated once their data is written, so an interrupted
+    ``add`` leaves the index as it was. An index has a single writer.
+
+    Useage:
+        >>> index = PaletteIndex("palettes/")
+        >>> index.add([converter.palette for converter in converters], ids=[converter.name for converter in converters])
+        >>> distances, indices = index.query([["#ba7469", "#dfd67d", "#5d536a"]], k=5)
+        >>> [index.ids[i] for i in indices[0]]
+
+    Args:
+        path (str, optional): A directory holding the index, created if needed. If None, the index only lives in
+            memory. Defaults to None.
+        max_colors (int, optional): The largest number of colors of a palette, the query cost grows with its square.
+            An existing index keeps its own. Defaults to 10.
+        color_space (str, optional): The color space distances are measured in, see ``ImageConverter.generate_cmap``.
+            An existing index keeps its own. Defaults to "oklab".
+
+    Attributes:
+        ids (list): The id of each palette, in the order they were added.
+    """
+
+    def __init__(self, path=None, max_colors=None, color_space=None):
+        self.path = None if path is None else Path(path)
+        meta = dict(version=INDEX_VERSION, max_colors=10, color_space="oklab", size=0)
+        if self.path is not None and (self.path / "index.json").exists():
+            with open(self.path / "index.json") as f:
+                meta = json.load(f)
+            if meta.get("version") != INDEX_VERSION:
+                raise ValueError(f"Unsupported palette index version {meta.get('version')!r}, expected {INDEX_VERSION}")
+            for name, value in (("max_colors", max_colors), ("color_space", color_space)):
+                if value is not None and value != meta[name]:
+                    raise ValueError(f"The index at {path} has {name}={meta[name]!r}, got {value!r}")
+        else:
+            meta.update((name, value) for name, value in (("max_colors", max_colors), ("color_space", color_space)) if value is not None)
+        if meta["color_space"] not in COLOR_SPACES:
+            raise ValueError(f"color_space must be one of {COLOR_SPACES}, got {meta['color_space']!r}")
+        if not 1 <= meta["max_colors"] <= 255:
+            raise ValueError(f"max_colors must be between 1 and 255, got {meta['max_colors']}")
+        self.max_colors = meta["max_colors"]
+        self.color_space = meta["color_space"]
+        self._size = meta["size"]
+        self._colors = np.empty((0, self.max_colors, 3), dtype=np.float32)
+        self._counts = np.empty(0, dtype=np.uint8)
+        self.ids = []
+        self._stale_ids = False
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._load_ids()
+            self._map()
+
+    def _file(self, name):
+        return self.path / name
+
+    def _load_ids(self):
+        try:
+            with open(self._file("ids.jsonl")) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        # an interrupted add may have written ids past the recorded size
+        self._stale_ids = len(lines) != self._size
+        self.ids = [json.loads(line) for line in lines[: self._size]]
+
+    def _map(self):
+        """Memory-maps the recorded palettes of an index on disk."""
+        if self._size:
+            self._colors = np.memmap(self._file("colors.f32"), dtype=np.float32, mode="r", shape=(self._size, self.max_colors, 3))
+            self._counts = np.memmap(self._file("counts.u8"), dtype=np.uint8, mode="r", shape=(self._size,))
+
+    def _append(self, name, data):
+        """Appends to a data file after dropping whatever an interrupted add left past the recorded size."""
+        path = self._file(name)
+        with open(path, "r+b" if path.exists() else "wb") as f:
+            f.truncate(self._size * data[0].nbytes)
+            f.seek(0, os.SEEK_END)
+            f.write(data.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_meta(self, size):
+        meta = dict(version=INDEX_VERSION, max_colors=self.max_colors, color_space=self.color_space, size=size)
+        # write to a temporary file first so readers never see a partial index.json
+        handle, temporary = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "w") as f:
+                json.dump(meta, f)
+            os.replace(temporary, self._file("index.json"))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def encode(self, palettes):
+        """Converts palettes to the padded perceptual form stored by the index.
+
+        Args:
+            palettes (list): ``Palette`` objects, lists of hex codes or (n_colors, 3) arrays of RGB colors on the
+                0-255 scale, with at most ``max_colors`` colors each.
+
+        Returns:
+            numpy.ndarray: A (n_palettes, max_colors, 3) float32 array, shorter palettes repeat their first color.
+            numpy.ndarray: The number of colors of each palette, as uint8.
+        """
+        rgb = [_palette_rgb(palette) for palette in palettes]
+        counts = np.array([len(colors) for colors in rgb], dtype=np.intp)
+        if len(counts) and counts.max() > self.max_colors:
+            raise ValueError(f"The index holds palettes of at most {self.max_colors} colors, got {counts.max()}")
+        colors = np.empty((len(rgb), self.max_colors, 3), dtype=np.float32)
+        if not len(rgb):
+            return colors, counts.astype(np.uint8)
+        # one conversion for every color of every palette
+        converted = from_rgb(np.concatenate([np.asarray(colors, dtype=np.float64) for colors in rgb]), self.color_space)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        slots = np.arange(self.max_colors)
+        # slot j of palette i holds its color j, or its first color once the palette runs out
+        colors[:] = converted[starts[:, None] + np.where(slots < counts[:, None], slots, 0)]
+        return colors, counts.astype(np.uint8)
+
+    def add(self, palettes, ids=None):
+        """Adds palettes to the index.
+
+        Args:
+            palettes (list): The palettes, see ``encode``.
+            ids (list, optional): An id for each palette, e.g. the image path, stored as strings. If None, the
+                position of each palette in the index. Defaults to None.
+
+        Returns:
+            None
+        """
+        colors, counts = self.encode(palettes)
+        if ids is None:
+            ids = range(self._size, self._size + len(colors))
+        ids = [str(id_) for id_ in ids]
+        if len(ids) != len(colors):
+            raise ValueError(f"Got {len(ids)} ids for {len(colors)} palettes")
+        if not len(colors):
+            return
+
+        if self.path is None:
+            if self._size + len(colors) > len(self._colors):
+                # grow geometrically so adding palettes one at a time stays linear
+                capacity = max(self._size + len(colors), 2 * len(self._colors))
+                self._colors = np.resize(self._colors, (capacity, self.max_colors, 3))
+                self._counts = np.resize(self._counts, capacity)
+            added = slice(self._size, self._size + len(colors))
+            self._colors[added] = colors
+            self._counts[added] = counts
+        else:
+            self._append("colors.f32", colors)
+            self._append("counts.u8", counts)
+            if self._stale_ids:
+                with open(self._file("ids.jsonl"), "w") as f:
+                    f.writelines(json.dumps(id_) + "\n" for id_ in self.ids)
+                self._stale_ids = False
+            with open(self._file("ids.jsonl"), "a") as f:
+                f.writelines(json.dumps(id_) + "\n" for id_ in ids)
+            self._write_meta(self._size + len(colors))
+        self.ids.extend(ids)
+        self._size += len(colors)
+        if self.path is not None:
+            self._map()
+
+    def __len__(self):
+        return self._size
+
+    def query(self, palettes, k=10):
+        """Finds the palettes of the index nearest to each query palette.
+
+        Args:
+            palettes (list): The query palettes, see ``encode``.
+            k (int, optional): The number of neighbors of each query. Defaults to 10.
+
+        Returns:
+            numpy.ndarray: A (n_queries, k) float32 array of palette distances, nearest first.
+            numpy.ndarray: A (n_queries, k) array of the positions of the neighbors in the index, see ``ids``.
+        """
+        query_colors, query_counts = self.encode(palettes)
+        k = min(k, self._size)
+        if not k or not len(query_colors):
+            return np.empty((len(query_colors), k), dtype=np.float32), np.empty((len(query_colors), k), dtype=np.intp)
+
+        # blocks of palettes keep the (n_queries, max_colors, max_colors, block) distance matrix small
+        block = max(1, _BLOCK_ENTRIES // (self.max_colors**2 * len(query_colors)))
+        distances = np.empty((len(query_colors), self._size), dtype=np.float32)
+        for start in range(0, self._size, block):
+            stop = min(start + block, self._size)
+            distances[:, start:stop] = _distances(query_colors, query_counts, self._colors[start:stop], self._counts[start:stop])
+
+        nearest = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < self._size else np.argsort(distances, axis=1)
+        nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+        order = np.argsort(nearest_distances, axis=1, kind="stable")
+        return np.take_along_axis(nearest_distances, order, axis=1), np.take_along_axis(nearest, order, axis=1)
+
+
+def palette_distance(a, b, color_space="oklab"):
+    """The distance between two palettes, independent of the order of their colors, see ``PaletteIndex``.
+
+    Args:
+        a: A ``Palette``, a list of hex codes or a (n_colors, 3) array of RGB colors on the 0-255 scale.
+        b: Another palette.
+        color_space (str, optional): The color space distances are measured in. Defaults to "oklab".
+
+    Returns:
+        float: The mean distance between the matched colors.
+    """
+    index = PaletteIndex(max_colors=max(len(_palette_rgb(a)), len(_palette_rgb(b))), color_space=color_space)
+    index.add([b])
+    distances, _ = index.query([a], k=1)
+    return float(distances[0, 0])
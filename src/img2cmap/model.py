@@ -0,0 +1,257 @@
+import json
+
+import numpy as np
+from PIL import Image
+
+from .colorspace import COLOR_SPACES
+from .colorspace import from_rgb
+from .colorspace import pixels_from_rgb
+from .palette import from_hex
+from .palette import to_hex
+from .sources import open_source
+from .stream import STRIP_PIXELS
+
+# Bump whenever the serialized form of a PaletteModel changes
+MODEL_VERSION = 1
+
+# the number of lookup table entries assigned per chunk, bounds the memory of building a full 8-bit table
+_CHUNK = 1 << 16
+
+
+class PaletteModel:
+    """Maps pixels onto a fixed palette, e.g. to quantize many images or video frames to one brand palette.
+
+    Every pixel is assigned to its nearest palette color in ``color_space``. The assignment is precomputed once for
+    every color of an RGB cube quantized to ``bits`` bits per channel, so labeling an image is a single table lookup
+    per pixel and a 4K frame takes milliseconds. With ``bits=8`` the table is exact, lower values only differ for
+    colors that lie almost halfway between two palette colors.
+
+    Useage:
+        >>> converter.generate_cmap(n_colors=5, random_state=42)
+        >>> model = PaletteModel.from_converter(converter)
+        >>> quantized = model.quantize("frame.png")
+
+    Args:
+        colors (numpy.ndarray): A (n_colors, 3) array of RGB colors on the 0-255 scale.
+        color_space (str, optional): The color space nearest colors are measured in, see
+            ``ImageConverter.generate_cmap``. Defaults to "rgb".
+        bits (int, optional): The number of bits per channel of the lookup table, between 1 and 8. 6 keeps the table
+            at 256 KB, 8 makes it exact at 16 MB. Defaults to 6.
+
+    Attributes:
+        colors (numpy.ndarray): A (n_colors, 3) float array of the RGB colors on the 0-255 scale.
+        rgb (numpy.ndarray): A (n_colors, 3) uint8 array of the colors, as written by ``quantize``.
+        hexcodes (list): The hex codes of the colors.
+    """
+
+    def __init__(self, colors, color_space="rgb", bits=6):
+        colors = np.asarray(colors, dtype=np.float64)
+        if colors.ndim != 2 or colors.shape[1] != 3 or not 1 <= len(colors) <= 1 << 16:
+            raise ValueError(f"colors must have shape (n_colors, 3) with at most 65536 colors, got {colors.shape}")
+        if color_space not in COLOR_SPACES:
+            raise ValueError(f"color_space must be one of {COLOR_SPACES}, got {color_space!r}")
+        if not 1 <= bits <= 8:
+            raise ValueError(f"bits must be between 1 and 8, got {bits}")
+        self.colors = colors
+        self.color_space = color_space
+        self.bits = bits
+        self.rgb = np.round(np.clip(colors, 0, 255)).astype(np.uint8)
+        self.hexcodes = to_hex(self.rgb)
+        self._centers = np.asarray(from_rgb(colors, color_space), dtype=np.float32)
+        self._lut = None
+        self._rgb_lut = None
+
+    @classmethod
+    def from_palette(cls, palette, color_space="rgb", bits=6):
+        """Builds a model from an ``img2cmap.Palette``, keeping its order.
+
+        Args:
+            palette (img2cmap.Palette): The palette.
+            color_space (str, optional): The color space nearest colors are measured in. Defaults to "rgb".
+            bits (int, optional): The number of bits per channel of the lookup table. Defaults to 6.
+
+        Returns:
+            PaletteModel: The model.
+        """
+        return cls(np.asarray(palette.colors) * 255, color_space, bits)
+
+    @classmethod
+    def from_converter(cls, converter, color_space="rgb", bits=6):
+        """Builds a model from the last palette generated by an ``ImageConverter``.
+
+        Args:
+            converter (img2cmap.ImageConverter): A converter after ``generate_cmap``, ``generate_palette`` or
+                ``generate_optimal_cmap``.
+            color_space (str, optional): The color space nearest colors are measured in, usually the one the palette
+                was clustered in. Defaults to "rgb".
+            bits (int, optional): The number of bits per channel of the lookup table. Defaults to 6.
+
+        Returns:
+            PaletteModel: The model.
+        """
+        if converter.palette is None:
+            raise ValueError("The converter has no palette yet, run generate_cmap or generate_optimal_cmap first")
+        return cls.from_palette(converter.palette, color_space, bits)
+
+    @classmethod
+    def from_hexcodes(cls, hexcodes, color_space="rgb", bits=6):
+        """Builds a model from hex codes, e.g. a brand palette.
+
+        Args:
+            hexcodes (list): Hex codes such as ``["#ba7469", "#dfd67d"]``, the leading "#" is optional.
+            color_space (str, optional): The color space nearest colors are measured in. Defaults to "rgb".
+            bits (int, optional): The number of bits per channel of the lookup table. Defaults to 6.
+
+        Returns:
+            PaletteModel: The model.
+        """
+        return cls(from_hex(hexcodes), color_space, bits)
+
+    def to_dict(self):
+        """Returns the model as a small JSON serializable dictionary, without the lookup table.
+
+        Returns:
+            dict: The version, colors, color space and bits of the model.
+        """
+        return {"version": MODEL_VERSION, "colors": self.colors.tolist(), "color_space": self.color_space, "bits": self.bits}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuilds a model from ``to_dict``.
+
+        Args:
+            data (dict): The dictionary.
+
+        Returns:
+            PaletteModel: The model.
+        """
+        if data.get("version") != MODEL_VERSION:
+            raise ValueError(f"Unsupported palette model version {data.get('version')!r}, expected {MODEL_VERSION}")
+        return cls(data["colors"], data["color_space"], data["bits"])
+
+    def save(self, path):
+        """Writes the model to a JSON file.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            None
+        """
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a model written by ``save``.
+
+        Args:
+            path (str): The path of the file.
+
+        Returns:
+            PaletteModel: The model.
+        """
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+    def __getstate__(self):
+        # the lookup table is rebuilt on first use, so pickles stay as small as the JSON form
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(state["colors"], state["color_space"], state["bits"])
+
+    def __len__(self):
+        return len(self.colors)
+
+    def _nearest(self, data):
+        """Returns the index of the nearest palette color of each row of ``data``, in the model color space."""
+        # |x - c|^2 = |x|^2 - 2 x.c + |c|^2 and |x|^2 is the same for every center
+        return np.argmin((self._centers**2).sum(axis=1) - 2 * data @ self._centers.T, axis=1)
+
+    @property
+    def lut(self):
+        """numpy.ndarray: The nearest palette color of every quantized RGB color, built on first use."""
+        if self._lut is None:
+            shift = 8 - self.bits
+            levels = np.arange(1 << self.bits, dtype=np.uint8) << shift
+            # the middle of each bin stands for the colors it holds
+            levels += np.uint8((1 << shift) >> 1)
+            dtype = np.uint8 if len(self.colors) <= 256 else np.uint16
+            lut = np.empty(1 << (3 * self.bits), dtype=dtype)
+            grid = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape(-1, 3)
+            for start in range(0, len(grid), _CHUNK):
+                stop = start + _CHUNK
+                chunk = pixels_from_rgb(grid[start:stop], self.color_space).astype(np.float32, copy=False)
+                lut[start:stop] = self._nearest(chunk)
+            self._lut = lut
+        return self._lut
+
+    def _lookup(self, pixels, table):
+        """Looks up ``table`` at the quantized color of every (N, C) pixel, strip by strip so the keys stay in cache."""
+        shift = 8 - self.bits
+        out = np.empty((len(pixels),) + table.shape[1:], dtype=table.dtype)
+        keys = np.empty(min(len(pixels), STRIP_PIXELS), dtype=np.uint32)
+        channel = np.empty_like(keys)
+        for start in range(0, len(pixels), STRIP_PIXELS):
+            stop = min(start + STRIP_PIXELS, len(pixels))
+            strip = pixels[start:stop]
+            key, value = keys[: len(strip)], channel[: len(strip)]
+            np.right_shift(strip[:, 0], shift, out=key, casting="unsafe")
+            key <<= 2 * self.bits
+            np.right_shift(strip[:, 1], shift, out=value, casting="unsafe")
+            value <<= self.bits
+            key |= value
+            np.right_shift(strip[:, 2], shift, out=value, casting="unsafe")
+            key |= value
+            np.take(table, key, axis=0, out=out[start:stop])
+        return out
+
+    @staticmethod
+    def _check_pixels(pixels):
+        pixels = np.asarray(pixels)
+        if pixels.dtype != np.uint8 or pixels.ndim < 2 or pixels.shape[-1] not in (3, 4):
+            raise ValueError(f"pixels must be a uint8 array of RGB(A) values, got {pixels.dtype} of shape {pixels.shape}")
+        return pixels
+
+    def labels(self, pixels):
+        """Assigns pixels to their nearest palette color.
+
+        Args:
+            pixels (numpy.ndarray): A uint8 array of RGB(A) values, e.g. (N, 3) pixels or a (height, width, 3) image.
+                An alpha channel is ignored.
+
+        Returns:
+            numpy.ndarray: The index of the nearest color of each pixel in ``colors``, with the shape of ``pixels``
+            without the channel axis.
+        """
+        pixels = self._check_pixels(pixels)
+        return self._lookup(pixels.reshape(-1, pixels.shape[-1]), self.lut).reshape(pixels.shape[:-1])
+
+    def quantize(self, image):
+        """Replaces every pixel of an image by its nearest palette color.
+
+        Args:
+            image: Anything ``ImageConverter`` accepts, e.g. a path, a URL, a PIL image or a uint8 array.
+
+        Returns:
+            numpy.ndarray: A (height, width, 3) uint8 array, or (height, width, 4) with the alpha channel kept when
+            the image has one.
+        """
+        source = open_source(image)
+        if isinstance(source, Image.Image):
+            array = np.asarray(source if source.mode in ("RGB", "RGBA") else source.convert("RGBA"))
+            if source is not image:
+                source.close()
+        else:
+            array = source
+        if array.ndim == 2:
+            array = np.repeat(array[:, :, None], 3, axis=2)
+        array = self._check_pixels(array)
+        if self._rgb_lut is None:
+            # the palette color of every quantized color, so each pixel is a single lookup
+            self._rgb_lut = self.rgb[self.lut]
+        quantized = self._lookup(array.reshape(-1, array.shape[2]), self._rgb_lut).reshape(array.shape[:2] + (3,))
+        if array.shape[2] == 4:
+            quantized = np.concatenate([quantized, array[:, :, 3:]], axis=2)
+        return quantized
@@ -0,0 +1,141 @@
+from collections import namedtuple
+
+import numpy as np
+
+# "00" to "ff" as ASCII codes, indexed by channel value
+_HEX_DIGITS = np.array([list(f"{value:02x}".encode()) for value in range(256)], dtype=np.uint8)
+
+
+def rgb_to_hsv(rgb):
+    """Converts an array of RGB colors to HSV, matching ``colorsys.rgb_to_hsv`` color by color.
+
+    Args:
+        rgb (numpy.ndarray): A (N, 3) array of RGB colors in the 0-1 range.
+
+    Returns:
+        numpy.ndarray: A (N, 3) array of hue, saturation and value in the 0-1 range.
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    maxc = rgb.max(axis=1)
+    rangec = maxc - rgb.min(axis=1)
+    gray = rangec == 0
+
+    # gray colors divide by zero here, their hue and saturation are set to zero below
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rc, gc, bc = ((maxc[:, None] - rgb) / rangec[:, None]).T
+        r, g = rgb[:, 0], rgb[:, 1]
+        hue = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        hue = (hue / 6.0) % 1.0
+        saturation = rangec / maxc
+    hue[gray] = 0.0
+    saturation[gray] = 0.0
+    return np.stack([hue, saturation, maxc], axis=1)
+
+
+def to_hex(rgb):
+    """Encodes an array of 8-bit RGB colors as hex codes in one pass.
+
+    Args:
+        rgb (numpy.ndarray): A (N, 3) uint8 array of RGB colors.
+
+    Returns:
+        list: The hex codes, e.g. ``["#ff0000", "#00ff00"]``.
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    codes = np.empty((len(rgb), 7), dtype=np.uint8)
+    codes[:, 0] = ord("#")
+    codes[:, 1:] = _HEX_DIGITS[rgb].reshape(len(rgb), 6)
+    return codes.view("S7").ravel().astype(str).tolist()
+
+
+def from_hex(hexcodes):
+    """Decodes hex codes into an array of 8-bit RGB colors, the inverse of ``to_hex``.
+
+    Args:
+        hexcodes (list): Hex codes such as ``["#ba7469", "#dfd67d"]``, the leading "#" is optional.
+
+    Returns:
+        numpy.ndarray: A (N, 3) uint8 array of RGB colors.
+    """
+    colors = []
+    for code in hexcodes:
+        digits = code[1:] if code.startswith("#") else code
+        try:
+            value = int(digits, 16)
+        except ValueError:
+            value = None
+        if len(digits) != 6 or value is None:
+            raise ValueError(f"Invalid hex code {code!r}")
+        colors.append([value >> 16, (value >> 8) & 0xFF, value & 0xFF])
+    return np.array(colors, dtype=np.uint8).reshape(-1, 3)
+
+
+class Palette(namedtuple("Palette", ["rgb", "colors", "hexcodes"])):
+    """A finalized, hue sorted palette.
+
+    Attributes:
+        rgb (numpy.ndarray): A (n_colors, 3) uint8 array of the colors.
+        colors (numpy.ndarray): A (n_colors, 3) float array of the colors in the 0-1 range, as used by matplotlib.
+        hexcodes (list): The hex codes of the colors.
+    """
+
+    __slots__ = ()
+
+    def to_cmap(self, name=None):
+        """Builds a matplotlib ListedColormap from the palette.
+
+        Args:
+            name (str, optional): The name of the colormap. Defaults to None.
+
+        Returns:
+            matplotlib.colors.ListedColormap: A matplotlib ListedColormap object.
+        """
+        import matplotlib as mpl
+
+        return mpl.colors.ListedColormap(self.colors, name=name)
+
+
+def finalize_palettes(cluster_centers):
+    """Turns several sets of cluster centers on the 0-255 scale into hue sorted palettes in a single vectorized pass.
+
+    Args:
+        cluster_centers (list): A list of (n_colors, 3) arrays of cluster centers, one per palette.
+
+    Returns:
+        list: A ``Palette`` per set of cluster centers.
+    """
+    sizes = [len(centers) for centers in cluster_centers]
+    # float32 rounding can push the centers slightly outside of 0-255, so clip them into the 0-1 range
+    colors = np.concatenate([np.asarray(centers, dtype=np.float64)[:, :3] for centers in cluster_centers]) / 255
+    np.clip(colors, 0, 1, out=colors)
+
+    # Sort colors by hue, then saturation and value, within each palette
+    hsv = rgb_to_hsv(colors)
+    groups = np.repeat(np.arange(len(sizes)), sizes)
+    colors = colors[np.lexsort((hsv[:, 2], hsv[:, 1], hsv[:, 0], groups))]
+
+    # Handle cases where all rgb values evaluate to 1 or 0, the bounds match numpy.isclose. This is a temporary fix
+    colors[np.abs(colors - 1) <= 1e-8 + 1e-5] = 1 - 1e-6
+    colors[colors <= 1e-8] = 1e-6
+
+    rgb = np.round(colors * 255).astype(np.uint8)
+    hexcodes = to_hex(rgb)
+    palettes = []
+    start = 0
+    for size in sizes:
+        stop = start + size
+        palettes.append(Palette(rgb[start:stop], colors[start:stop], hexcodes[start:stop]))
+        start = stop
+    return palettes
+
+
+def finalize_palette(cluster_centers):
+    """Turns cluster centers on the 0-255 scale into a hue sorted ``Palette``, see ``finalize_palettes``.
+
+    Args:
+        cluster_centers (numpy.ndarray): A (n_colors, 3) array of cluster centers.
+
+    Returns:
+        Palette: The palette.
+    """
+    return finalize_palettes([cluster_centers])[0]
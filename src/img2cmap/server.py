@@ -0,0 +1,471 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from io import BytesIO
+from urllib.error import URLError
+from urllib.parse import parse_qsl
+from urllib.parse import urlsplit
+
+from PIL import Image
+
+from .cache import PaletteCache
+from .colorspace import COLOR_SPACES
+from .convert import SWEEPS
+from .convert import ImageConverter
+from .engines import engine_names
+from .fetch import DEFAULT_MAX_BYTES
+from .fetch import fetch_bytes
+
+DEFAULT_MAX_PIXELS = 250_000
+# the largest image a request can send, checked on the header before anything is decoded
+DEFAULT_MAX_IMAGE_PIXELS = 50_000_000
+# the largest number of colors a request can ask for, a sweep fits every number up to it
+MAX_COLORS = 20
+# URLs from clients are only fetched over HTTP, other schemes would read files or hang on devices of the server
+URL_SCHEMES = ("http", "https")
+
+# name -> (type, default) of the options a request can set
+OPTIONS = {
+    "n_colors": (int, 4),
+    "optimal": (bool, False),
+    "max_colors": (int, 10),
+    "sweep": (str, "independent"),
+    "min_improvement": (float, None),
+    "knee_patience": (int, None),
+    "engine": (str, "kmeans"),
+    "histogram_bits": (int, 5),
+    "color_space": (str, "rgb"),
+    "remove_transparent": (bool, False),
+    "random_state": (int, 42),
+    "max_pixels": (int, None),
+}
+# the cache of each worker process, set by _init_worker
+_worker_cache = None
+
+
+class Overloaded(Exception):
+    """Raised when the queue of a ``PaletteService`` is full."""
+
+
+def parse_options(params, max_pixels=DEFAULT_MAX_PIXELS):
+    """Validates request options, filling in the defaults.
+
+    Args:
+        params (dict): The options of the request, strings from a query string or values from a JSON body.
+        max_pixels (int, optional): The largest pixel budget a request can ask for. Defaults to 250,000.
+
+    ``n_colors`` and ``max_colors`` are capped at ``MAX_COLORS``, so a single request cannot hold a worker for long.
+
+    Returns:
+        dict: Every option of ``OPTIONS``.
+
+    Raises:
+        ValueError: An option is unknown or invalid.
+    """
+    unknown = set(params) - set(OPTIONS)
+    if unknown:
+        raise ValueError(f"Unknown options {sorted(unknown)}")
+    # engines can be registered at any time, so the names are looked up on every request
+    choices = {"sweep": SWEEPS, "engine": engine_names(), "color_space": COLOR_SPACES}
+    options = dict()
+    for name, (kind, default) in OPTIONS.items():
+        value = params.get(name, default)
+        if value is not None and not isinstance(value, kind):
+            if kind is bool and isinstance(value, str) and value.lower() in ("true", "1", "false", "0"):
+                value = value.lower() in ("true", "1")
+            elif kind is not bool and isinstance(value, (str, int)):
+                try:
+                    value = kind(value)
+                except ValueError:
+                    raise ValueError(f"{name} must be of type {kind.__name__}, got {value!r}") from None
+            else:
+                raise ValueError(f"{name} must be of type {kind.__name__}, got {value!r}")
+        if name in choices and value not in choices[name]:
+            raise ValueError(f"{name} must be one of {choices[name]}, got {value!r}")
+        if name in ("n_colors", "max_colors") and not 1 <= value <= MAX_COLORS:
+            raise ValueError(f"{name} must be between 1 and {MAX_COLORS}, got {value}")
+        options[name] = value
+    options["max_pixels"] = max_pixels if options["max_pixels"] is None else min(options["max_pixels"], max_pixels)
+    return options
+
+
+def _init_worker(cache_dir):
+    global _worker_cache
+    if cache_dir is not None:
+        _worker_cache = PaletteCache(directory=cache_dir)
+
+
+def compute_palette(data, options):
+    """Generates the palette of encoded image bytes, in a worker process.
+
+    Args:
+        data (bytes): The encoded image.
+        options (dict): The options returned by ``parse_options``.
+
+    Returns:
+        dict: The hex codes and number of colors, and with ``optimal`` the best number of colors and the SSD curve.
+    """
+    start = time.perf_counter()
+    converter = ImageConverter(data, max_pixels=options["max_pixels"], cache=_worker_cache)
+    if options["remove_transparent"]:
+        converter.remove_transparent()
+    kwargs = {name: options[name] for name in ("random_state", "engine", "histogram_bits", "color_space")}
+    result = dict()
+    if options["optimal"]:
+        _, best_n_colors, ssd = converter.generate_optimal_cmap(
+            max_colors=options["max_colors"],
+            sweep=options["sweep"],
+            min_improvement=options["min_improvement"],
+            knee_patience=options["knee_patience"],
+            **kwargs,
+        )
+        result.update(best_n_colors=None if best_n_colors is None else int(best_n_colors), ssd={str(k): float(v) for k, v in ssd.items()})
+    else:
+        converter.generate_palette(options["n_colors"], **kwargs)
+    result.update(
+        hexcodes=converter.hexcodes,
+        n_colors=None if converter.hexcodes is None else len(converter.hexcodes),
+        seconds=time.perf_counter() - start,
+    )
+    return result
+
+
+class PaletteService:
+    """Runs palette requests in a process pool, coalescing identical concurrent requests.
+
+    Requests are keyed by a hash of the image bytes and the options. A request whose key is already being computed
+    waits for that computation instead of starting another one. At most ``max_queue`` distinct computations are queued
+    or running at once, beyond that ``submit`` raises ``Overloaded`` so callers can shed load instead of piling up.
+
+    If a worker process dies, the pool is broken: the computations in flight fail with ``BrokenProcessPool``, and the
+    pool is replaced by a fresh one so later requests are served again.
+
+    Args:
+        workers (int, optional): The number of worker processes. If None, the number of CPUs. Defaults to None.
+        max_queue (int, optional): The maximum number of distinct computations in flight. If None, four per worker.
+            Defaults to None.
+        cache_dir (str, optional): A ``PaletteCache`` directory shared by the workers. Defaults to None.
+    """
+
+    def __init__(self, workers=None, max_queue=None, cache_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or 4 * self.workers
+        self._cache_dir = cache_dir
+        self._pool = self._new_pool()
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+        self._counts = dict(requests=0, computations=0, coalesced=0, rejected=0, completed=0, failed=0, restarts=0)
+        self._peak_queue_depth = 0
+
+    def _new_pool(self):
+        # forking a process that runs server threads can deadlock, so the workers are spawned
+        return ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker, initargs=(self._cache_dir,)
+        )
+
+    def _replace_broken_pool(self, pool):
+        # called with the lock held, the waiters of a broken pool all see it break but only the first one replaces it
+        if self._pool is pool:
+            self._pool = self._new_pool()
+            self._counts["restarts"] += 1
+            # the broken pool has no live workers left to wait for
+            pool.shutdown(wait=False)
+
+    def submit(self, data, options):
+        """Starts computing a palette, or joins the identical computation in flight.
+
+        Args:
+            data (bytes): The encoded image.
+            options (dict): The options returned by ``parse_options``.
+
+        Returns:
+            concurrent.futures.Future: The future of the ``compute_palette`` result.
+            bool: Whether the request joined a computation in flight.
+
+        Raises:
+            Overloaded: ``max_queue`` computations are already in flight.
+            BrokenProcessPool: A worker process died, the pool has been replaced and the request can be retried.
+        """
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        key = PaletteCache.key(digest, **options)
+        with self._lock:
+            self._counts["requests"] += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self._counts["coalesced"] += 1
+                return future, True
+            if len(self._in_flight) >= self.max_queue:
+                self._counts["rejected"] += 1
+                raise Overloaded(f"{len(self._in_flight)} computations in flight")
+            pool = self._pool
+            try:
+                future = pool.submit(compute_palette, data, options)
+            except BrokenProcessPool:
+                self._counts["failed"] += 1
+                self._replace_broken_pool(pool)
+                raise
+            self._in_flight[key] = future
+            self._counts["computations"] += 1
+            self._peak_queue_depth = max(self._peak_queue_depth, len(self._in_flight))
+        future.add_done_callback(lambda done: self._finish(key, pool, done))
+        return future, False
+
+    def _finish(self, key, pool, future):
+        with self._lock:
+            del self._in_flight[key]
+            error = None if future.cancelled() else future.exception()
+            self._counts["failed" if future.cancelled() or error is not None else "completed"] += 1
+            if isinstance(error, BrokenProcessPool):
+                self._replace_broken_pool(pool)
+
+    def metrics(self):
+        """Returns the request counters and the queue depth.
+
+        Returns:
+            dict: The number of requests, computations, coalesced and rejected requests, completed and failed
+            computations, pool restarts after a worker died, the current and peak queue depth, and the pool size.
+        """
+        with self._lock:
+            return dict(
+                self._counts,
+                queue_depth=len(self._in_flight),
+                peak_queue_depth=self._peak_queue_depth,
+                max_queue=self.max_queue,
+                workers=self.workers,
+            )
+
+    def close(self):
+        """Shuts the worker processes down.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            pool = self._pool
+        pool.shutdown()
+
+
+class PaletteRequestHandler(BaseHTTPRequestHandler):
+    """Serves ``POST /palette``, ``GET /metrics`` and ``GET /health`` for the ``PaletteService`` of the server.
+
+    ``POST /palette`` takes either the encoded image as the body with the options in the query string, or a JSON body
+    with a "url" and the options. Every response is JSON.
+
+    Only http and https URLs are fetched, redirects included. The server still fetches whatever host a client names
+    and follows redirects, so a client can reach hosts on the server's internal network (server-side request
+    forgery). Deployments that serve untrusted clients should block such destinations at the network level, or only
+    accept image bodies.
+    """
+
+    server_version = "img2cmap"
+
+    def _send(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/metrics":
+            self._send(200, self.server.service.metrics())
+        elif path == "/health":
+            self._send(200, {"status": "ok"})
+        else:
+            self._send(404, {"error": f"Unknown path {path}"})
+
+    def _read_request(self):
+        """Returns the image bytes and the raw options of a palette request."""
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise _HTTPError(411, "A Content-Length is required")
+        if not length.strip().isdigit():
+            raise _HTTPError(400, f"Invalid Content-Length {length!r}")
+        length = int(length)
+        if length > self.server.max_bytes:
+            raise _HTTPError(413, f"The body is larger than {self.server.max_bytes} bytes")
+        body = self.rfile.read(length)
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            return body, params
+
+        try:
+            payload = json.loads(body)
+            url = payload.pop("url")
+        except (ValueError, AttributeError, KeyError):
+            raise _HTTPError(400, 'A JSON body must be an object with a "url"') from None
+        if not isinstance(url, str) or urlsplit(url).scheme not in URL_SCHEMES or not urlsplit(url).netloc:
+            raise _HTTPError(400, f"Invalid url {url!r}, only http and https URLs are fetched")
+        params.update(payload)
+        try:
+            return fetch_bytes(url, max_bytes=self.server.max_bytes, schemes=URL_SCHEMES), params
+        except (URLError, ValueError) as error:
+            raise _HTTPError(502, f"Could not download {url}: {error}") from None
+
+    def _check_image_size(self, data):
+        """Rejects an image that declares more than ``max_image_pixels`` pixels, reading only its header.
+
+        A few KB of PNG can declare hundreds of megapixels, which a worker would decode in full before resizing.
+        """
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+                with Image.open(BytesIO(data)) as image:
+                    width, height = image.size
+        except Image.DecompressionBombError as error:
+            raise _HTTPError(413, f"The image is too large: {error}") from None
+        except (OSError, ValueError) as error:
+            raise _HTTPError(422, f"Could not process the image: {error}") from None
+        if width * height > self.server.max_image_pixels:
+            raise _HTTPError(413, f"The image has {width * height} pixels, more than {self.server.max_image_pixels}")
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/palette":
+            self._send(404, {"error": f"Unknown path {urlsplit(self.path).path}"})
+            return
+        try:
+            data, params = self._read_request()
+            try:
+                options = parse_options(params, self.server.max_pixels)
+            except ValueError as error:
+                raise _HTTPError(400, str(error)) from None
+            self._check_image_size(data)
+            try:
+                future, coalesced = self.server.service.submit(data, options)
+            except Overloaded as error:
+                raise _HTTPError(503, f"Overloaded, {error}", [("Retry-After", "1")]) from None
+            except BrokenProcessPool:
+                raise _HTTPError(503, "A worker process died, retry the request", [("Retry-After", "1")]) from None
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # every request waiting on the computation, coalesced ones included, gets this answer
+                self.log_error("A worker process died")
+                raise _HTTPError(503, "A worker process died, retry the request", [("Retry-After", "1")]) from None
+            except Image.DecompressionBombError as error:
+                raise _HTTPError(413, f"The image is too large: {error}") from None
+            except (OSError, ValueError) as error:
+                raise _HTTPError(422, f"Could not process the image: {error}") from None
+            except Exception as error:
+                # e.g. a crashed worker process, the client still gets an answer and the server keeps serving
+                self.log_error("Palette request failed: %r", error)
+                raise _HTTPError(500, f"Internal error: {type(error).__name__}") from None
+        except _HTTPError as error:
+            self._send(error.status, {"error": error.message}, error.headers)
+            return
+        self._send(200, dict(result, coalesced=coalesced))
+
+
+class _HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+
+class PaletteServer(ThreadingHTTPServer):
+    """A threaded HTTP server with a listen backlog deep enough for bursts of concurrent clients."""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(
+    host="127.0.0.1",
+    port=8000,
+    service=None,
+    max_pixels=DEFAULT_MAX_PIXELS,
+    max_bytes=DEFAULT_MAX_BYTES,
+    quiet=False,
+    max_image_pixels=DEFAULT_MAX_IMAGE_PIXELS,
+):
+    """Builds a threaded HTTP server around a ``PaletteService``.
+
+    Useage:
+        >>> server = make_server(port=8000)
+        >>> server.serve_forever()
+
+    Args:
+        host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+        port (int, optional): The port to listen on, 0 picks a free port. Defaults to 8000.
+        service (PaletteService, optional): The service computing palettes. If None, one with a worker per CPU.
+            Defaults to None.
+        max_pixels (int, optional): The largest pixel budget a request can ask for, and the default one. Defaults to
+            250,000.
+        max_bytes (int, optional): The largest image accepted, uploaded or downloaded. Defaults to 50 MB.
+        quiet (bool, optional): Whether to silence the request log. Defaults to False.
+        max_image_pixels (int, optional): The largest image accepted, in pixels. Larger images get a 413 before they
+            are decoded. Defaults to 50,000,000.
+
+    Returns:
+        PaletteServer: The server, ``server.service`` is the service.
+    """
+    server = PaletteServer((host, port), PaletteRequestHandler)
+    server.service = service or PaletteService()
+    server.max_pixels = max_pixels
+    server.max_bytes = max_bytes
+    server.quiet = quiet
+    server.max_image_pixels = max_image_pixels
+    return server
+
+
+def main(argv=None):
+    """Runs the ``img2cmap-serve`` command.
+
+    Args:
+        argv (list, optional): The command line arguments. If None, ``sys.argv[1:]``. Defaults to None.
+
+    Returns:
+        int: The exit status.
+    """
+    parser = argparse.ArgumentParser(prog="img2cmap-serve", description="Serve palettes over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1", help="the address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="the port to listen on (default: 8000)")
+    parser.add_argument("-j", "--workers", type=int, help="the number of worker processes (default: CPU count)")
+    parser.add_argument("--max-queue", type=int, help="the computations in flight before rejecting requests (default: 4 per worker)")
+    parser.add_argument("--max-pixels", type=int, default=DEFAULT_MAX_PIXELS, help="the largest pixel budget (default: 250000)")
+    parser.add_argument(
+        "--max-image-pixels",
+        type=int,
+        default=DEFAULT_MAX_IMAGE_PIXELS,
+        help="the largest image accepted, in pixels (default: 50000000)",
+    )
+    parser.add_argument("--cache-dir", help="a directory caching palettes between requests and restarts")
+    parser.add_argument("--quiet", action="store_true", help="do not log requests")
+    args = parser.parse_args(argv)
+
+    cache_dir = None if args.cache_dir is None else os.path.expanduser(args.cache_dir)
+    service = PaletteService(args.workers, args.max_queue, cache_dir)
+    server = make_server(args.host, args.port, service, args.max_pixels, quiet=args.quiet, max_image_pixels=args.max_image_pixels)
+    print(f"Serving palettes on http://{args.host}:{server.server_address[1]} with {service.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,99 @@
+import os
+from io import BytesIO
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.error import URLError
+from urllib.parse import urlsplit
+
+import numpy as np
+from PIL import Image
+
+from .fetch import fetch_bytes
+
+URL_SCHEMES = ("http", "https", "ftp", "file", "data")
+DEFAULT_NAME = "image"
+
+
+def is_url(source):
+    """Whether a string is a URL rather than a local path.
+
+    Args:
+        source (str): The string to check.
+
+    Returns:
+        bool: True for strings with a known URL scheme.
+    """
+    # single letter schemes are Windows drive letters
+    scheme = urlsplit(source).scheme.lower()
+    return len(scheme) > 1 and scheme in URL_SCHEMES
+
+
+def source_name(source):
+    """Derives a short name for an image source, used as the default palette name.
+
+    Args:
+        source: Anything ``open_source`` accepts.
+
+    Returns:
+        str: The file name without its extension, or "image" when the source has no name.
+    """
+    if isinstance(source, str) and is_url(source):
+        return Path(urlsplit(source).path).stem or DEFAULT_NAME
+    if isinstance(source, (str, os.PathLike)):
+        return Path(source).stem
+    name = getattr(source, "filename", None) or getattr(source, "name", None)
+    if isinstance(name, (str, os.PathLike)) and str(name):
+        return Path(name).stem
+    return DEFAULT_NAME
+
+
+def _validate_array(array):
+    if array.dtype != np.uint8:
+        raise ValueError(f"Image arrays must be uint8, got {array.dtype}")
+    if array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (3, 4)):
+        return array
+    raise ValueError(f"Image arrays must have shape (height, width), (height, width, 3) or (height, width, 4), got {array.shape}")
+
+
+def open_source(source):
+    """Opens an image from any of the supported sources, dispatching on the type of the input.
+
+    Supported sources are:
+
+    * a local path (``str`` or ``os.PathLike``)
+    * a URL (``str`` with an http, https, ftp, file or data scheme), downloaded with ``img2cmap.fetch.fetch_bytes``
+    * encoded image bytes (``bytes``, ``bytearray`` or ``memoryview``)
+    * a binary file-like object
+    * a ``PIL.Image.Image``, returned as is
+    * a uint8 ``numpy.ndarray`` of shape (height, width), (height, width, 3) or (height, width, 4), returned as is
+
+    Args:
+        source: The image source.
+
+    Returns:
+        PIL.Image.Image or numpy.ndarray: The (lazily decoded) image, or the array that was passed in.
+
+    Raises:
+        FileNotFoundError: A local path does not exist.
+        urllib.error.URLError: A URL could not be downloaded.
+        ValueError: A URL or an array is invalid.
+        TypeError: The source type is not supported.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        return _validate_array(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(source))
+    if isinstance(source, str) and is_url(source):
+        try:
+            return Image.open(BytesIO(fetch_bytes(source)))
+        except (URLError, HTTPError) as error:
+            raise URLError(f"Could not open {source} {error}") from error
+        except ValueError as error:
+            raise ValueError(f"Could not open {source} {error}") from error
+    if isinstance(source, (str, os.PathLike)):
+        return Image.open(source)
+    if hasattr(source, "read"):
+        return Image.open(source)
+    raise TypeError(f"Unsupported image source of type {type(source).__name__}")
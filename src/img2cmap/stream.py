@@ -0,0 +1,195 @@
+import numpy as np
+
+# the strips are sized in pixels so memory does not grow with the width of the image
+STRIP_PIXELS = 1 << 18
+
+# raw modes that can be read straight from the file, mapped to the RGB(A) channels they hold
+_RAW_CHANNELS = {
+    "RGB": (3, [0, 1, 2]),
+    "BGR": (3, [2, 1, 0]),
+    "RGBX": (4, [0, 1, 2]),
+    "BGRX": (4, [2, 1, 0]),
+    "RGBA": (4, [0, 1, 2, 3]),
+    "BGRA": (4, [2, 1, 0, 3]),
+    "L": (1, [0]),
+}
+
+
+def _raw_rows(image):
+    """Memory-maps the pixel rows of an uncompressed image file.
+
+    Args:
+        image (PIL.Image.Image): A lazily opened image.
+
+    Returns:
+        numpy.ndarray: A read-only (height, width, bands) memory map of the stored pixels, None when the image is not
+        stored as a single block of raw pixels in a file.
+        list: The indices of the RGB(A) channels in the stored bands.
+    """
+    tile = getattr(image, "tile", None)
+    if not getattr(image, "filename", None) or not tile or len(tile) != 1:
+        return None, None
+    codec, extents, offset, args = tile[0]
+    if isinstance(args, str):
+        args = (args, 0, 1)
+    width, height = image.size
+    if codec != "raw" or args[0] not in _RAW_CHANNELS or tuple(extents) != (0, 0, width, height):
+        return None, None
+
+    bands, channels = _RAW_CHANNELS[args[0]]
+    stride = args[1] or width * bands
+    rows = np.memmap(image.filename, dtype=np.uint8, mode="r", offset=offset, shape=(height, stride))
+    return rows[:, : width * bands].reshape(height, width, bands), channels
+
+
+def iter_strips(image, rows=None):
+    """Reads an image strip by strip, without holding more than one strip of converted pixels in memory.
+
+    Uncompressed files (raw TIFF, BMP, PPM) are memory-mapped, so only the strip being read is paged in. Other formats
+    are decoded in full once, but never converted or copied as a whole. Row order follows the file, which is
+    bottom-up for BMPs.
+
+    Args:
+        image (PIL.Image.Image or numpy.ndarray): A lazily opened image, or a uint8 array.
+        rows (int, optional): The number of rows per strip. If None, as many rows as fit in about 250,000 pixels.
+            Defaults to None.
+
+    Yields:
+        numpy.ndarray: A (rows * width, 3) or (rows * width, 4) uint8 array of RGB(A) values.
+    """
+    if isinstance(image, np.ndarray):
+        array, channels = image, None
+    else:
+        array, channels = _raw_rows(image)
+    width = array.shape[1] if array is not None else image.size[0]
+    if rows is None:
+        rows = max(1, STRIP_PIXELS // max(1, width))
+
+    if array is None:
+        yield from _decoded_strips(image, rows)
+        return
+    for start in range(0, array.shape[0], rows):
+        stop = start + rows
+        strip = array[start:stop]
+        if channels is not None:
+            strip = strip[:, :, channels]
+        yield _flat_pixels(strip)
+
+
+def _decoded_strips(image, rows):
+    """Crops and converts a decoded image strip by strip, the image is never converted or copied as a whole."""
+    width, height = image.size
+    image.load()
+    for top in range(0, height, rows):
+        strip = image.crop((0, top, width, min(top + rows, height)))
+        if strip.mode not in ("RGB", "RGBA", "L"):
+            strip = strip.convert("RGBA")
+        yield _flat_pixels(np.asarray(strip))
+
+
+def _flat_pixels(strip):
+    """Flattens a (rows, width[, bands]) strip into a contiguous (rows * width, 3) or (rows * width, 4) array."""
+    if strip.ndim == 2:
+        strip = strip[:, :, None]
+    if strip.shape[2] == 1:
+        strip = np.repeat(strip, 3, axis=2)
+    return np.ascontiguousarray(strip).reshape(-1, strip.shape[2])
+
+
+def image_size(image):
+    """Returns the (width, height) of a PIL image or a numpy array."""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+
+class ColorAccumulator:
+    """A running color histogram, the streaming counterpart of ``img2cmap.color_histogram``.
+
+    Each channel is quantized to ``bits`` bits. The accumulator keeps the pixel count and the channel sums of every bin,
+    so its memory only depends on ``bits``, not on the number of pixels added.
+
+    Args:
+        bits (int, optional): The number of bits kept per channel, between 1 and 7. Defaults to 5.
+    """
+
+    def __init__(self, bits=5):
+        if not 1 <= bits <= 7:
+            raise ValueError(f"bits must be between 1 and 7, got {bits}")
+        self.bits = bits
+        self.n_bins = 1 << (3 * bits)
+        self.counts = np.zeros(self.n_bins, dtype=np.int64)
+        self.sums = np.zeros((3, self.n_bins))
+
+    def update(self, pixels):
+        """Adds pixels to the histogram.
+
+        Args:
+            pixels (numpy.ndarray): A (N, 3) uint8 array of RGB values, extra channels are ignored.
+
+        Returns:
+            None
+        """
+        pixels = np.asarray(pixels, dtype=np.uint8)
+        shift = 8 - self.bits
+        channels = [pixels[:, i].astype(np.uint32) >> shift for i in range(3)]
+        keys = (channels[0] << (2 * self.bits)) | (channels[1] << self.bits) | channels[2]
+        self.counts += np.bincount(keys, minlength=self.n_bins)
+        for i in range(3):
+            self.sums[i] += np.bincount(keys, weights=pixels[:, i], minlength=self.n_bins)
+
+    def result(self):
+        """Returns the weighted table of representative colors, see ``img2cmap.color_histogram``.
+
+        Returns:
+            numpy.ndarray: A (M, 3) float32 array of representative colors.
+            numpy.ndarray: A (M,) float64 array with the number of pixels behind each color.
+        """
+        occupied = np.flatnonzero(self.counts)
+        counts = self.counts[occupied].astype(np.float64)
+        return (self.sums[:, occupied].T / counts[:, None]).astype(np.float32), counts
+
+
+def stream_image(image, sample_size, bits=5, rows=None, seed=0):
+    """Reads an image strip by strip into a uniform pixel sample and color histograms of every pixel.
+
+    The sampled positions are drawn up front, so memory is bounded by ``sample_size``, ``bits`` and one strip,
+    however large the image is.
+
+    Args:
+        image (PIL.Image.Image or numpy.ndarray): A lazily opened image, or a uint8 array.
+        sample_size (int): The number of pixels to keep. Every pixel is kept when the image is smaller.
+        bits (int, optional): The number of bits per channel of the histograms. Defaults to 5.
+        rows (int, optional): The number of rows per strip, see ``iter_strips``. Defaults to None.
+        seed (int, optional): The random seed of the sampled positions. Defaults to 0.
+
+    Returns:
+        numpy.ndarray: A (sample_size, 3) or (sample_size, 4) uint8 array of sampled RGB(A) values.
+        tuple: The ``ColorAccumulator.result`` of every pixel.
+        tuple: The ``ColorAccumulator.result`` of the pixels that are not fully transparent.
+    """
+    width, height = image_size(image)
+    n_pixels = width * height
+    positions = None
+    if n_pixels > sample_size:
+        positions = np.sort(np.random.default_rng(seed).choice(n_pixels, size=sample_size, replace=False))
+
+    everything = ColorAccumulator(bits)
+    opaque = None
+    parts = []
+    start = 0
+    for strip in iter_strips(image, rows):
+        everything.update(strip)
+        if strip.shape[1] == 4:
+            opaque = ColorAccumulator(bits) if opaque is None else opaque
+            opaque.update(strip[strip[:, 3] != 0])
+        stop = start + len(strip)
+        if positions is None:
+            parts.append(strip)
+        else:
+            first, last = np.searchsorted(positions, [start, stop])
+            parts.append(strip[positions[first:last] - start])
+        start = stop
+
+    histogram = everything.result()
+    return np.concatenate(parts), histogram, histogram if opaque is None else opaque.result()
@@ -1,16 +1,22 @@
+import os
 import warnings
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from io import BytesIO
 from pprint import pformat
 
 import matplotlib as mpl
 import matplotlib.patches as patches
-import matplotlib.pyplot as plt
 import numpy as np
 from annotated_text import annotated_text
+from matplotlib.figure import Figure
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from threadpoolctl import threadpool_limits
 
 import streamlit as st
 from img2cmap import ImageConverter
+from img2cmap.cache import pixel_digest
 
 
 def colorpicker(color):
@@ -33,6 +39,142 @@ def colorpicker(color):
         return "#ffffff"
 
 
+@st.cache_resource
+def get_executor():
+    """One pool of workers shared by every session, so concurrent users queue for the cores instead of each holding one."""
+    # the workers share the cores, so each fit stays on one native thread
+    threadpool_limits(limits=1)
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="img2cmap")
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_image(user_image, remove_transparent):
+    """Opens and resizes an image once, cached by the image bytes or URL.
+
+    Returns:
+        numpy.ndarray: The resized image as a uint8 array.
+        numpy.ndarray: The (N, 3) uint8 pixels that are clustered.
+        str: The digest of the pixels, which identifies the image in the palette caches.
+    """
+    converter = ImageConverter(user_image)
+    if remove_transparent:
+        converter.remove_transparent()
+    converter.resize()
+    pixels = np.ascontiguousarray(converter.pixels)
+    return np.asarray(converter.image), pixels, pixel_digest(pixels)
+
+
+@st.cache_data(max_entries=1024, show_spinner=False)
+def fit_palette(digest, _pixels, n_colors, random_state):
+    """Clusters the pixels, cached by the image digest and the parameters (``_pixels`` is not hashed).
+
+    Returns:
+        img2cmap.Palette: The palette.
+        float: The sum of squared distances from each pixel to its color.
+    """
+    converter = ImageConverter(_pixels.reshape(1, -1, 3))
+    palette = converter.generate_palette(n_colors=n_colors, random_state=random_state)
+    return palette, float(converter.kmeans.inertia_)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_image(digest, _image, hexcodes):
+    """Renders the image next to its colorbar as PNG bytes, cached by the image digest and the hex codes."""
+    cmap = mpl.colors.ListedColormap(hexcodes, name="")
+    fig = Figure(figsize=(8, 8))
+    ax1 = fig.subplots()
+    ax1.axis("off")
+    im = ax1.imshow(_image, cmap=cmap)
+
+    divider = make_axes_locatable(ax1)
+    cax = divider.append_axes("right", size="10%", pad=0.05)
+
+    cb = fig.colorbar(im, cax=cax, orientation="vertical", label=cmap.name)
+    cb.set_ticks([])
+    buffer = BytesIO()
+    fig.savefig(buffer, format="png", bbox_inches="tight")
+    return buffer.getvalue()
+
+
+def plot_sweep(palettes, max_colors, best_n_colors=None):
+    """Draws one row of colors per number of colors evaluated so far.
+
+    Returns:
+        matplotlib.figure.Figure: The figure.
+    """
+    figopt = Figure(figsize=(7, 5))
+    ax = figopt.subplots()
+
+    ymax = max_colors + 1
+    xmax = max_colors
+    ax.set_ylim(2, ymax)
+    ax.set_xlim(0, max_colors)
+
+    # i will be y axis
+    for y, palette in palettes.items():
+        # Fix small
+        colors = sorted(palette.hexcodes)
+        intervals, width = np.linspace(0, xmax, len(colors) + 1, retstep=True)
+        # j will be x axis
+        for j, color in enumerate(colors):
+            rect = patches.Rectangle((intervals[j], y), width, 1, facecolor=color)
+            ax.add_patch(rect)
+
+    ax.set_yticks(np.arange(2, ymax) + 0.5)
+    ax.set_yticklabels(np.arange(2, ymax))
+    ax.set_ylabel("Number of colors")
+    ax.set_xticks([])
+
+    if best_n_colors is not None:
+        rect = patches.Rectangle((0, best_n_colors), ymax, 1, linewidth=1, facecolor="none", edgecolor="black", linestyle="--")
+        ax.add_patch(rect)
+        # minus 2, one for starting at 2 and one for 0-indexing
+        ax.get_yticklabels()[best_n_colors - 2].set_color("red")
+    return figopt
+
+
+def start_sweep(digest, pixels, max_colors, random_state):
+    """Submits one fit per number of colors to the shared workers, the results land in the ``fit_palette`` cache.
+
+    Returns:
+        dict: The futures, keyed by the number of colors.
+    """
+    executor = get_executor()
+    return {n_colors: executor.submit(fit_palette, digest, pixels, n_colors, random_state) for n_colors in range(2, max_colors + 1)}
+
+
+def show_sweep(futures, max_colors):
+    """Streams the palettes of a sweep into the chart as they finish, then marks the optimal number of colors.
+
+    A widget interaction reruns the script and interrupts the wait, the fits keep running in the workers.
+    """
+    placeholder = st.empty()
+    pending = set(futures.values())
+    while pending:
+        palettes = {n_colors: future.result()[0] for n_colors, future in futures.items() if future.done()}
+        with placeholder.container():
+            st.pyplot(plot_sweep(palettes, max_colors))
+            st.caption(f"Optimizing... {len(palettes)} of {len(futures)} colormaps done")
+        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    results = {n_colors: future.result() for n_colors, future in futures.items()}
+    palettes = {n_colors: palette for n_colors, (palette, _) in results.items()}
+    ssd = {n_colors: inertia for n_colors, (_, inertia) in results.items()}
+    # kneed pulls in scipy, so it is only loaded once a sweep finishes
+    from kneed import KneeLocator
+
+    best_n_colors = KneeLocator(list(ssd.keys()), list(ssd.values()), curve="convex", direction="decreasing").knee
+    placeholder.pyplot(plot_sweep(palettes, max_colors, best_n_colors))
+    if best_n_colors is None:
+        st.warning("No optimal number of colors was found, try a larger max number of colors")
+    else:
+        st.metric("Optimal number of colors", best_n_colors)
+        st.text("Hex Codes of optimal colormap (click to copy on far right)")
+        st.code(sorted(palettes[best_n_colors].hexcodes))
+    st.text("Hex Codes of all colormaps {k: [hex codes]}")
+    st.code(pformat({k: sorted(v.hexcodes) for k, v in palettes.items()}))
+
+
 # @profile
 def main():
     warnings.filterwarnings("ignore")
@@ -58,7 +200,7 @@ def main():
     if file_or_url == "file":
         user_image = st.sidebar.file_uploader("Upload an image file")
         if user_image is not None:
-            user_image = BytesIO(user_image.getvalue())
+            user_image = user_image.getvalue()
     elif file_or_url == "url":
         user_image = st.sidebar.text_input("Paste an image URL", "https://static1.bigstockphoto.com/3/2/3/large1500/323952496.jpg")
     else:
@@ -80,34 +222,14 @@ def main():
     random_state = st.sidebar.number_input("Random state", value=42, help="Random state for reproducibility")
     random_state = int(random_state)
 
-    @st.cache_data
-    def get_image_converter(user_image, remove_transparent):
-        converter = ImageConverter(user_image)
-        if remove_transparent:
-            converter.remove_transparent()
-        return converter
-
-    converter = get_image_converter(user_image, remove_transparent)
-    converter.resize()
-
+    image, pixels, digest = load_image(user_image, remove_transparent)
     with st.spinner("Generating colormap..."):
-        cmap = converter.generate_cmap(n_colors=n_colors, palette_name="", random_state=random_state)
+        palette, _ = get_executor().submit(fit_palette, digest, pixels, n_colors, random_state).result()
 
     # plot the image and colorbar
-    fig1, ax1 = plt.subplots(figsize=(8, 8))
+    st.image(render_image(digest, image, palette.hexcodes))
 
-    ax1.axis("off")
-    img = converter.image
-    im = ax1.imshow(img, cmap=cmap)
-
-    divider = make_axes_locatable(ax1)
-    cax = divider.append_axes("right", size="10%", pad=0.05)
-
-    cb = fig1.colorbar(im, cax=cax, orientation="vertical", label=cmap.name)
-    cb.set_ticks([])
-    st.pyplot(fig1)
-
-    colors1 = [mpl.colors.rgb2hex(c) for c in cmap.colors]
+    colors1 = palette.hexcodes
 
     # determine whether to show the text in white or black
     bw_mask = [colorpicker(c) for c in colors1]
@@ -119,45 +241,14 @@ def main():
     st.header("Detect optimal number of colors")
     col1, _, _, _, _ = st.columns(5)
     max_colors = col1.number_input("Max number of colors in cmap (more colors = longer runtime)", min_value=2, max_value=20, value=10)
-    optimize = st.button("Optimize")
-    if optimize:
-        with st.spinner("Optimizing... (this can take up to a minute)"):
-            cmaps, best_n_colors, ssd = converter.generate_optimal_cmap(max_colors=max_colors, palette_name="", random_state=random_state)
-
-        figopt, ax = plt.subplots(figsize=(7, 5))
-
-        ymax = max_colors + 1
-        xmax = max_colors
-        ax.set_ylim(2, ymax)
-        ax.set_xlim(0, max_colors)
-
-        # i will be y axis
-        for y, cmap_ in cmaps.items():
-            # Fix small
-            colors = sorted([mpl.colors.rgb2hex(c) for c in cmap_.colors])
-            intervals, width = np.linspace(0, xmax, len(colors) + 1, retstep=True)
-            # j will be x axis
-            for j, color in enumerate(colors):
-                rect = patches.Rectangle((intervals[j], y), width, 1, facecolor=color)
-                ax.add_patch(rect)
-
-        ax.set_yticks(np.arange(2, ymax) + 0.5)
-        ax.set_yticklabels(np.arange(2, ymax))
-        ax.set_ylabel("Number of colors")
-        ax.set_xticks([])
-
-        # best
-        rect = patches.Rectangle((0, best_n_colors), ymax, 1, linewidth=1, facecolor="none", edgecolor="black", linestyle="--")
-        ax.add_patch(rect)
-
-        # minus 2, one for starting at 2 and one for 0-indexing
-        ax.get_yticklabels()[best_n_colors - 2].set_color("red")
-        st.pyplot(figopt)
-        st.metric("Optimal number of colors", best_n_colors)
-        st.text("Hex Codes of optimal colormap (click to copy on far right)")
-        st.code(sorted([mpl.colors.rgb2hex(c) for c in cmaps[best_n_colors].colors]))
-        st.text("Hex Codes of all colormaps {k: [hex codes]}")
-        st.code(pformat({k: sorted([mpl.colors.rgb2hex(c) for c in v.colors]) for k, v in cmaps.items()}))
+    max_colors = int(max_colors)
+    # the sweep lives in the session, so it keeps streaming across reruns with the same image and settings
+    sweep_key = (digest, max_colors, random_state)
+    if st.button("Optimize") and st.session_state.get("sweep_key") != sweep_key:
+        st.session_state["sweep_key"] = sweep_key
+        st.session_state["sweep"] = start_sweep(digest, pixels, max_colors, random_state)
+    if st.session_state.get("sweep_key") == sweep_key:
+        show_sweep(st.session_state["sweep"], max_colors)
 
 
 if __name__ == "__main__":
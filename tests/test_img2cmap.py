@@ -1,10 +1,57 @@
+import asyncio
+import colorsys
+import csv
+import http.client
+import json
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import warnings
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from io import BytesIO
 from pathlib import Path
+from urllib.error import HTTPError
+from urllib.error import URLError
 
+import matplotlib as mpl
 import numpy as np
 import pytest
 import requests
+from PIL import Image
+from threadpoolctl import threadpool_info
 
 from img2cmap import ImageConverter
+from img2cmap import PaletteCache
+from img2cmap import PaletteIndex
+from img2cmap import PaletteModel
+from img2cmap import StageTiming
+from img2cmap import color_histogram
+from img2cmap import finalize_palettes
+from img2cmap import generate_aggregate_palette
+from img2cmap import generate_cmaps
+from img2cmap import generate_frame_palettes
+from img2cmap.cli import build_parser
+from img2cmap.cli import main
+from img2cmap.colorspace import from_rgb
+from img2cmap.colorspace import pixels_from_rgb
+from img2cmap.colorspace import to_rgb
+from img2cmap.engines import palette_inertia
+from img2cmap.engines import register_engine
+from img2cmap.fetch import ConnectionPool
+from img2cmap.fetch import fetch_bytes
+from img2cmap.index import palette_distance
+from img2cmap.server import Overloaded
+from img2cmap.server import PaletteService
+from img2cmap.server import make_server
+from img2cmap.server import parse_options
+from img2cmap.stream import iter_strips
 
 THIS_DIR = Path(__file__).parent
 
@@ -103,11 +150,986 @@ def test_generate_optimal():
     assert best_n_colors == 5
 
 
+@pytest.mark.parametrize("test_image_input", test_image_files)
+def test_pixels_uint8_view(test_image_input):
+    imageconverter = ImageConverter(test_image_input)
+    width, height = imageconverter.image.size
+    assert imageconverter.pixels.dtype == np.uint8
+    assert imageconverter.pixels.shape == (width * height, 3)
+    assert imageconverter.transparent_pixels.shape == (width * height,)
+
+
+def _pixel_ssd(pixels, colors):
+    """Sum of squared distances from every pixel to its nearest palette color."""
+    pixels = pixels.astype(np.float64)
+    centers = np.asarray(colors, dtype=np.float64) * 255
+    return ((pixels[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).min(axis=1).sum()
+
+
+@pytest.mark.parametrize("test_image_input", test_image_files)
+@pytest.mark.parametrize("histogram_bits", [5, 8])
+def test_histogram_engine_parity(test_image_input, histogram_bits):
+    imageconverter = ImageConverter(test_image_input)
+    kmeans_cmap = imageconverter.generate_cmap(4, "miami", 42)
+    histogram_cmap = imageconverter.generate_cmap(4, "miami", 42, engine="histogram", histogram_bits=histogram_bits)
+    assert histogram_cmap.N == 4
+    assert len(imageconverter.hexcodes) == 4
+    pixels = imageconverter.pixels
+    assert _pixel_ssd(pixels, histogram_cmap.colors) <= 1.05 * _pixel_ssd(pixels, kmeans_cmap.colors)
+
+
+def test_color_histogram_counts():
+    pixels = np.array([[0, 0, 0], [0, 0, 0], [255, 128, 1], [3, 2, 1]], dtype=np.uint8)
+    colors, counts = color_histogram(pixels, bits=8)
+    assert counts.sum() == len(pixels)
+    assert colors.tolist() == [[0, 0, 0], [3, 2, 1], [255, 128, 1]]
+    assert counts.tolist() == [2, 1, 1]
+    colors, counts = color_histogram(pixels, bits=5)
+    assert counts.tolist() == [3, 1]
+    np.testing.assert_allclose(colors[0], [1, 2 / 3, 1 / 3], rtol=1e-6)
+
+
+def test_unknown_engine():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"))
+    with pytest.raises(ValueError):
+        imageconverter.generate_cmap(4, engine="nope")
+
+
+@pytest.mark.parametrize("engine", ["kmeans", "histogram"])
+def test_incremental_sweep(engine):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"))
+    cmaps, best_n_colors, ssd = imageconverter.generate_optimal_cmap(max_colors=8, random_state=42, engine=engine, sweep="incremental")
+    assert list(cmaps) == list(ssd) == list(range(2, 9))
+    assert all(cmap.N == n_colors for n_colors, cmap in cmaps.items())
+    assert best_n_colors in cmaps
+    assert imageconverter.hexcodes == [mpl.colors.rgb2hex(c) for c in cmaps[best_n_colors].colors]
+
+    _, _, independent_ssd = imageconverter.generate_optimal_cmap(max_colors=8, random_state=42, engine="histogram")
+    for n_colors, value in ssd.items():
+        assert value <= 1.1 * independent_ssd[n_colors]
+
+
+@pytest.mark.parametrize("sweep", ["independent", "incremental"])
+def test_sweep_two_color_image(sweep):
+    array = np.zeros((40, 40, 3), dtype=np.uint8)
+    array[:, 20:] = [200, 30, 60]
+    imageconverter = ImageConverter(array)
+    with warnings.catch_warnings():
+        # k-means finds fewer distinct clusters than requested
+        warnings.simplefilter("ignore")
+        _, _, ssd = imageconverter.generate_optimal_cmap(max_colors=4, random_state=42, engine="histogram", sweep=sweep)
+    assert list(ssd) == [2, 3, 4]
+    assert ssd[2] == pytest.approx(0, abs=1e-6)
+
+
+def test_incremental_sweep_deterministic():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"))
+    _, _, ssd_1 = imageconverter.generate_optimal_cmap(max_colors=6, random_state=42, sweep="incremental", sample_size=5000)
+    _, _, ssd_2 = imageconverter.generate_optimal_cmap(max_colors=6, random_state=42, sweep="incremental", sample_size=5000)
+    assert ssd_1 == ssd_2
+
+
+def test_parallel_sweep_shares_inputs(monkeypatch):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/south_beach_sunset.jpg"), max_pixels=200_000)
+    saved = []
+    save = np.save
+    monkeypatch.setattr(np, "save", lambda path, array: saved.append(path) or save(path, array))
+    _, _, ssd = imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, color_space="oklab", n_jobs=2)
+    assert list(ssd) == [2, 3, 4, 5]
+    # the pixels are converted and written to a memory map once for the whole sweep
+    assert [timing.stage for timing in imageconverter.timings].count("color_space") == 1
+    assert len(saved) == 1
+
+
+@pytest.mark.parametrize("engine", ["kmeans", "histogram"])
+def test_parallel_sweep_deterministic(engine):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"))
+    cmaps_1, best_1, ssd_1 = imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, engine=engine)
+    cmaps_2, best_2, ssd_2 = imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, engine=engine, n_jobs=2)
+    assert best_1 == best_2
+    assert ssd_1 == pytest.approx(ssd_2)
+    for n_colors, cmap in cmaps_1.items():
+        np.testing.assert_allclose(cmap.colors, cmaps_2[n_colors].colors)
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_generate_cmaps(ordered):
+    inputs = test_image_files + [THIS_DIR.joinpath("images/does_not_exist.png")] + test_image_files
+    results = list(generate_cmaps(inputs, n_colors=3, random_state=42, workers=2, ordered=ordered, max_pixels=20_000, queue_size=2))
+    assert sorted(result.index for result in results) == list(range(len(inputs)))
+    if ordered:
+        assert [result.index for result in results] == list(range(len(inputs)))
+    for result in results:
+        assert result.source == inputs[result.index]
+        if result.source.exists():
+            assert result.error is None
+            assert result.cmap.N == 3
+            assert len(result.hexcodes) == 3
+        else:
+            assert result.cmap is None
+            assert result.error is not None
+
+
+def test_generate_cmaps_leaves_caller_threads():
+    def thread_counts():
+        return [library["num_threads"] for library in threadpool_info()]
+
+    before = thread_counts()
+    results = generate_cmaps(test_image_files, n_colors=3, random_state=42, workers=1, max_pixels=20_000, queue_size=1)
+    next(results)
+    # the worker is idle until the next result is requested, so the caller's native code keeps its threads
+    assert thread_counts() == before
+    results.close()
+    assert thread_counts() == before
+
+
+def test_generate_cmaps_matches_converter():
+    image = THIS_DIR.joinpath("images/movie_chart.png")
+    (result,) = generate_cmaps([image], n_colors=4, random_state=42, engine="histogram")
+    imageconverter = ImageConverter(image)
+    imageconverter.generate_cmap(4, random_state=42, engine="histogram")
+    assert result.hexcodes == imageconverter.hexcodes
+
+
+def test_palette_cache_hits():
+    cache = PaletteCache(maxsize=8)
+    image = THIS_DIR.joinpath("images/movie_chart.png")
+    first = ImageConverter(image, cache=cache).generate_cmap(4, "miami", 42, engine="histogram")
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    imageconverter = ImageConverter(image, cache=cache)
+    second = imageconverter.generate_cmap(4, "miami", 42, engine="histogram")
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert imageconverter.kmeans is None
+    np.testing.assert_array_equal(first.colors, second.colors)
+
+    # a different number of colors, engine or seed is a different entry, no seed is never cached
+    imageconverter.generate_cmap(5, "miami", 42, engine="histogram")
+    imageconverter.generate_cmap(4, "miami", 42)
+    imageconverter.generate_cmap(4, "miami", None, engine="histogram")
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert len(cache) == 3
+
+
+def test_palette_cache_numpy_params():
+    cache = PaletteCache()
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000, cache=cache)
+    palette = imageconverter.generate_palette(np.int64(3), random_state=np.int64(42))
+    assert imageconverter.generate_palette(3, random_state=42).hexcodes == palette.hexcodes
+    assert cache.hits == 1
+    imageconverter.generate_optimal_cmap(max_colors=np.int64(4), random_state=np.int32(42), sweep="incremental")
+
+
+def test_palette_cache_sweep_reuses_fits():
+    cache = PaletteCache()
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), cache=cache)
+    imageconverter.generate_cmap(3, random_state=42, engine="histogram")
+    _, best_n_colors, ssd = imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, engine="histogram")
+    assert cache.hits == 1
+    _, cached_best_n_colors, cached_ssd = imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, engine="histogram", n_jobs=2)
+    assert cache.hits == 5
+    assert (cached_best_n_colors, cached_ssd) == (best_n_colors, pytest.approx(ssd))
+
+
+def test_palette_cache_lru_and_disk(tmp_path):
+    cache = PaletteCache(maxsize=1, directory=tmp_path)
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000, cache=cache)
+    cmaps, _, _ = imageconverter.generate_optimal_cmap(max_colors=4, random_state=42, sweep="incremental")
+    imageconverter.generate_cmap(2, random_state=42)
+    assert len(cache) == 1
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+
+    # a new cache on the same directory, as after a restart or in another process
+    restarted = PaletteCache(directory=tmp_path)
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000, cache=restarted)
+    cached_cmaps, _, _ = imageconverter.generate_optimal_cmap(max_colors=4, random_state=42, sweep="incremental")
+    assert (restarted.hits, restarted.misses) == (1, 0)
+    for n_colors, cmap in cmaps.items():
+        np.testing.assert_array_equal(cmap.colors, cached_cmaps[n_colors].colors)
+    restarted.clear()
+    assert not list(tmp_path.glob("*.npz"))
+
+
+def test_palette_cache_expands_home(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    cache = PaletteCache(directory="~/.cache/img2cmap")
+    assert cache.directory == tmp_path.joinpath(".cache/img2cmap")
+    assert cache.directory.is_dir()
+    assert not tmp_path.joinpath("~").exists()
+
+
+def test_pickle_converter(tmp_path):
+    cache = PaletteCache(directory=tmp_path / "cache")
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), cache=cache)
+    imageconverter.remove_transparent()
+    imageconverter.generate_cmap(4, random_state=42)
+    image = np.asarray(imageconverter.image)
+
+    # the RGB data and a bit per pixel for the binary alpha channel, not the image, pixels, mask and model
+    data = pickle.dumps(imageconverter)
+    assert len(data) < image.shape[0] * image.shape[1] * (3 + 1 / 8) + 10_000
+    unpickled = pickle.loads(data)
+    assert unpickled.kmeans is None
+    assert unpickled.hexcodes == imageconverter.hexcodes
+    np.testing.assert_array_equal(np.asarray(unpickled.image), image)
+    np.testing.assert_array_equal(unpickled.pixels, imageconverter.pixels)
+    np.testing.assert_array_equal(unpickled.transparent_pixels, imageconverter.transparent_pixels)
+    assert unpickled.generate_palette(4, random_state=42).hexcodes == imageconverter.hexcodes
+    assert unpickled.cache.hits == 1
+
+    # semi-transparent pixels keep their alpha
+    rgba = image.copy()
+    rgba[:10, :, 3] = 128
+    np.testing.assert_array_equal(np.asarray(pickle.loads(pickle.dumps(ImageConverter(rgba))).image), rgba)
+
+    path = imageconverter.to_memmap(tmp_path / "image.npy")
+    data = pickle.dumps(imageconverter)
+    assert len(data) < 10_000
+    unpickled = pickle.loads(data)
+    np.testing.assert_array_equal(unpickled.pixels, imageconverter.pixels)
+    assert unpickled.generate_palette(4, random_state=42).hexcodes == imageconverter.hexcodes
+    assert Path(path).exists()
+
+
+class LocalImageHandler(SimpleHTTPRequestHandler):
+    """Serves the tests directory over keep-alive HTTP/1.1, with a slow and a redirecting route."""
+
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(1)
+        if self.path.startswith(("/redirect/", "/redirect-file/")):
+            self.send_response(302)
+            if self.path.startswith("/redirect-file/"):
+                self.send_header("Location", "file://" + str(THIS_DIR) + self.path.replace("/redirect-file", "", 1))
+            else:
+                self.send_header("Location", self.path.replace("/redirect", "", 1))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients of the timeout test hang up on purpose
+        pass
+
+
+@pytest.fixture
+def local_server():
+    LocalImageHandler.connections = 0
+    server = QuietHTTPServer(("127.0.0.1", 0), partial(LocalImageHandler, directory=str(THIS_DIR)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def pool():
+    pool = ConnectionPool(max_per_host=2)
+    yield pool
+    pool.close()
+
+
+def test_url_local_server(local_server):
+    imageconverter = ImageConverter(f"{local_server}/images/movie_chart.png")
+    cmap = imageconverter.generate_cmap(2, None, 42)
+    assert cmap.name == "movie_chart"
+
+
+def test_from_url(local_server, pool):
+    url = f"{local_server}/redirect/images/movie_chart.png"
+    imageconverter = asyncio.run(ImageConverter.from_url(url, pool=pool, max_pixels=10_000))
+    assert imageconverter.image_path == url
+    assert imageconverter.pixels.shape[0] <= 10_000
+    assert imageconverter.generate_cmap(3, None, 42).name == "movie_chart"
+
+
+def test_from_urls_reuses_connections(local_server, pool):
+    urls = [f"{local_server}/images/{image.name}" for image in test_image_files] * 3 + [f"{local_server}/images/nope.png"]
+    results = asyncio.run(ImageConverter.from_urls(urls, pool=pool, max_pixels=10_000))
+    assert [isinstance(result, ImageConverter) for result in results] == [True] * (len(urls) - 1) + [False]
+    assert isinstance(results[-1], HTTPError)
+    assert pool.connections_opened <= pool.max_per_host
+    assert LocalImageHandler.connections == pool.connections_opened
+
+
+def test_fetch_max_bytes(local_server, pool):
+    with pytest.raises(ValueError):
+        fetch_bytes(f"{local_server}/images/movie_chart.png", max_bytes=1000, pool=pool)
+
+
+def test_fetch_schemes(local_server, pool):
+    url = f"{local_server}/redirect-file/images/movie_chart.png"
+    # a server cannot redirect to a local file unless the caller allows it
+    with pytest.raises(ValueError):
+        fetch_bytes(url, pool=pool)
+    with pytest.raises(ValueError):
+        fetch_bytes(url, pool=pool, schemes=("http", "https"))
+    assert fetch_bytes(url, pool=pool, schemes=("http", "file")) == THIS_DIR.joinpath("images/movie_chart.png").read_bytes()
+    with pytest.raises(ValueError):
+        ImageConverter(url)
+    with pytest.raises(ValueError):
+        fetch_bytes(THIS_DIR.joinpath("images/movie_chart.png").as_uri(), pool=pool, schemes=("http", "https"))
+
+
+def test_fetch_host_slots(pool):
+    barrier = threading.Barrier(8)
+
+    def slot(_):
+        barrier.wait()
+        return pool._slot("http", "example.com")
+
+    with ThreadPoolExecutor(8) as executor:
+        slots = list(executor.map(slot, range(8)))
+    assert all(other is slots[0] for other in slots)
+
+
+def test_fetch_timeout(local_server, pool):
+    with pytest.raises(URLError):
+        fetch_bytes(f"{local_server}/slow", timeout=0.2, pool=pool)
+
+
+def test_sources_bytes_and_file_objects():
+    image = THIS_DIR.joinpath("images/black_square.jpg")
+    expected = ImageConverter(image).generate_cmap(3, "miami", 42).colors
+    with open(image, "rb") as f:
+        from_file = ImageConverter(f)
+        assert from_file.name == "black_square"
+        np.testing.assert_array_equal(from_file.generate_cmap(3, "miami", 42).colors, expected)
+    from_bytes = ImageConverter(image.read_bytes())
+    assert from_bytes.generate_cmap(3, None, 42).name == "image"
+    np.testing.assert_array_equal(from_bytes.generate_cmap(3, "miami", 42).colors, expected)
+
+
+def test_sources_array_zero_copy():
+    array = np.asarray(Image.open(THIS_DIR.joinpath("images/movie_chart.png")).convert("RGB")).copy()
+    imageconverter = ImageConverter(array)
+    assert np.shares_memory(imageconverter.pixels, array)
+    assert not imageconverter.transparent_pixels.any()
+    assert imageconverter.generate_cmap(3, "miami", 42).N == 3
+
+    rgba = np.dstack([array, np.zeros(array.shape[:2], dtype=np.uint8)])
+    imageconverter = ImageConverter(rgba)
+    assert np.shares_memory(imageconverter.pixels, rgba)
+    imageconverter.remove_transparent()
+    assert len(imageconverter.pixels) == 0
+
+    imageconverter = ImageConverter(array)
+    imageconverter.resize(size=(64, 64))
+    assert len(imageconverter.pixels) <= 64 * 64
+    assert array.shape == (694, 601, 3)
+    assert len(ImageConverter(array, max_pixels=10_000).pixels) <= 10_000
+
+
+def test_sources_pil_image_not_modified():
+    image = Image.open(THIS_DIR.joinpath("images/movie_chart.png")).convert("RGBA")
+    imageconverter = ImageConverter(image)
+    assert imageconverter.image is image
+    imageconverter.resize(size=(64, 64))
+    assert image.size == (601, 694)
+    assert len(imageconverter.pixels) <= 64 * 64
+
+    # JPEGs are not drafted to a reduced scale when the caller owns the image
+    image = Image.open(THIS_DIR.joinpath("images/south_beach_sunset.jpg"))
+    imageconverter = ImageConverter(image, max_pixels=10_000)
+    assert image.size == (1318, 929)
+    assert np.asarray(image).shape == (929, 1318, 3)
+    assert len(imageconverter.pixels) <= 10_000
+
+
+@pytest.mark.parametrize("bad_input", [3, np.zeros((4, 4, 3), dtype=np.float32), np.zeros((4, 4, 5), dtype=np.uint8)])
+def test_sources_invalid(bad_input):
+    with pytest.raises((TypeError, ValueError)):
+        ImageConverter(bad_input)
+
+
+def test_sources_missing_file():
+    with pytest.raises(FileNotFoundError):
+        ImageConverter(THIS_DIR.joinpath("images/does_not_exist.png"))
+
+
+def test_finalize_palette_matches_colorsys():
+    rng = np.random.default_rng(0)
+    centers = [rng.integers(0, 256, size=(n_colors, 3)).astype(float) for n_colors in range(2, 12)]
+    # grays, exact ties in hue and values that round to 0 or 1
+    centers.append(np.array([[0, 0, 0], [255, 255, 255], [128, 128, 128], [255, 0, 0], [128, 0, 0], [255.0001, 0, -0.0001]]))
+    for cluster_centers, palette in zip(centers, finalize_palettes(centers)):
+        colors = np.clip(cluster_centers / 255, 0, 1)
+        colors = np.array(sorted(colors, key=lambda rgb: colorsys.rgb_to_hsv(*rgb)))
+        colors = np.where(np.isclose(colors, 1), 1 - 1e-6, colors)
+        colors = np.where(np.isclose(colors, 0), 1e-6, colors)
+        np.testing.assert_array_equal(palette.colors, colors)
+        assert palette.hexcodes == [mpl.colors.rgb2hex(c) for c in colors]
+        assert palette.rgb.dtype == np.uint8
+        assert palette.hexcodes == ["#%02x%02x%02x" % tuple(rgb) for rgb in palette.rgb]
+
+
+def test_generate_palette():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"))
+    palette = imageconverter.generate_palette(4, random_state=42, engine="histogram")
+    assert palette.rgb.shape == (4, 3)
+    assert imageconverter.hexcodes == palette.hexcodes
+    cmap = imageconverter.generate_cmap(4, "miami", 42, engine="histogram")
+    np.testing.assert_array_equal(cmap.colors, palette.colors)
+    assert imageconverter.palette.hexcodes == palette.hexcodes
+
+
+def test_optimal_palettes():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"))
+    cmaps, best_n_colors, _ = imageconverter.generate_optimal_cmap(max_colors=6, random_state=42, engine="histogram")
+    assert list(imageconverter.palettes) == list(cmaps)
+    for n_colors, cmap in cmaps.items():
+        np.testing.assert_array_equal(cmap.colors, imageconverter.palettes[n_colors].colors)
+    assert imageconverter.palette is imageconverter.palettes[best_n_colors]
+    assert imageconverter.hexcodes == imageconverter.palette.hexcodes
+
+
+@pytest.mark.parametrize("stopping", [{"min_improvement": 0.05}, {"knee_patience": 3}])
+def test_early_stopping(stopping):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/south_beach_sunset.jpg"), max_pixels=50_000)
+    cmaps, best_n_colors, ssd = imageconverter.generate_optimal_cmap(max_colors=20, random_state=42, engine="histogram", **stopping)
+    assert 4 <= max(ssd) < 20
+    assert list(cmaps) == list(ssd) == list(range(2, max(ssd) + 1))
+    assert best_n_colors in ssd
+
+    # a parallel sweep evaluates batches of numbers of colors but stops at the same one
+    _, parallel_best_n_colors, parallel_ssd = imageconverter.generate_optimal_cmap(
+        max_colors=20, random_state=42, engine="histogram", n_jobs=2, **stopping
+    )
+    assert (parallel_best_n_colors, parallel_ssd) == (best_n_colors, pytest.approx(ssd))
+
+
+def test_early_stopping_incremental_cache():
+    cache = PaletteCache()
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/south_beach_sunset.jpg"), max_pixels=50_000, cache=cache)
+    kwargs = dict(max_colors=20, random_state=42, sweep="incremental", min_improvement=0.05)
+    cmaps, best_n_colors, ssd = imageconverter.generate_optimal_cmap(**kwargs)
+    assert max(ssd) < 20
+    cached_cmaps, cached_best_n_colors, cached_ssd = imageconverter.generate_optimal_cmap(**kwargs)
+    assert cache.hits == 1
+    assert (list(cached_cmaps), cached_best_n_colors, cached_ssd) == (list(cmaps), best_n_colors, pytest.approx(ssd))
+
+
+@pytest.mark.parametrize("stopping", [{"min_improvement": 1.5}, {"knee_patience": 0}])
+def test_early_stopping_invalid(stopping):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000)
+    with pytest.raises(ValueError):
+        imageconverter.generate_optimal_cmap(max_colors=5, **stopping)
+
+
+def test_color_space_conversions():
+    rgb = np.array([[255, 0, 0], [255, 255, 255], [0, 0, 0], [30, 144, 255]], dtype=np.uint8)
+    np.testing.assert_allclose(from_rgb(rgb, "lab")[:3], [[53.24, 80.09, 67.20], [100, 0, 0], [0, 0, 0]], atol=0.01)
+    np.testing.assert_allclose(from_rgb(rgb, "oklab")[0], [0.628, 0.2249, 0.1258], atol=1e-3)
+    for color_space in ("lab", "oklab"):
+        colors = from_rgb(rgb, color_space)
+        np.testing.assert_allclose(to_rgb(colors, color_space), rgb, atol=1e-6)
+        # the lookup table path for pixels agrees with the exact path for color tables
+        np.testing.assert_allclose(pixels_from_rgb(rgb, color_space), colors, atol=1e-3)
+    assert pixels_from_rgb(rgb, "rgb") is rgb
+
+
+@pytest.mark.parametrize("engine", ["kmeans", "histogram"])
+@pytest.mark.parametrize("color_space", ["lab", "oklab"])
+def test_generate_cmap_color_space(engine, color_space):
+    cache = PaletteCache()
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), max_pixels=50_000, cache=cache)
+    rgb_palette = imageconverter.generate_palette(5, random_state=42, engine=engine)
+    palette = imageconverter.generate_palette(5, random_state=42, engine=engine, color_space=color_space)
+    assert palette.rgb.shape == (5, 3)
+    assert palette.hexcodes != rgb_palette.hexcodes
+    assert imageconverter.generate_palette(5, random_state=42, engine=engine, color_space=color_space).hexcodes == palette.hexcodes
+    assert cache.hits == 1
+    assert "color_space" in {timing.stage for timing in imageconverter.timings}
+
+    _, _, ssd = imageconverter.generate_optimal_cmap(
+        max_colors=6, random_state=42, engine=engine, sweep="incremental", color_space=color_space
+    )
+    assert list(ssd) == list(range(2, 7))
+
+
+def test_color_space_invalid():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000)
+    with pytest.raises(ValueError):
+        imageconverter.generate_cmap(3, color_space="hsv")
+
+
+@pytest.mark.parametrize("engine", ["median_cut", "octree"])
+def test_quantizer_engines(engine):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), max_pixels=50_000)
+    palette = imageconverter.generate_palette(5, engine=engine)
+    assert 1 <= len(palette.hexcodes) <= 5
+    assert imageconverter.kmeans is None
+
+    _, best_n_colors, ssd = imageconverter.generate_optimal_cmap(max_colors=8, engine=engine)
+    _, parallel_best_n_colors, parallel_ssd = imageconverter.generate_optimal_cmap(max_colors=8, engine=engine, n_jobs=2)
+    assert list(ssd) == list(range(2, 9))
+    assert parallel_ssd == ssd
+    assert parallel_best_n_colors == best_n_colors
+
+
+def test_register_engine():
+    def grayscale_ramp(pixels, n_colors, random_state=None):
+        centers = np.linspace(0, 255, n_colors)[:, None].repeat(3, axis=1)
+        labels = np.abs(pixels.mean(axis=1)[:, None] - centers[:, 0]).argmin(axis=1)
+        return centers, palette_inertia(pixels, labels, centers)
+
+    register_engine("grayscale_ramp", grayscale_ramp)
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), max_pixels=10_000)
+    palette = imageconverter.generate_palette(3, engine="grayscale_ramp")
+    assert palette.hexcodes == ["#000000", "#808080", "#ffffff"]
+    with pytest.raises(ValueError):
+        register_engine("kmeans", grayscale_ramp)
+    # the command line and the HTTP API accept engines registered after import
+    assert build_parser().parse_args(["image.png", "--engine", "grayscale_ramp"]).engine == "grayscale_ramp"
+    assert parse_options({"engine": "grayscale_ramp"})["engine"] == "grayscale_ramp"
+
+
+def test_quantizer_engines_invalid():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000)
+    with pytest.raises(ValueError):
+        imageconverter.generate_cmap(3, engine="octree", color_space="lab")
+    with pytest.raises(ValueError):
+        imageconverter.generate_optimal_cmap(max_colors=5, engine="octree", sweep="incremental")
+    with pytest.raises(ValueError):
+        imageconverter.generate_cmap(3, engine="nonexistent")
+
+
+@pytest.mark.parametrize("color_space", ["rgb", "oklab"])
+def test_palette_model_labels(color_space):
+    model = PaletteModel.from_hexcodes(["#ba7469", "#dfd67d", "5d536a", "#321e28"], color_space=color_space, bits=8)
+    assert model.hexcodes == ["#ba7469", "#dfd67d", "#5d536a", "#321e28"]
+    pixels = np.random.default_rng(0).integers(0, 256, size=(20_000, 3), dtype=np.uint8)
+    distances = ((from_rgb(pixels, color_space)[:, None, :] - from_rgb(model.colors, color_space)[None, :, :]) ** 2).sum(axis=2)
+    # the 8-bit lookup table is exact up to float32 ties
+    assert (model.labels(pixels) == distances.argmin(axis=1)).mean() > 0.999
+    coarse = PaletteModel(model.colors, color_space=color_space)
+    assert (coarse.labels(pixels) == distances.argmin(axis=1)).mean() > 0.95
+    assert coarse.labels(pixels.reshape(100, 200, 3)).shape == (100, 200)
+
+
+def test_palette_model_quantize(tmp_path):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"))
+    with pytest.raises(ValueError):
+        PaletteModel.from_converter(imageconverter)
+    imageconverter.generate_cmap(4, random_state=42, engine="histogram")
+    model = PaletteModel.from_converter(imageconverter)
+    assert model.hexcodes == imageconverter.hexcodes
+
+    quantized = model.quantize(THIS_DIR.joinpath("images/movie_chart.png"))
+    image = np.asarray(imageconverter.image)
+    assert quantized.shape == image.shape
+    np.testing.assert_array_equal(quantized[:, :, 3], image[:, :, 3])
+    assert {tuple(color) for color in quantized[:, :, :3].reshape(-1, 3)} <= {tuple(color) for color in model.rgb}
+    np.testing.assert_array_equal(quantized[:, :, :3], model.rgb[model.labels(image)])
+
+    model.save(tmp_path / "model.json")
+    loaded = PaletteModel.load(tmp_path / "model.json")
+    np.testing.assert_array_equal(loaded.quantize(image), quantized)
+    assert len(pickle.dumps(model)) < 1000
+    assert pickle.loads(pickle.dumps(model)).hexcodes == model.hexcodes
+    with pytest.raises(ValueError):
+        PaletteModel.from_dict(dict(model.to_dict(), version=0))
+    with pytest.raises(ValueError):
+        PaletteModel.from_hexcodes(["#12345g"])
+
+
+def test_palette_index():
+    rng = np.random.default_rng(0)
+    palettes = [rng.integers(0, 256, size=(rng.integers(2, 7), 3)) for _ in range(200)]
+    index = PaletteIndex(max_colors=6)
+    for chunk in (palettes[:64], palettes[64:128], palettes[128:]):
+        index.add(chunk)
+    assert len(index) == 200
+    assert index.ids[:3] == ["0", "1", "2"]
+
+    queries = [palettes[17][::-1], rng.integers(0, 256, size=(4, 3))]
+    distances, indices = index.query(queries, k=5)
+    assert indices[0, 0] == 17
+    assert distances[0, 0] == pytest.approx(0, abs=1e-3)
+    for query, row, neighbors in zip(queries, distances, indices):
+        expected = np.array([palette_distance(query, palette) for palette in palettes])
+        np.testing.assert_allclose(row, np.sort(expected)[:5], rtol=1e-3, atol=1e-4)
+        np.testing.assert_allclose(expected[neighbors], row, rtol=1e-3, atol=1e-4)
+    assert palette_distance(palettes[0], palettes[1]) == pytest.approx(palette_distance(palettes[1], palettes[0]), rel=1e-4)
+    with pytest.raises(ValueError):
+        index.add([rng.integers(0, 256, size=(7, 3))])
+
+
+def test_palette_index_persistence(tmp_path):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), max_pixels=50_000)
+    index = PaletteIndex(tmp_path / "index", max_colors=5)
+    index.add([imageconverter.generate_palette(5, random_state=42, engine="histogram")], ids=["movie_chart"])
+    index.add([["#ff0000", "#00ff00"], ["#000000", "#ffffff", "#808080"]], ids=["red_green", "grays"])
+
+    # bytes past the recorded size, as left by an interrupted add, are dropped by the next add
+    with open(tmp_path / "index" / "colors.f32", "ab") as f:
+        f.write(b"partial")
+    reopened = PaletteIndex(tmp_path / "index")
+    assert len(reopened) == 3
+    assert reopened.max_colors == 5
+    reopened.add([["#0000ff"]], ids=["blue"])
+    reopened = PaletteIndex(tmp_path / "index")
+    assert reopened.ids == ["movie_chart", "red_green", "grays", "blue"]
+    _, indices = reopened.query([["#010101", "#fefefe"], ["#00fe00", "#fe0000"]], k=2)
+    assert [reopened.ids[i] for i in indices[:, 0]] == ["grays", "red_green"]
+    with pytest.raises(ValueError):
+        PaletteIndex(tmp_path / "index", max_colors=10)
+
+
+def test_cli(tmp_path, capsys):
+    images = THIS_DIR.joinpath("images")
+    output = tmp_path / "palettes.jsonl"
+    args = [str(images), "-n", "3", "--max-pixels", "50000", "--cache-dir", str(tmp_path / "cache"), "-j", "2", "-o", str(output)]
+    assert main(args) == 0
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert sorted(record["source"] for record in records) == sorted(str(path) for path in images.iterdir())
+    assert all(len(record["hexcodes"]) == 3 and "fit" in record["timings"] for record in records)
+
+    # an interrupted run leaves a partial last line, which is dropped before the missing sources are appended
+    lines = output.read_text().splitlines(keepends=True)
+    output.write_text("".join(lines[:-1]) + lines[-1][:20])
+    assert main(args + ["--resume"]) == 0
+    resumed = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record["source"] for record in resumed] == [record["source"] for record in records]
+    assert resumed[-1]["cached"] and resumed[-1]["hexcodes"] == records[-1]["hexcodes"]
+    assert "1 done, 0 failed, 2 skipped" in capsys.readouterr().err
+    # only the inputs of this run that were already done count as skipped
+    assert main([records[0]["source"], "-o", str(output), "--resume"]) == 0
+    assert "0 done, 0 failed, 1 skipped" in capsys.readouterr().err
+
+    for workers in ("0", "-1"):
+        with pytest.raises(SystemExit):
+            main(args + ["-j", workers])
+
+
+def test_cli_optimal_csv(tmp_path, capsys):
+    sources = tmp_path / "sources.txt"
+    sources.write_text(f"# images\n{THIS_DIR.joinpath('images/movie_chart.png')}\n\nmissing.png\n")
+    assert main(["-i", str(sources), "--optimal", "--max-colors", "6", "--engine", "histogram", "-f", "csv"]) == 1
+    rows = list(csv.DictReader(capsys.readouterr().out.splitlines()))
+    assert [row["source"] for row in rows] == [str(THIS_DIR.joinpath("images/movie_chart.png")), "missing.png"]
+    assert list(json.loads(rows[0]["ssd"])) == ["2", "3", "4", "5", "6"]
+    assert len(rows[0]["hexcodes"].split()) == int(rows[0]["best_n_colors"])
+    assert rows[1]["error"].startswith("FileNotFoundError")
+
+
+@pytest.fixture(scope="module")
+def palette_server():
+    service = PaletteService(workers=1, max_queue=1)
+    server = make_server(port=0, service=service, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def _post_palette(server, query="", body=b"", content_type="image/png"):
+    url = f"http://127.0.0.1:{server.server_address[1]}/palette?{query}"
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        with error:
+            return error.code, json.loads(error.read())
+
+
+def test_server_palette(palette_server):
+    data = THIS_DIR.joinpath("images/movie_chart.png").read_bytes()
+    with ThreadPoolExecutor(4) as pool:
+        responses = list(pool.map(lambda _: _post_palette(palette_server, "n_colors=3&engine=histogram", data), range(4)))
+    expected = ImageConverter(data, max_pixels=250_000).generate_palette(3, random_state=42, engine="histogram").hexcodes
+    assert all(status == 200 and result["hexcodes"] == expected for status, result in responses)
+    # the requests arrive while the worker process starts, so they share one computation
+    assert sum(result["coalesced"] for _, result in responses) == 3
+
+    assert _post_palette(palette_server, "n_colors=x", data)[0] == 400
+    assert _post_palette(palette_server, "colors=3", data)[0] == 400
+    assert _post_palette(palette_server, "", b"not an image")[0] == 422
+    assert _post_palette(palette_server, "", b"{}", "application/json")[0] == 400
+    for url in ("file:///etc/passwd", "ftp://localhost/image.png", "data:image/png;base64,AAAA", "file:///dev/stdin"):
+        assert _post_palette(palette_server, "", json.dumps({"url": url}).encode(), "application/json")[0] == 400
+    assert _post_palette(palette_server, "optimal=true&max_colors=100000", data)[0] == 400
+    assert _post_palette(palette_server, "n_colors=21", data)[0] == 400
+    # a few KB on the wire that would decode to 400 megapixels
+    bomb = BytesIO()
+    Image.new("1", (20_000, 20_000)).save(bomb, format="PNG")
+    assert _post_palette(palette_server, "", bomb.getvalue())[0] == 413
+    # 100 megapixels is below the limit of Pillow, the server still rejects it before decoding
+    bomb = BytesIO()
+    Image.new("1", (10_000, 10_000)).save(bomb, format="PNG")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+        assert _post_palette(palette_server, "", bomb.getvalue())[0] == 413
+    with urllib.request.urlopen(f"http://127.0.0.1:{palette_server.server_address[1]}/metrics") as response:
+        metrics = json.loads(response.read())
+    assert metrics["coalesced"] == 3
+    assert metrics["queue_depth"] == 0
+    # invalid images are rejected before they reach a worker
+    assert metrics["computations"] == 1
+    assert metrics["failed"] == 0
+
+
+@pytest.mark.parametrize("length, status", [(None, 411), ("-1", 400), ("ten", 400)])
+def test_server_content_length(palette_server, length, status):
+    connection = http.client.HTTPConnection("127.0.0.1", palette_server.server_address[1])
+    connection.putrequest("POST", "/palette")
+    if length is not None:
+        connection.putheader("Content-Length", length)
+    connection.endheaders()
+    response = connection.getresponse()
+    assert response.status == status
+    assert "Content-Length" in json.loads(response.read())["error"]
+    connection.close()
+
+
+def test_server_backpressure(palette_server):
+    service = palette_server.service
+    options = parse_options({"n_colors": "3"})
+    data = THIS_DIR.joinpath("images/black_square.jpg").read_bytes()
+    future, _ = service.submit(data, options)
+    with pytest.raises(Overloaded):
+        service.submit(data, dict(options, n_colors=4))
+    assert service.submit(data, options) == (future, True)
+    assert len(future.result()["hexcodes"]) == 3
+    assert service.metrics()["rejected"] == 1
+
+
+def test_server_worker_failure():
+    class FailingService:
+        def submit(self, data, options):
+            future = Future()
+            future.set_exception(RuntimeError("worker died"))
+            return future, False
+
+    server = make_server(port=0, service=FailingService(), quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        status, result = _post_palette(server, "", THIS_DIR.joinpath("images/black_square.jpg").read_bytes())
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert status == 500
+    assert "RuntimeError" in result["error"]
+
+
+def test_server_worker_killed():
+    service = PaletteService(workers=1)
+    server = make_server(port=0, service=service, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    data = THIS_DIR.joinpath("images/black_square.jpg").read_bytes()
+    try:
+        assert _post_palette(server, "n_colors=2", data)[0] == 200
+        for process in service._pool._processes.values():
+            process.kill()
+            process.join()
+        status, result = _post_palette(server, "n_colors=3", data)
+        assert status == 503
+        assert "worker" in result["error"]
+        # the broken pool is replaced, by the time the failed request returns or by the next submit at the latest
+        statuses = [_post_palette(server, "n_colors=3", data)[0] for _ in range(2)]
+        assert statuses[-1] == 200
+        assert service.metrics()["restarts"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+
+def _blocky_image(height, width, seed=0):
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 256, size=(height // 50 + 1, width // 50 + 1, 3)).repeat(50, axis=0).repeat(50, axis=1)
+    return np.clip(blocks[:height, :width] + rng.integers(-8, 9, size=(height, width, 3)), 0, 255).astype(np.uint8)
+
+
+@pytest.mark.parametrize("suffix", [".tif", ".bmp", ".png"])
+def test_streaming(tmp_path, suffix):
+    array = _blocky_image(400, 600)
+    path = tmp_path.joinpath(f"scan{suffix}")
+    Image.fromarray(array).save(path)
+    imageconverter = ImageConverter(path, max_pixels=5_000, streaming=True)
+    assert imageconverter.pixels.shape == (5_000, 3)
+    assert imageconverter.timings[1].stage == "stream"
+
+    # the histogram engine sees every pixel, not only the sample
+    colors, counts = imageconverter._histogram(5)
+    expected_colors, expected_counts = color_histogram(array.reshape(-1, 3), 5)
+    np.testing.assert_array_equal(counts, expected_counts)
+    np.testing.assert_allclose(colors, expected_colors, rtol=1e-6)
+    palette = imageconverter.generate_palette(4, random_state=42, engine="histogram")
+    assert palette.hexcodes == ImageConverter(array).generate_palette(4, random_state=42, engine="histogram").hexcodes
+
+
+def test_streaming_resize():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/south_beach_sunset.jpg"), max_pixels=200_000, streaming=True)
+    sample = imageconverter.pixels.copy()
+    imageconverter.resize((300, 300))
+    # the sample is thinned out, never resampled, so no blended colors appear
+    assert len(imageconverter.pixels) <= 90_000
+    np.testing.assert_array_equal(imageconverter.pixels, sample[:: -(-len(sample) // 90_000)])
+    assert imageconverter.image.size == (len(imageconverter.pixels), 1)
+
+
+def test_streaming_transparent(tmp_path):
+    array = np.dstack([_blocky_image(300, 200), np.full((300, 200), 255, dtype=np.uint8)])
+    array[:100, :, 3] = 0
+    path = tmp_path.joinpath("scan.tif")
+    Image.fromarray(array).save(path)
+    imageconverter = ImageConverter(path, max_pixels=2_000, streaming=True)
+    assert imageconverter.transparent_pixels.any()
+    imageconverter.remove_transparent()
+    assert len(imageconverter.pixels) < 2_000
+    _, counts = imageconverter._histogram(5)
+    assert counts.sum() == 200 * 200
+
+
+def test_iter_strips_decoded(tmp_path):
+    # a compressed palette image is cropped and converted strip by strip
+    path = tmp_path.joinpath("scan.gif")
+    Image.fromarray(_blocky_image(130, 90)).convert("P").save(path, transparency=0)
+    with Image.open(path) as image:
+        strips = list(iter_strips(image, rows=40))
+        expected = np.asarray(image.convert("RGBA")).reshape(-1, 4)
+    assert [len(strip) for strip in strips] == [40 * 90] * 3 + [10 * 90]
+    np.testing.assert_array_equal(np.concatenate(strips), expected)
+
+
+@pytest.fixture
+def animation():
+    # three scenes of ten slightly noisy frames each
+    frames = []
+    for scene in range(3):
+        base = _blocky_image(60, 80, seed=scene).astype(np.int16)
+        noise = np.random.default_rng(scene).integers(-3, 4, size=(10, 60, 80, 3))
+        frames.extend(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return np.stack(frames)
+
+
+def test_frame_palettes(animation, tmp_path):
+    results = list(generate_frame_palettes(animation, n_colors=4, random_state=42))
+    assert [result.index for result in results] == list(range(30))
+    assert sorted({result.keyframe for result in results}) == [0, 10, 20]
+    assert results[0].change is None
+    for result in results[1:]:
+        assert len(result.palette.hexcodes) == 4
+        assert result.palette is results[result.keyframe].palette
+        assert (result.change < 0.1) == (result.index != result.keyframe)
+
+    # animated GIFs give one palette per frame, threshold=0 clusters every frame
+    path = tmp_path.joinpath("animation.gif")
+    images = [Image.fromarray(frame) for frame in animation]
+    images[0].save(path, save_all=True, append_images=images[1:])
+    results = list(generate_frame_palettes(path, n_colors=4, random_state=42, threshold=0))
+    assert [result.keyframe for result in results] == list(range(30))
+
+
+def test_frame_palettes_blank_frames(animation):
+    opaque = np.full(animation.shape[:3] + (1,), 255, dtype=np.uint8)
+    frames = np.concatenate([animation, opaque], axis=3)
+    blank = np.zeros_like(frames[0])
+    results = list(generate_frame_palettes([blank, frames[0], frames[1], blank], n_colors=4, random_state=42, remove_transparent=True))
+    assert results[0].palette is None and results[0].keyframe is None
+    assert results[1].keyframe == 1
+    assert results[3].palette is results[1].palette
+    assert results[3].change == 0
+
+
+def test_aggregate_palette(animation):
+    palette = generate_aggregate_palette(list(animation), n_colors=5, random_state=42)
+    assert palette.rgb.shape == (5, 3)
+    with pytest.raises(ValueError):
+        generate_aggregate_palette(animation[0], n_colors=5)
+
+
+def test_stage_timings():
+    recorded = []
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"), max_pixels=20_000, on_stage=recorded.append)
+    imageconverter.remove_transparent()
+    imageconverter.generate_cmap(4, random_state=42, engine="histogram")
+    assert recorded == imageconverter.timings
+    assert all(isinstance(timing, StageTiming) and timing.seconds >= 0 for timing in recorded)
+    assert [timing.stage for timing in recorded] == [
+        "open",
+        "decode",
+        "resize",
+        "pixels",
+        "remove_transparent",
+        "histogram",
+        "fit",
+        "palette",
+    ]
+    fit = recorded[-2]
+    assert (fit.n_colors, fit.pixels) == (4, len(imageconverter._histogram(5)[0]))
+    assert fit.iterations == imageconverter.kmeans.n_iter_
+    assert recorded[3].pixels <= 20_000
+
+
+@pytest.mark.parametrize("sweep, n_jobs", [("independent", None), ("independent", 2), ("incremental", None)])
+def test_sweep_timings(sweep, n_jobs, caplog):
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/black_square.jpg"), max_pixels=10_000)
+    imageconverter.timings.clear()
+    with caplog.at_level("DEBUG", logger="img2cmap.convert"):
+        imageconverter.generate_optimal_cmap(max_colors=5, random_state=42, sweep=sweep, n_jobs=n_jobs)
+    fits = [timing for timing in imageconverter.timings if timing.stage == "fit"]
+    assert [timing.n_colors for timing in fits] == [2, 3, 4, 5]
+    assert all(timing.iterations >= 1 for timing in fits)
+    assert [timing.stage for timing in imageconverter.timings][-2:] == ["palette", "knee"]
+    assert len(caplog.records) == len(imageconverter.timings)
+
+
+def test_lazy_imports():
+    script = (
+        "import sys; import img2cmap; loaded = {m.split('.')[0] for m in sys.modules}; "
+        "print(sorted(loaded & {'sklearn', 'scipy', 'kneed', 'matplotlib', 'joblib'})); "
+        f"img2cmap.ImageConverter({str(THIS_DIR.joinpath('images/black_square.jpg'))!r}).generate_palette(2, random_state=42); "
+        "print('matplotlib' in sys.modules, 'kneed' in sys.modules)"
+    )
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+    assert result.stdout.split("\n")[:2] == ["[]", "False False"]
+
+
 def test_resize():
     imageconverter = ImageConverter(THIS_DIR.joinpath("images/south_beach_sunset.jpg"))
     imageconverter.resize(size=(512, 512))
     # thumbnail preserves the aspect ratio
     assert imageconverter.image.size == (512, 361)
+    assert imageconverter.pixels.shape == (512 * 361, 3)
+
+
+def test_resize_after_remove_transparent():
+    imageconverter = ImageConverter(THIS_DIR.joinpath("images/movie_chart.png"))
+    imageconverter.remove_transparent()
+    imageconverter.resize(size=(64, 64))
+    assert imageconverter.pixels.shape[0] == (~imageconverter.transparent_pixels).sum()
+
+
+@pytest.mark.parametrize("test_image_input", test_image_files)
+def test_max_pixels(test_image_input):
+    imageconverter = ImageConverter(test_image_input, max_pixels=10_000)
+    assert imageconverter.pixels.shape[0] <= 10_000
+    cmap = imageconverter.generate_cmap(4, "miami", 42)
+    assert cmap.N == 4
 
 
 @pytest.mark.parametrize("test_image_input", images)